@@ -8,3 +8,6 @@ import pysnooper_click_able
 from tomorrow3 import threads as tomorrow_threads
 from .common_decorators import *
 from .black_technology_decorators import *
+from .process_pool import WorkerCrashedError
+from .scheduler import IDLE
+from .thread_pool import RejectedExecutionError
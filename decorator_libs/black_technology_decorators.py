@@ -1,81 +1,359 @@
 """
 这里是黑科技装饰器，有想法的装饰器
 """
-import json
+import cProfile
+import itertools
+import logging
+import os
+import pstats
+import random
+import reprlib
+import signal
 import sys
+import tempfile
+import threading
 import time
 import traceback
+import tracemalloc
 import unittest
 from functools import wraps
 
 from nb_log import LogManager
 
+from .scheduler import get_default_scheduler
+from .tracing import span_tracer
 
-def where_is_it_called(func):
-    """一个装饰器，被装饰的函数，如果被调用，将记录一条日志,记录函数被什么文件的哪一行代码所调用，非常犀利黑科技的装饰器"""
+
+class _CallSite:
+    __slots__ = ('file_name', 'line', 'function', 'count')
+
+    def __init__(self, file_name, line, function):
+        self.file_name = file_name
+        self.line = line
+        self.function = function
+        self.count = 0
+
+
+def where_is_it_called(func=None, *, sample_every=1, sample_rate=None, max_repr=200):
+    """
+    一个装饰器，被装饰的函数，如果被调用，将记录一条日志,记录函数被什么文件的哪一行代码所调用，非常犀利黑科技的装饰器
+    每次调用都会按调用位置(文件, 行)计数，装饰后的函数的 callers() 返回调用位置统计表， dump_callers() 把统计表写到日志，
+    生产环境可以只抽样记录日志，需要时再查看统计表。参数和结果用 reprlib 截断，不会完整格式化很大的对象。
+    :param sample_every: 每N次调用记录一次日志，1为每次都记录
+    :param sample_rate: 按概率抽样记录日志，例如0.01，设置了这个参数时忽略sample_every
+    :param max_repr: 日志里面参数和结果的最大长度
+    """
     if not hasattr(where_is_it_called, 'log'):
         where_is_it_called.log = LogManager('where_is_it_called').get_logger_and_add_handlers()
-
-    # noinspection PyProtectedMember
-    @wraps(func)
-    def _where_is_it_called(*args, **kwargs):
-        # 获取被调用函数名称
-        # func_name = sys._getframe().f_code.co_name
-        func_name = func.__name__
-        # 什么函数调用了此函数
-        which_fun_call_this = sys._getframe(1).f_code.co_name  # NOQA
-
-        # 获取被调用函数在被调用时所处代码行数
-        line = sys._getframe().f_back.f_lineno
-
-        # 获取被调用函数所在模块文件名
-        file_name = sys._getframe(1).f_code.co_filename
-
-        # noinspection PyPep8
-        where_is_it_called.log.debug(
-            f'文件[{func.__code__.co_filename}]的第[{func.__code__.co_firstlineno}]行即模块 [{func.__module__}] 中的方法 [{func_name}] 正在被文件 [{file_name}] 中的'
-            f'方法 [{which_fun_call_this}] 中的第 [{line}] 行处调用，传入的参数为[{args},{kwargs}]')
+    log = where_is_it_called.log
+    short_repr = reprlib.Repr()
+    short_repr.maxstring = short_repr.maxother = max_repr
+    short_repr.maxlong = max_repr
+
+    def _where_is_it_called_decorator(fun):
+        func_name = fun.__name__
+        func_desc = (f'文件[{fun.__code__.co_filename}]的第[{fun.__code__.co_firstlineno}]行即模块 [{fun.__module__}] '
+                     f'中的方法 [{func_name}]')
+        sites = {}  # (调用方的code对象, 行号) -> _CallSite ，同一个调用位置只格式化一次
+        lock = threading.Lock()
+        counter = itertools.count()
+
+        def _sampled():
+            if sample_rate is not None:
+                return random.random() < sample_rate
+            return sample_every <= 1 or next(counter) % sample_every == 0
+
+        # noinspection PyProtectedMember
+        @wraps(fun)
+        def _where_is_it_called(*args, **kwargs):
+            frame = sys._getframe(1)  # NOQA 只取一次调用方的栈帧
+            key = (frame.f_code, frame.f_lineno)
+            with lock:
+                site = sites.get(key)
+                if site is None:
+                    site = sites[key] = _CallSite(frame.f_code.co_filename, frame.f_lineno, frame.f_code.co_name)
+                site.count += 1
+            del frame
+            if not (_sampled() and log.isEnabledFor(logging.DEBUG)):
+                return fun(*args, **kwargs)
+
+            # noinspection PyPep8
+            log.debug(f'{func_desc} 正在被文件 [{site.file_name}] 中的方法 [{site.function}] 中的第 [{site.line}] 行处调用，'
+                      f'传入的参数为[{short_repr.repr(args)},{short_repr.repr(kwargs)}]')
+            try:
+                t0 = time.perf_counter()
+                result = fun(*args, **kwargs)
+                t_spend = round(time.perf_counter() - t0, 4)
+                log.debug(f'执行函数[{func_name}]消耗的时间是{t_spend}秒，返回的结果是 --> {short_repr.repr(result)}')
+                return result
+            except Exception as e:
+                log.debug('执行函数{}，发生错误'.format(func_name))
+                log.exception(e)
+                raise e
+
+        def callers():
+            """调用位置统计表，按调用次数从多到少排列"""
+            with lock:
+                rows = [{'file_name': site.file_name, 'line': site.line, 'function': site.function, 'count': site.count}
+                        for site in sites.values()]
+            return sorted(rows, key=lambda row: row['count'], reverse=True)
+
+        def dump_callers():
+            rows = callers()
+            lines = '\n'.join(f'{row["count"]:>10}  "{row["file_name"]}:{row["line"]}"  {row["function"]}' for row in rows)
+            log.debug(f'{func_desc} 的调用位置统计，共 {sum(row["count"] for row in rows)} 次调用:\n{lines}')
+
+        def reset_callers():
+            with lock:
+                sites.clear()
+
+        _where_is_it_called.callers = callers
+        _where_is_it_called.dump_callers = dump_callers
+        _where_is_it_called.reset_callers = reset_callers
+        return _where_is_it_called
+
+    if func is not None:
+        return _where_is_it_called_decorator(func)
+    return _where_is_it_called_decorator
+
+
+_profiling = threading.local()  # 当前线程是否正在被抽样分析，cProfile 不能在同一个线程嵌套开启
+_profiled_functions = {}  # 函数限定名 -> _ProfiledFunction
+_tracemalloc_lock = threading.Lock()
+_tracemalloc_users = 0
+_tracemalloc_owned = False  # tracemalloc 是不是这个装饰器开启的，用户自己开启的不能停止也不能重置峰值
+
+
+class _ProfiledFunction:
+    """一个被 profiled 装饰的函数的合并统计"""
+
+    def __init__(self, name, dump_dir):
+        self.name = name
+        self.dump_dir = dump_dir
+        self.stats = None
+        self.sampled_calls = 0
+        self.memory_sites = {}  # (调用方文件, 行号) -> [抽样次数, 最大峰值字节, 峰值字节总和]
+        self.lock = threading.Lock()
+
+    def add_profile(self, profile):
+        with self.lock:
+            self.sampled_calls += 1
+            if self.stats is None:
+                self.stats = pstats.Stats(profile)
+            else:
+                self.stats.add(profile)
+
+    def add_memory_peak(self, site, peak):
+        with self.lock:
+            row = self.memory_sites.get(site)
+            if row is None:
+                row = self.memory_sites[site] = [0, 0, 0]
+            row[0] += 1
+            row[1] = max(row[1], peak)
+            row[2] += peak
+
+    def profile_stats(self):
+        """合并的 pstats.Stats 的副本，还没有抽中过返回None"""
+        with self.lock:
+            if self.stats is None:
+                return None
+            stats = pstats.Stats()
+            stats.add(self.stats)
+            return stats
+
+    def memory_stats(self):
+        with self.lock:
+            rows = [{'file_name': site[0], 'line': site[1], 'count': count, 'max_peak_bytes': max_peak,
+                     'avg_peak_bytes': total // count} for site, (count, max_peak, total) in self.memory_sites.items()]
+        return sorted(rows, key=lambda row: row['max_peak_bytes'], reverse=True)
+
+    def dump(self):
+        """把合并的统计写到 dump_dir/函数限定名.prof ，用 python -m pstats 或者 snakeviz 查看，内存统计写到 .mem.txt"""
+        os.makedirs(self.dump_dir, exist_ok=True)
+        base = os.path.join(self.dump_dir, self.name)
+        with self.lock:
+            if self.stats is not None:
+                self.stats.dump_stats(base + '.prof')
+        rows = self.memory_stats()
+        if rows:
+            with open(base + '.mem.txt', 'w', encoding='utf8') as f:
+                for row in rows:
+                    f.write(f'{row["max_peak_bytes"]:>14} {row["avg_peak_bytes"]:>14} {row["count"]:>8}  '
+                            f'"{row["file_name"]}:{row["line"]}"\n')
+        return base
+
+
+def dump_all_profiles():
+    """把所有被 profiled 装饰的函数的统计写到磁盘"""
+    return [profiled_function.dump() for profiled_function in list(_profiled_functions.values())]
+
+
+_dump_signal_previous = {}  # 信号 -> 安装之前的信号处理函数
+_dump_wakeup_fd = None  # 信号处理函数只往这个管道写一个字节，由后台线程写磁盘
+
+
+def _dump_worker(read_fd):
+    log = LogManager('profiled').get_logger_and_add_handlers()
+    while True:
+        os.read(read_fd, 512)
         try:
-            t0 = time.time()
-            result = func(*args, **kwargs)
-            result_raw = result
-            t_spend = round(time.time() - t0, 2)
-            if isinstance(result, dict):
-                result = json.dumps(result)
-            if len(str(result)) > 200:
-                result = str(result)[0:200] + '  。。。。。。  '
-            where_is_it_called.log.debug('执行函数[{}]消耗的时间是{}秒，返回的结果是 --> '.format(func_name, t_spend) + str(result))
-            return result_raw
-        except Exception as e:
-            where_is_it_called.log.debug('执行函数{}，发生错误'.format(func_name))
-            where_is_it_called.log.exception(e)
-            raise e
-
-    return _where_is_it_called
+            dump_all_profiles()
+        except Exception as e:  # noqa
+            log.exception(f'收到信号后写出性能分析统计出错 {e!r}')
+
+
+def _on_dump_signal(signum, frame):
+    """
+    信号处理函数在主线程两条字节码之间运行，主线程这时可能正持有统计的锁，所以这里不能加锁，也不写文件，只唤醒后台线程
+    """
+    try:
+        os.write(_dump_wakeup_fd, b'\0')
+    except (BlockingIOError, InterruptedError):  # 管道满了说明已经有没处理的唤醒，这次可以忽略
+        pass
+    previous = _dump_signal_previous.get(signum)
+    if callable(previous):
+        previous(signum, frame)
+
+
+def _install_dump_signal(dump_signal):
+    global _dump_wakeup_fd
+    if dump_signal in _dump_signal_previous:
+        return
+    if _dump_wakeup_fd is None:
+        read_fd, _dump_wakeup_fd = os.pipe()
+        os.set_blocking(_dump_wakeup_fd, False)
+        threading.Thread(target=_dump_worker, args=(read_fd,), daemon=True, name='profiled_dump_on_signal').start()
+    _dump_signal_previous[dump_signal] = signal.getsignal(dump_signal)
+    signal.signal(dump_signal, _on_dump_signal)
+
+
+def _tracemalloc_acquire():
+    global _tracemalloc_users, _tracemalloc_owned
+    with _tracemalloc_lock:
+        if _tracemalloc_users == 0:
+            _tracemalloc_owned = not tracemalloc.is_tracing()
+            if _tracemalloc_owned:
+                tracemalloc.start()
+        _tracemalloc_users += 1
+        if _tracemalloc_owned:
+            tracemalloc.reset_peak()
+        return tracemalloc.get_traced_memory()[0]
+
+
+def _tracemalloc_release():
+    """返回调用期间的峰值；tracemalloc是用户开启的时候不能重置峰值，返回调用结束时的内存占用，只能近似反映净增长"""
+    global _tracemalloc_users, _tracemalloc_owned
+    with _tracemalloc_lock:
+        current, peak = tracemalloc.get_traced_memory()
+        _tracemalloc_users -= 1
+        owned = _tracemalloc_owned
+        if _tracemalloc_users == 0 and owned:
+            tracemalloc.stop()
+            _tracemalloc_owned = False
+        return peak if owned else current
+
+
+def profiled(sample_every=100, dump_dir=None, dump_interval=300, dump_signal=None, trace_memory=False):
+    """
+    抽样性能分析装饰器，每 sample_every 次调用用 cProfile 分析一次，同一个函数的结果合并成一个 pstats.Stats ，
+    定时或者收到信号时写到磁盘，可以在生产环境持续地分析热点函数，没抽中的调用几乎没有额外开销。
+    装饰后的函数有 profile_stats() memory_stats() dump_profile() 方法，也可以用 dump_all_profiles() 写出所有函数的统计。
+    :param sample_every: 每N次调用分析一次
+    :param dump_dir: 统计文件写到哪个文件夹，默认是临时文件夹下的 decorator_libs_profiles
+    :param dump_interval: 每隔多少秒写一次磁盘，None为不定时写
+    :param dump_signal: 收到这个信号时在后台线程写出所有函数的统计，例如 signal.SIGUSR1 ，只能在主线程里面装饰，
+                        之前安装的信号处理函数仍然会被调用
+    :param trace_memory: 抽中的调用同时用 tracemalloc 记录内存分配峰值，按调用位置统计。
+                         tracemalloc 开启期间所有线程的内存分配都会变慢，同时有多个抽中的调用时峰值是互相叠加的近似值
+    """
+    dump_dir = dump_dir or os.path.join(tempfile.gettempdir(), 'decorator_libs_profiles')
+    if dump_signal is not None:
+        _install_dump_signal(dump_signal)
+
+    def _profiled(func):
+        name = f'{func.__module__}.{func.__qualname__}'
+        profiled_function = _profiled_functions.setdefault(name, _ProfiledFunction(name, dump_dir))
+        counter = itertools.count()
+        dump_job = []
+
+        def _start_dump_job():
+            with profiled_function.lock:
+                if not dump_job:
+                    dump_job.append(get_default_scheduler().schedule(
+                        profiled_function.dump, interval=dump_interval, name=f'profiled_dump_{name}',
+                        run_immediately=False))
+
+        @wraps(func)
+        def __profiled(*args, **kwargs):
+            if next(counter) % sample_every or getattr(_profiling, 'active', False):
+                return func(*args, **kwargs)
+            if dump_interval is not None and not dump_job:
+                _start_dump_job()
+            site = None
+            if trace_memory:
+                frame = sys._getframe(1)  # NOQA
+                site = (frame.f_code.co_filename, frame.f_lineno)
+                del frame
+                memory_before = _tracemalloc_acquire()
+            profile = cProfile.Profile()
+            _profiling.active = True
+            try:
+                profile.enable()
+            except ValueError:  # 已经有别的分析工具在运行了，这次不分析
+                profile = None
+            try:
+                return func(*args, **kwargs)
+            finally:
+                if profile is not None:
+                    profile.disable()
+                    profiled_function.add_profile(profile)
+                _profiling.active = False
+                if trace_memory:
+                    profiled_function.add_memory_peak(site, max(_tracemalloc_release() - memory_before, 0))
+
+        __profiled.profile_stats = profiled_function.profile_stats
+        __profiled.memory_stats = profiled_function.memory_stats
+        __profiled.dump_profile = profiled_function.dump
+        return __profiled
+
+    return _profiled
 
 
 # noinspection PyProtectedMember
 class TimerContextManager(object):
     """
     用上下文管理器计时，可对代码片段计时
+    span_tracer.enable() 开启追踪后，每个with代码块是一个span，嵌套的代码块和被timer装饰的函数会按调用路径关联起来。
     """
     log = LogManager('TimerContext').get_logger_and_add_handlers()
 
-    def __init__(self, is_print_log=True):
+    def __init__(self, is_print_log=True, name=None):
+        """
+        :param is_print_log: 是否写日志
+        :param name: span的名字，默认是 文件名:行号
+        """
         self._is_print_log = is_print_log
+        self._name = name
         self.t_spend = None
         self._line = None
         self._file_name = None
         self.time_start = None
+        self._span = None
 
     def __enter__(self):
-        self._line = sys._getframe().f_back.f_lineno  # 调用此方法的代码的函数
-        self._file_name = sys._getframe(1).f_code.co_filename  # 哪个文件调了用此方法
+        frame = sys._getframe(1)  # 调用此方法的代码的栈帧
+        self._line = frame.f_lineno
+        self._file_name = frame.f_code.co_filename  # 哪个文件调了用此方法
+        if span_tracer.enabled:
+            self._span = span_tracer.start_span(self._name or f'{os.path.basename(self._file_name)}:{self._line}')
         self.time_start = time.time()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.t_spend = time.time() - self.time_start
+        if self._span is not None:
+            span_tracer.end_span(self._span)
+            self._span = None
         if self._is_print_log:
             self.log.debug(f'对下面代码片段进行计时:  \n执行"{self._file_name}:{self._line}" 用时 {round(self.t_spend, 2)} 秒')
 
@@ -130,6 +408,92 @@ class _Test(unittest.TestCase):
             print('测试这里面的代码片段的时间。')
             time.sleep(2)
 
+    def test_timer_context_spans(self):
+        """测试嵌套的计时上下文按调用路径形成span"""
+        span_tracer.reset()
+        span_tracer.enable()
+        try:
+            with TimerContextManager(is_print_log=False, name='outer'):
+                for _ in range(2):
+                    with TimerContextManager(is_print_log=False, name='inner'):
+                        time.sleep(0.001)
+        finally:
+            span_tracer.disable()
+        rows = {row['path']: row['count'] for row in span_tracer.stats()}
+        self.assertEqual(rows, {'outer': 1, 'outer;inner': 2})
+        span_tracer.reset()
+
+    def test_profiled(self):
+        """测试抽样性能分析，合并统计并写到磁盘"""
+
+        def _work(n):
+            return sum(i * i for i in range(n))
+
+        @profiled(sample_every=5, dump_dir=tempfile.mkdtemp(), dump_interval=None, trace_memory=True)
+        def f11(n):
+            _work(n)
+            return [0] * n
+
+        for _ in range(20):
+            f11(10000)
+        stats = f11.profile_stats()
+        self.assertEqual(len([1 for (_, _, func_name) in stats.stats if func_name == '_work']), 1)
+        calls = [value[1] for (_, _, func_name), value in stats.stats.items() if func_name == '_work'][0]
+        self.assertEqual(calls, 4)  # 20次调用抽中4次
+        memory = f11.memory_stats()
+        self.assertEqual(memory[0]['count'], 4)
+        self.assertGreaterEqual(memory[0]['max_peak_bytes'], 80000)
+        self.assertFalse(tracemalloc.is_tracing())
+        base = f11.dump_profile()
+        self.assertTrue(os.path.exists(base + '.prof'))
+        self.assertTrue(os.path.exists(base + '.mem.txt'))
+        pstats.Stats(base + '.prof')
+
+    def test_profiled_dump_signal(self):
+        """信号到来时主线程正持有统计的锁也不会死锁，统计在后台线程写出，之前的信号处理函数照样被调用"""
+        previous_calls = []
+        old_handler = signal.signal(signal.SIGUSR1, lambda signum, frame: previous_calls.append(signum))
+        dump_dir = tempfile.mkdtemp()
+        try:
+            @profiled(sample_every=1, dump_dir=dump_dir, dump_interval=None, dump_signal=signal.SIGUSR1)
+            def f13():
+                return 1
+
+            f13()
+            profiled_function = _profiled_functions[f'{f13.__module__}.{f13.__qualname__}']
+            with profiled_function.lock:
+                os.kill(os.getpid(), signal.SIGUSR1)
+                time.sleep(0.05)
+            self.assertEqual(previous_calls, [signal.SIGUSR1])
+            for _ in range(100):
+                if os.path.exists(os.path.join(dump_dir, profiled_function.name + '.prof')):
+                    break
+                time.sleep(0.01)
+            self.assertTrue(os.path.exists(os.path.join(dump_dir, profiled_function.name + '.prof')))
+            self.assertIsNot(f13.profile_stats(), profiled_function.stats)
+        finally:
+            signal.signal(signal.SIGUSR1, old_handler)
+            _dump_signal_previous.pop(signal.SIGUSR1, None)
+
+    def test_profiled_keeps_user_tracemalloc(self):
+        """用户自己开启的 tracemalloc 不能被停止，峰值也不能被重置"""
+
+        @profiled(sample_every=1, dump_interval=None, trace_memory=True)
+        def f12():
+            return [0] * 1000
+
+        tracemalloc.start()
+        try:
+            big = [0] * 1000000
+            del big
+            user_peak = tracemalloc.get_traced_memory()[1]
+            f12()
+            self.assertTrue(tracemalloc.is_tracing())
+            self.assertGreaterEqual(tracemalloc.get_traced_memory()[1], user_peak)
+            self.assertEqual(f12.memory_stats()[0]['count'], 1)
+        finally:
+            tracemalloc.stop()
+
     @unittest.skip
     def test_where_is_it_called(self):
         """测试函数被调用的装饰器，被调用2次将会记录2次被调用的日志"""
@@ -145,6 +509,33 @@ class _Test(unittest.TestCase):
 
         f9(3, 4)
 
+    def test_where_is_it_called_sampling_and_callers(self):
+        """测试抽样记录日志和调用位置统计表"""
+        logged = []
+
+        @where_is_it_called(sample_every=10, max_repr=20)
+        def f10(data):
+            return data * 2
+
+        handler = logging.Handler()
+        handler.emit = lambda record: logged.append(record.getMessage())
+        where_is_it_called.log.addHandler(handler)
+        try:
+            for _ in range(20):
+                f10('x' * 1000)
+            f10(1)
+        finally:
+            where_is_it_called.log.removeHandler(handler)
+        self.assertEqual(len(logged), 6)  # 第1 11 21次调用，每次调用记录参数和结果两条日志
+        self.assertTrue(all(len(message) < 400 for message in logged))
+        rows = f10.callers()
+        self.assertEqual([row['count'] for row in rows], [20, 1])
+        self.assertEqual(rows[0]['function'], 'test_where_is_it_called_sampling_and_callers')
+        self.assertEqual(rows[0]['file_name'], __file__)
+        f10.dump_callers()
+        f10.reset_callers()
+        self.assertEqual(f10.callers(), [])
+
     @unittest.skip
     def test_exception_context_manager(self):
         def f1():
@@ -0,0 +1,715 @@
+# coding=utf-8
+"""
+函数结果缓存的引擎，带命名空间、条目数和内存上限、LRU淘汰、过期清理和命中统计。
+"""
+import abc
+import heapq
+import itertools
+import os
+import pickle
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from collections import OrderedDict
+
+MISSING = object()  # 缓存未命中的哨兵，因为None也可能是函数的正常返回值
+
+_ATOMIC_TYPES = (int, float, complex, bool, str, bytes, bytearray, type(None))
+
+
+def estimate_size(obj, _max_depth=3, _sample=100):
+    """估算对象占用的内存字节数，会递归计算容器里面的元素，而不是像sys.getsizeof那样只算容器外壳。
+    超大的容器只抽样前_sample个元素再按比例推算，避免缓存一个百万元素的列表时每次写入都要遍历。
+    :param obj: 要估算的对象
+    :param _max_depth: 递归深度
+    :param _sample: 容器抽样的元素个数
+    """
+    size = sys.getsizeof(obj, 64)
+    if _max_depth <= 0 or isinstance(obj, _ATOMIC_TYPES):
+        return size
+    if isinstance(obj, dict):
+        items = obj.items()
+        length = len(obj)
+        sub = 0
+        for i, (k, v) in enumerate(items):
+            if i >= _sample:
+                break
+            sub += estimate_size(k, _max_depth - 1, _sample) + estimate_size(v, _max_depth - 1, _sample)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        length = len(obj)
+        sub = 0
+        for i, v in enumerate(obj):
+            if i >= _sample:
+                break
+            sub += estimate_size(v, _max_depth - 1, _sample)
+    elif hasattr(obj, '__dict__'):
+        return size + estimate_size(obj.__dict__, _max_depth - 1, _sample)
+    else:
+        return size
+    if length > _sample:
+        sub = sub * length // _sample
+    return size + sub
+
+
+class _CacheEntry:
+    __slots__ = ('value', 'fresh_until', 'expire_at', 'size', 'hits')
+
+    def __init__(self, value, fresh_until, expire_at, size):
+        self.value = value
+        self.fresh_until = fresh_until  # 超过这个时间点结果就不新鲜了，但是在expire_at之前还可以作为旧值返回
+        self.expire_at = expire_at
+        self.size = size
+        self.hits = 0
+
+    def is_fresh(self, now):
+        return now < self.fresh_until
+
+
+class _NamespaceStats:
+    __slots__ = ('hits', 'stale_hits', 'misses', 'evictions', 'expirations', 'entries', 'bytes')
+
+    def __init__(self):
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.entries = 0
+        self.bytes = 0
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class CacheBackend(metaclass=abc.ABCMeta):
+    """
+    缓存后端的接口，FunctionResultCacher 只通过下面这几个方法读写缓存，实现了这些方法就可以作为缓存后端。
+    get_entry 返回的条目要有 value fresh_until expire_at hits 属性和 is_fresh(now) 方法。
+    """
+
+    @abc.abstractmethod
+    def get(self, namespace, key, default=MISSING):
+        """获取新鲜的缓存，没有返回default"""
+
+    @abc.abstractmethod
+    def get_entry(self, namespace, key):
+        """获取还没彻底过期的缓存条目，没有返回None"""
+
+    @abc.abstractmethod
+    def set(self, namespace, key, value, ttl, stale_ttl=0):
+        """写入缓存"""
+
+    def peek(self, namespace, key, default=MISSING):
+        """获取新鲜的缓存，不计入命中统计，没有返回default。默认实现就是get，子类可以覆盖成不记统计的版本"""
+        return self.get(namespace, key, default)
+
+    @abc.abstractmethod
+    def delete(self, namespace, key):
+        """删除一个缓存"""
+
+    @abc.abstractmethod
+    def clear(self, namespace=None):
+        """清除一个命名空间或者全部的缓存"""
+
+    @abc.abstractmethod
+    def stats(self, namespace=None):
+        """命中统计"""
+
+
+class LruTtlCache(CacheBackend):
+    """
+    有界的 LRU + TTL 缓存引擎。
+
+    所有命名空间共用一个LRU链表和条目数、字节数上限，超出上限时淘汰最久没被访问的条目，而不是一次性清空全部缓存。
+    每个条目有自己的过期时间，所有命名空间的条目另外放在一个按过期时间排序的最小堆里面，
+    每次读写时从堆顶弹出已过期的条目，同一个命名空间混用不同的ttl、或者某个命名空间一直没人访问，过期条目也能及时清理。
+    """
+
+    def __init__(self, max_entries=100000, max_bytes=100 * 1000 * 1000, sizeof=estimate_size):
+        """
+        :param max_entries: 最多缓存多少个条目，为None则不限制
+        :param max_bytes: 缓存的值估算出来最多占用多少字节，为None则不限制
+        :param sizeof: 估算值大小的函数
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._sizeof = sizeof
+        self._lock = threading.RLock()
+        self._lru = OrderedDict()  # (namespace, key) -> _CacheEntry ，队尾是最近访问的
+        self._keys = {}  # namespace -> {key: None}
+        self._expire_heap = []  # (过期时间, 序号, namespace, key, 条目)，条目被删除或覆盖后留在堆里，弹出时再跳过
+        self._heap_seq = itertools.count()
+        self._stats = {}  # namespace -> _NamespaceStats
+        self._total_bytes = 0
+
+    def _get_stats(self, namespace):
+        stats = self._stats.get(namespace)
+        if stats is None:
+            stats = self._stats[namespace] = _NamespaceStats()
+        return stats
+
+    def _remove(self, namespace, key, entry):
+        del self._lru[(namespace, key)]
+        self._keys[namespace].pop(key, None)
+        self._total_bytes -= entry.size
+        stats = self._stats[namespace]
+        stats.entries -= 1
+        stats.bytes -= entry.size
+
+    def _purge_expired(self, now):
+        heap = self._expire_heap
+        while heap and heap[0][0] <= now:
+            _, _, namespace, key, entry = heapq.heappop(heap)
+            if self._lru.get((namespace, key)) is entry:
+                self._remove(namespace, key, entry)
+                self._stats[namespace].expirations += 1
+
+    def _compact_expire_heap(self):
+        """被删除、覆盖、淘汰的条目在堆里面积累太多时重建一次堆，堆的大小保持在条目数的两倍以内"""
+        if len(self._expire_heap) > 2 * len(self._lru) + 64:
+            self._expire_heap = [item for item in self._expire_heap if self._lru.get((item[2], item[3])) is item[4]]
+            heapq.heapify(self._expire_heap)
+
+    def _evict_if_needed(self):
+        while self._lru and ((self.max_entries is not None and len(self._lru) > self.max_entries) or
+                             (self.max_bytes is not None and self._total_bytes > self.max_bytes)):
+            (namespace, key), entry = next(iter(self._lru.items()))
+            self._remove(namespace, key, entry)
+            self._stats[namespace].evictions += 1
+
+    def get(self, namespace, key, default=MISSING):
+        """获取缓存，没有或者已过期返回default"""
+        now = time.time()
+        with self._lock:
+            self._purge_expired(now)
+            stats = self._get_stats(namespace)
+            entry = self._lru.get((namespace, key))
+            if entry is None or not entry.is_fresh(now):
+                stats.misses += 1
+                return default
+            self._lru.move_to_end((namespace, key))
+            stats.hits += 1
+            entry.hits += 1
+            return entry.value
+
+    def peek(self, namespace, key, default=MISSING):
+        """获取新鲜的缓存，不计入命中统计，也不改变LRU顺序，没有或者已过期返回default"""
+        with self._lock:
+            entry = self._lru.get((namespace, key))
+            if entry is None or not entry.is_fresh(time.time()):
+                return default
+            return entry.value
+
+    def get_entry(self, namespace, key):
+        """
+        获取缓存条目，和get不同的是已经不新鲜但还没超过旧值窗口的条目也会返回，由调用方根据entry.is_fresh决定是否后台刷新。
+        没有或者已彻底过期返回None
+        """
+        now = time.time()
+        with self._lock:
+            self._purge_expired(now)
+            stats = self._get_stats(namespace)
+            entry = self._lru.get((namespace, key))
+            if entry is None or entry.expire_at <= now:
+                stats.misses += 1
+                return None
+            self._lru.move_to_end((namespace, key))
+            if entry.is_fresh(now):
+                stats.hits += 1
+            else:
+                stats.stale_hits += 1
+            entry.hits += 1
+            return entry
+
+    def set(self, namespace, key, value, ttl, stale_ttl=0):
+        """
+        写入缓存
+        :param ttl: 缓存的秒数
+        :param stale_ttl: 新鲜期过了之后，还可以作为旧值返回的秒数
+        """
+        size = self._sizeof(value)
+        now = time.time()
+        with self._lock:
+            self._purge_expired(now)
+            stats = self._get_stats(namespace)
+            old = self._lru.get((namespace, key))
+            if old is not None:
+                self._remove(namespace, key, old)
+            if self.max_bytes is not None and size > self.max_bytes:
+                return  # 单个值就超过了上限，不缓存，免得把其他缓存全部挤掉
+            entry = self._lru[(namespace, key)] = _CacheEntry(value, now + ttl, now + ttl + stale_ttl, size)
+            self._keys.setdefault(namespace, {})[key] = None
+            heapq.heappush(self._expire_heap, (entry.expire_at, next(self._heap_seq), namespace, key, entry))
+            self._total_bytes += size
+            stats.entries += 1
+            stats.bytes += size
+            self._evict_if_needed()
+            self._compact_expire_heap()
+
+    def delete(self, namespace, key):
+        with self._lock:
+            entry = self._lru.get((namespace, key))
+            if entry is not None:
+                self._remove(namespace, key, entry)
+
+    def clear(self, namespace=None):
+        """清除缓存，namespace为None时清除所有命名空间"""
+        with self._lock:
+            if namespace is None:
+                self._lru.clear()
+                self._keys.clear()
+                self._expire_heap = []
+                self._total_bytes = 0
+                for stats in self._stats.values():
+                    stats.entries = stats.bytes = 0
+                return
+            for key in list(self._keys.get(namespace, ())):
+                self._remove(namespace, key, self._lru[(namespace, key)])
+            self._compact_expire_heap()
+
+    def purge_expired(self):
+        """主动清理所有命名空间里面已过期的条目"""
+        now = time.time()
+        with self._lock:
+            self._purge_expired(now)
+
+    def stats(self, namespace=None):
+        """
+        返回命中统计，namespace为None时返回所有命名空间汇总的统计。
+        {'hits': 10, 'stale_hits': 0, 'misses': 2, 'evictions': 0, 'expirations': 1, 'entries': 1, 'bytes': 28}
+        """
+        with self._lock:
+            if namespace is not None:
+                return self._get_stats(namespace).to_dict()
+            total = _NamespaceStats().to_dict()
+            for stats in self._stats.values():
+                for name, value in stats.to_dict().items():
+                    total[name] += value
+            return total
+
+    def __len__(self):
+        return len(self._lru)
+
+
+class SqliteCacheBackend(CacheBackend):
+    """
+    用WAL模式的sqlite文件做缓存后端，同一台机器上的多个进程(例如gunicorn的多个worker)共享同一份缓存，进程重启后缓存还在。
+    值用pickle序列化，每个条目有自己的过期时间，超过条目数或字节数上限时按最近访问时间淘汰。
+    每个线程各用一个sqlite连接，fork出来的子进程会自动重新连接。不再使用时调用 close ，或者用 with 语句。
+    hits misses 这些计数只统计当前进程，entries bytes 是整个文件里面的。
+    """
+
+    _PICKLE_PROTOCOL = 4  # 固定协议版本，保证不同python版本的进程对同样的参数生成同样的key
+
+    def __init__(self, path=None, max_entries=100000, max_bytes=1000 * 1000 * 1000, timeout=30,
+                 check_limit_every=100, touch_interval=10):
+        """
+        :param path: sqlite文件路径，默认是临时目录下的 decorator_libs_function_cache.db
+        :param max_entries: 最多缓存多少个条目，为None则不限制
+        :param max_bytes: 序列化之后的值最多占用多少字节，为None则不限制
+        :param timeout: 等待其他进程写锁的秒数
+        :param check_limit_every: 每写入多少次检查一次上限，并清理过期的条目
+        :param touch_interval: 命中时最近访问时间距离现在超过这么多秒才写回文件，期间的命中次数先在内存里面累计，
+                               读缓存大部分时候只是一次查询，不用拿sqlite的写锁，多个进程的读不会互相排队
+        """
+        self.path = path or os.path.join(tempfile.gettempdir(), 'decorator_libs_function_cache.db')
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._timeout = timeout
+        self._check_limit_every = check_limit_every
+        self._touch_interval = touch_interval
+        self._pending_hits = {}  # (namespace, key) -> 还没有写回文件的命中次数
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._sets_count = 0
+        self._stats = {}
+        self._conns = {}  # 线程 -> 连接，close 时统一关闭
+        self._conns_pid = os.getpid()
+        self._closed = False
+        self._get_conn()
+
+    def _get_conn(self):
+        if self._closed:
+            raise RuntimeError(f'缓存后端 {self.path} 已经关闭')
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        # close 可能在别的线程里面调用，所以不检查连接是不是在创建它的线程里面使用
+        conn = sqlite3.connect(self.path, timeout=self._timeout, isolation_level=None, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS function_cache ('
+                     'namespace TEXT NOT NULL, key BLOB NOT NULL, value BLOB NOT NULL, size INTEGER NOT NULL, '
+                     'fresh_until REAL NOT NULL, expire_at REAL NOT NULL, last_access REAL NOT NULL, '
+                     'hits INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (namespace, key)) WITHOUT ROWID')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_function_cache_expire_at ON function_cache (expire_at)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_function_cache_last_access ON function_cache (last_access)')
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        with self._lock:
+            if self._conns_pid != os.getpid():  # fork之前的连接属于父进程，子进程里面不能关闭
+                self._conns = {}
+                self._conns_pid = os.getpid()
+            for thread in [t for t in self._conns if not t.is_alive()]:  # 已经结束的线程的连接顺便关闭
+                self._conns.pop(thread).close()
+            self._conns[threading.current_thread()] = conn
+        return conn
+
+    def close(self):
+        """关闭当前进程里面所有线程的连接，关闭之后不能再使用"""
+        with self._lock:
+            self._closed = True
+            conns = list(self._conns.values()) if self._conns_pid == os.getpid() else []
+            self._conns = {}
+        for conn in conns:
+            conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _get_stats(self, namespace):
+        stats = self._stats.get(namespace)
+        if stats is None:
+            stats = self._stats[namespace] = _NamespaceStats()
+        return stats
+
+    def _dumps_key(self, key):
+        return pickle.dumps(key, self._PICKLE_PROTOCOL)
+
+    def get_entry(self, namespace, key):
+        now = time.time()
+        key_bytes = self._dumps_key(key)
+        conn = self._get_conn()
+        row = conn.execute('SELECT value, size, fresh_until, expire_at, hits, last_access FROM function_cache '
+                           'WHERE namespace = ? AND key = ? AND expire_at > ?', (namespace, key_bytes, now)).fetchone()
+        if row is None:
+            with self._lock:
+                self._get_stats(namespace).misses += 1
+            return None
+        with self._lock:
+            pending = self._pending_hits.get((namespace, key_bytes), 0) + 1
+            flush = now - row[5] >= self._touch_interval
+            if flush:
+                self._pending_hits.pop((namespace, key_bytes), None)
+            else:
+                self._pending_hits[(namespace, key_bytes)] = pending
+        if flush:
+            conn.execute('UPDATE function_cache SET last_access = ?, hits = hits + ? WHERE namespace = ? AND key = ?',
+                         (now, pending, namespace, key_bytes))
+        entry = _CacheEntry(pickle.loads(row[0]), row[2], row[3], row[1])
+        entry.hits = row[4] + pending
+        with self._lock:
+            stats = self._get_stats(namespace)
+            if entry.is_fresh(now):
+                stats.hits += 1
+            else:
+                stats.stale_hits += 1
+        return entry
+
+    def get(self, namespace, key, default=MISSING):
+        entry = self.get_entry(namespace, key)
+        if entry is None or not entry.is_fresh(time.time()):
+            return default
+        return entry.value
+
+    def peek(self, namespace, key, default=MISSING):
+        row = self._get_conn().execute(
+            'SELECT value FROM function_cache WHERE namespace = ? AND key = ? AND fresh_until > ?',
+            (namespace, self._dumps_key(key), time.time())).fetchone()
+        return default if row is None else pickle.loads(row[0])
+
+    def set(self, namespace, key, value, ttl, stale_ttl=0):
+        value_bytes = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if self.max_bytes is not None and len(value_bytes) > self.max_bytes:
+            return
+        now = time.time()
+        key_bytes = self._dumps_key(key)
+        with self._lock:
+            self._pending_hits.pop((namespace, key_bytes), None)
+        self._get_conn().execute(
+            'INSERT OR REPLACE INTO function_cache (namespace, key, value, size, fresh_until, expire_at, last_access) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (namespace, key_bytes, value_bytes, len(value_bytes), now + ttl, now + ttl + stale_ttl, now))
+        with self._lock:
+            self._sets_count += 1
+            need_check = self._sets_count % self._check_limit_every == 0
+        if need_check:
+            self.purge_expired()
+            self._evict_if_needed()
+
+    def purge_expired(self):
+        self._get_conn().execute('DELETE FROM function_cache WHERE expire_at <= ?', (time.time(),))
+
+    def _evict_if_needed(self):
+        conn = self._get_conn()
+        entries, total_bytes = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM function_cache').fetchone()
+        over_entries = entries - self.max_entries if self.max_entries is not None else 0
+        over_bytes = total_bytes - self.max_bytes if self.max_bytes is not None else 0
+        if over_entries <= 0 and over_bytes <= 0:
+            return
+        # 按最近访问时间从旧到新，删掉超出条目数的部分，以及累计字节数超出的部分
+        conn.execute('DELETE FROM function_cache WHERE (namespace, key) IN ('
+                     'SELECT namespace, key FROM (SELECT namespace, key, size, '
+                     'ROW_NUMBER() OVER w AS n, SUM(size) OVER w AS acc FROM function_cache '
+                     'WINDOW w AS (ORDER BY last_access)) WHERE n <= ? OR acc - size < ?)',
+                     (over_entries, over_bytes))
+
+    def delete(self, namespace, key):
+        key_bytes = self._dumps_key(key)
+        with self._lock:
+            self._pending_hits.pop((namespace, key_bytes), None)
+        self._get_conn().execute('DELETE FROM function_cache WHERE namespace = ? AND key = ?', (namespace, key_bytes))
+
+    def clear(self, namespace=None):
+        with self._lock:
+            for pending_key in [k for k in self._pending_hits if namespace is None or k[0] == namespace]:
+                del self._pending_hits[pending_key]
+        if namespace is None:
+            self._get_conn().execute('DELETE FROM function_cache')
+        else:
+            self._get_conn().execute('DELETE FROM function_cache WHERE namespace = ?', (namespace,))
+
+    def stats(self, namespace=None):
+        with self._lock:
+            if namespace is not None:
+                result = self._get_stats(namespace).to_dict()
+                where, params = 'WHERE namespace = ?', (namespace,)
+            else:
+                result = _NamespaceStats().to_dict()
+                for stats in self._stats.values():
+                    for name, value in stats.to_dict().items():
+                        result[name] += value
+                where, params = '', ()
+        result['entries'], result['bytes'] = self._get_conn().execute(
+            f'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM function_cache {where}', params).fetchone()
+        return result
+
+    def __len__(self):
+        return self._get_conn().execute('SELECT COUNT(*) FROM function_cache').fetchone()[0]
+
+
+class _Call:
+    __slots__ = ('event', 'result', 'exception')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.exception = None
+
+
+class SingleFlight:
+    """
+    同一个key同一时刻只允许一个线程执行计算，其他并发请求同一个key的线程阻塞等待这个计算的结果或者异常。
+    用来防止缓存过期瞬间的缓存击穿，N个并发请求只会调用1次后端。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn, wait_timeout=None):
+        """
+        :param key: 合并请求的key
+        :param fn: 无参数的计算函数
+        :param wait_timeout: 跟随者最多等待多少秒，超时抛出TimeoutError，None为一直等待
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self._calls[key] = _Call()
+        if is_leader:
+            try:
+                call.result = fn()
+            except BaseException as e:
+                call.exception = e
+                raise
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.event.set()
+            return call.result
+        if not call.event.wait(wait_timeout):
+            raise TimeoutError(f'等待 {key} 的计算结果超过了 {wait_timeout} 秒')
+        if call.exception is not None:
+            raise call.exception
+        return call.result
+
+
+class _Test(unittest.TestCase):
+    def test_lru_evict_by_entries(self):
+        cache = LruTtlCache(max_entries=2, max_bytes=None)
+        cache.set('f', 1, 'a', 10)
+        cache.set('f', 2, 'b', 10)
+        self.assertEqual(cache.get('f', 1), 'a')  # 访问1之后，2变成最久没被访问的
+        cache.set('g', 3, 'c', 10)
+        self.assertIs(cache.get('f', 2), MISSING)
+        self.assertEqual(cache.get('f', 1), 'a')
+        self.assertEqual(cache.stats('f')['evictions'], 1)
+        self.assertEqual(len(cache), 2)
+
+    def test_evict_by_bytes(self):
+        cache = LruTtlCache(max_entries=None, max_bytes=estimate_size(b'x' * 1000) * 2)
+        cache.set('f', 1, b'x' * 1000, 10)
+        cache.set('f', 2, b'x' * 1000, 10)
+        cache.set('f', 3, b'x' * 1000, 10)
+        self.assertEqual(len(cache), 2)
+        self.assertIs(cache.get('f', 1), MISSING)
+        cache.set('f', 4, b'x' * 10 ** 7, 10)  # 单个超过上限的值不缓存
+        self.assertEqual(len(cache), 2)
+
+    def test_expire(self):
+        cache = LruTtlCache()
+        cache.set('f', 1, None, 0.05)
+        self.assertIsNone(cache.get('f', 1))
+        time.sleep(0.06)
+        cache.set('f', 2, 'b', 10)  # 写入时顺便清理队头已过期的条目
+        self.assertEqual(len(cache), 1)
+        stats = cache.stats('f')
+        self.assertEqual((stats['hits'], stats['expirations'], stats['entries']), (1, 1, 1))
+
+    def test_expire_mixed_ttl(self):
+        """同一个命名空间混用不同的ttl，以及没人访问的命名空间，过期条目都能清理掉"""
+        cache = LruTtlCache()
+        cache.set('f', 1, 'long', 10)
+        cache.set('f', 2, 'short', 0.05)
+        cache.set('idle', 1, 'short', 0.05)
+        time.sleep(0.06)
+        cache.set('g', 1, 'c', 10)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get('f', 1), 'long')
+        self.assertEqual((cache.stats('f')['expirations'], cache.stats('idle')['expirations']), (1, 1))
+        for i in range(1000):
+            cache.set('f', 1, i, 10)  # 反复覆盖同一个key，堆里面的旧记录不会无限增长
+        self.assertLess(len(cache._expire_heap), 100)
+
+    def test_stale_entry(self):
+        cache = LruTtlCache()
+        cache.set('f', 1, 'a', 0.05, stale_ttl=10)
+        time.sleep(0.06)
+        self.assertIs(cache.get('f', 1), MISSING)  # get只返回新鲜的结果
+        entry = cache.get_entry('f', 1)
+        self.assertEqual(entry.value, 'a')
+        self.assertFalse(entry.is_fresh(time.time()))
+        self.assertEqual(cache.stats('f')['stale_hits'], 1)
+
+    def test_estimate_size(self):
+        big_list = ['x' * 1000] * 1000
+        self.assertGreater(estimate_size(big_list), 1000 * 1000)
+        self.assertGreater(estimate_size({'a': b'x' * 5000}), 5000)
+
+    def test_sqlite_backend(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'cache.db')
+            cache = SqliteCacheBackend(path, max_entries=3, check_limit_every=1)
+            cache.set('f', (1, 2), {'a': [1, 2]}, 10)
+            cache.set('f', ('x',), None, 0.05, stale_ttl=10)
+            self.assertEqual(SqliteCacheBackend(path).get('f', (1, 2)), {'a': [1, 2]})  # 另一个连接也能读到
+            time.sleep(0.06)
+            self.assertIs(cache.get('f', ('x',)), MISSING)
+            self.assertIsNone(cache.get_entry('f', ('x',)).value)
+            for i in range(5):
+                cache.set('g', i, i, 10)
+            self.assertEqual(len(cache), 3)
+            self.assertIs(cache.get('g', 0), MISSING)
+            self.assertEqual(cache.get('g', 4), 4)
+            cache.clear('g')
+            self.assertEqual(cache.stats('g')['entries'], 0)
+            cache.close()
+
+    def test_sqlite_backend_close(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'cache.db')
+            with SqliteCacheBackend(path) as cache:
+                cache.set('f', 1, 'a', 10)
+                thread = threading.Thread(target=lambda: cache.get('f', 1))
+                thread.start()
+                thread.join()
+                self.assertEqual(len(cache._conns), 2)
+            self.assertEqual(cache._conns, {})
+            with self.assertRaises(RuntimeError):
+                cache.get('f', 1)
+            with SqliteCacheBackend(path) as cache:
+                self.assertEqual(cache.get('f', 1), 'a')
+
+    def test_sqlite_backend_touch_interval(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'cache.db')
+            with SqliteCacheBackend(path, touch_interval=0.2) as cache:
+                cache.set('f', 1, 'a', 10)
+                conn = cache._get_conn()
+
+                def stored():
+                    return conn.execute('SELECT last_access, hits FROM function_cache').fetchone()
+
+                last_access, _ = stored()
+                for i in range(5):
+                    self.assertEqual(cache.get_entry('f', 1).hits, i + 1)
+                self.assertEqual(stored(), (last_access, 0))  # 间隔之内的命中只记在内存，不写文件
+                time.sleep(0.21)
+                self.assertEqual(cache.get_entry('f', 1).hits, 6)
+                self.assertGreater(stored()[0], last_access)
+                self.assertEqual(stored()[1], 6)
+                cache.get('f', 1)
+                cache.set('f', 1, 'b', 10)
+                self.assertEqual(cache.get_entry('f', 1).hits, 1)  # 重新写入后，旧条目攒下的命中次数不再带过来
+
+    def test_peek_not_counted(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for cache in [LruTtlCache(), SqliteCacheBackend(os.path.join(tmp_dir, 'cache.db'))]:
+                cache.set('f', 1, 'a', 10)
+                cache.set('f', 2, 'b', 0.05, stale_ttl=10)
+                time.sleep(0.06)
+                self.assertEqual(cache.peek('f', 1), 'a')
+                self.assertIs(cache.peek('f', 2), MISSING)  # 不新鲜的旧值不算
+                self.assertIs(cache.peek('f', 3), MISSING)
+                stats = cache.stats('f')
+                self.assertEqual((stats['hits'], stats['stale_hits'], stats['misses']), (0, 0, 0))
+
+    def test_single_flight(self):
+        single_flight = SingleFlight()
+        call_list = []
+        results = []
+
+        def slow():
+            call_list.append(1)
+            time.sleep(0.2)
+            return 'ok'
+
+        threads = [threading.Thread(target=lambda: results.append(single_flight.do('k', slow))) for _ in range(10)]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+        self.assertEqual(len(call_list), 1)
+        self.assertEqual(results, ['ok'] * 10)
+
+    def test_single_flight_exception_and_timeout(self):
+        single_flight = SingleFlight()
+        errors = []
+
+        def fail():
+            time.sleep(0.2)
+            raise ValueError('backend down')
+
+        def run(wait_timeout):
+            try:
+                single_flight.do('k', fail, wait_timeout)
+            except Exception as e:
+                errors.append(type(e))
+
+        threads = [threading.Thread(target=run, args=(None,))]
+        threads[0].start()
+        time.sleep(0.05)
+        threads += [threading.Thread(target=run, args=(None,)), threading.Thread(target=run, args=(0.01,))]
+        [t.start() for t in threads[1:]]
+        [t.join() for t in threads]
+        self.assertEqual(sorted(errors, key=str), sorted([ValueError, ValueError, TimeoutError], key=str))
+
+
+if __name__ == '__main__':
+    unittest.main()
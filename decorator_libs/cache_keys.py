@@ -0,0 +1,162 @@
+# coding=utf-8
+"""
+缓存类装饰器共用的参数key生成器。
+按函数签名绑定参数并补上默认值，所以 f(1, 2, 3, 4) 和 f(1, 2, c=3, d=4) 以及 f(1, 2) 生成的key一样。
+dict list set bytearray numpy数组 这些不可哈希的参数会转换成稳定的可哈希结构，跨进程也一样，可以给sqlite缓存后端用。
+"""
+import hashlib
+import inspect
+import pickle
+import unittest
+
+_IDENTITY_TYPES = frozenset([int, float, bool, str, type(None), complex])
+_EMPTY = inspect.Parameter.empty
+_BIG_BYTES = 256  # 超过这个长度的bytes用摘要代替，免得缓存的key持有大对象
+
+
+def _digest(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def _sorted_stably(items):
+    try:
+        return tuple(sorted(items))
+    except TypeError:  # 混合类型不能直接比较大小
+        return tuple(sorted(items, key=repr))
+
+
+def freeze(obj):
+    """把参数转换成稳定的可哈希结构"""
+    tp = type(obj)
+    if tp in _IDENTITY_TYPES:
+        return obj
+    if tp is tuple:
+        return tuple(freeze(v) for v in obj)
+    if tp is list:
+        return ('__list__', tuple(freeze(v) for v in obj))
+    if tp is dict:
+        return ('__dict__', _sorted_stably((freeze(k), freeze(v)) for k, v in obj.items()))
+    if tp is set or tp is frozenset:
+        return ('__set__', _sorted_stably(freeze(v) for v in obj))
+    if tp is bytes or tp is bytearray or tp is memoryview:
+        if tp is not bytes:
+            obj = bytes(obj)
+        return obj if len(obj) <= _BIG_BYTES else ('__bytes__', len(obj), _digest(obj))
+    if tp.__module__ == 'numpy' and hasattr(obj, 'tobytes') and hasattr(obj, 'dtype'):
+        return ('__ndarray__', obj.dtype.str, getattr(obj, 'shape', ()), _digest(obj.tobytes()))
+    try:
+        hash(obj)
+        return obj
+    except TypeError:
+        pass
+    try:
+        return ('__pickle__', tp.__qualname__, _digest(pickle.dumps(obj, 4)))
+    except Exception:
+        raise TypeError(f'参数 {obj!r} 的类型 {tp} 不可哈希也不能pickle，无法作为缓存的key')
+
+
+class ArgumentsKeyMaker:
+    """
+    根据函数签名把一次调用的参数转换成缓存key。
+    签名只在创建时解析一次；只有普通位置或关键字参数的函数走快速路径，不调用 inspect.Signature.bind ，
+    有 *args **kwargs 或者仅关键字参数的函数才用 bind 。
+    """
+
+    def __init__(self, func, typed=False):
+        """
+        :param func: 被缓存的函数或者类
+        :param typed: 为True时参数的类型也作为key的一部分，f(1) 和 f(1.0) 分开缓存
+        """
+        self.typed = typed
+        try:
+            self._signature = inspect.signature(func)
+        except (TypeError, ValueError):  # 部分内置函数没有签名
+            self._signature = None
+        self._names = ()
+        self._defaults = ()
+        self._simple = False
+        if self._signature is not None:
+            params = list(self._signature.parameters.values())
+            self._simple = all(p.kind == p.POSITIONAL_OR_KEYWORD for p in params)
+            self._names = tuple(p.name for p in params)
+            self._defaults = tuple(p.default for p in params)
+        self._index = {name: i for i, name in enumerate(self._names)}
+        self._n_params = len(self._names)
+        # 没有默认值的参数都在前面，记录必须传入的参数个数
+        self._n_required = sum(1 for d in self._defaults if d is _EMPTY)
+
+    def _bind(self, args, kwargs):
+        """返回按签名顺序排列的参数值"""
+        if self._signature is None:
+            return args + tuple(sorted(kwargs.items()))
+        n_args = len(args)
+        if self._simple and n_args <= self._n_params:
+            if not kwargs:
+                if n_args == self._n_params:
+                    return args
+                if self._n_required <= n_args:
+                    return args + self._defaults[n_args:]
+            elif all(self._index.get(k, -1) >= n_args for k in kwargs):
+                values = list(args)
+                for i in range(n_args, self._n_params):
+                    value = kwargs.get(self._names[i], self._defaults[i])
+                    if value is _EMPTY:
+                        break  # 缺少参数，交给bind抛出和直接调用一样的TypeError
+                    values.append(value)
+                else:
+                    return tuple(values)
+        bound = self._signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        values = []
+        for name, param in self._signature.parameters.items():
+            value = bound.arguments[name]
+            if param.kind == param.VAR_KEYWORD:
+                values.append(tuple(sorted(value.items())))
+            else:
+                values.append(value)
+        return tuple(values)
+
+    def __call__(self, args, kwargs):
+        values = self._bind(args, kwargs)
+        if self.typed:
+            return tuple([(freeze(v), type(v).__qualname__) for v in values])
+        for v in values:
+            if type(v) not in _IDENTITY_TYPES:
+                return tuple([freeze(v) for v in values])
+        return values  # 参数全是int str这些常见类型时不用再转换
+
+
+class _Test(unittest.TestCase):
+    def test_signature_normalized(self):
+        def f10(a, b, c=3, d=4):
+            pass
+
+        make_key = ArgumentsKeyMaker(f10)
+        key = make_key((1, 2, 3, 4), {})
+        self.assertEqual(make_key((1, 2), {'c': 3, 'd': 4}), key)
+        self.assertEqual(make_key((1, 2), {}), key)
+        self.assertEqual(make_key((), {'d': 4, 'b': 2, 'a': 1}), key)
+        self.assertNotEqual(make_key((1, 2, 3, 5), {}), key)
+        with self.assertRaises(TypeError):
+            make_key((1,), {'a': 1, 'b': 2})
+
+    def test_var_args_and_unhashable(self):
+        def f(a, *args, x=None, **kwargs):
+            pass
+
+        make_key = ArgumentsKeyMaker(f)
+        key = make_key(({'k': [1, 2]}, {3, 4}), {'x': bytearray(b'ab'), 'z': b'1' * 1000})
+        self.assertEqual(key, make_key(({'k': [1, 2]}, {4, 3}), {'z': b'1' * 1000, 'x': b'ab'}))
+        hash(key)
+        self.assertNotEqual(make_key(([1, 2],), {}), make_key(((1, 2),), {}))
+
+    def test_typed(self):
+        def f(a):
+            pass
+
+        self.assertEqual(ArgumentsKeyMaker(f)((1,), {}), ArgumentsKeyMaker(f)((1.0,), {}))
+        self.assertNotEqual(ArgumentsKeyMaker(f, typed=True)((1,), {}), ArgumentsKeyMaker(f, typed=True)((1.0,), {}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,17 +3,27 @@
 这里面是常规的装饰器，实现简单
 """
 import abc
+import asyncio
+import collections
 import copy
 import warnings
-from multiprocessing import Process
 import uuid
 import functools
+import inspect
+import itertools
+import logging
 import os
+import queue
+import random
+import socket
 import sys
+import tempfile
 import threading
 import time
 import traceback
 import unittest
+import weakref
+from concurrent.futures import Future, ThreadPoolExecutor
 from functools import wraps
 from typing import TypeVar
 
@@ -21,6 +31,15 @@ from flask import request as flask_request
 
 from nb_log import LogManager, nb_print, LoggerMixin
 
+from .cache_keys import ArgumentsKeyMaker
+from .scheduler import AdaptiveInterval, Job, Scheduler, get_default_scheduler
+from .cache_engine import CacheBackend, LruTtlCache, SqliteCacheBackend, SingleFlight, MISSING
+from .thread_pool import BoundedThreadPoolExecutor, get_thread_pool
+from . import process_pool
+from .latency_histogram import LatencyHistogram
+from .tracing import span_tracer
+from .process_pool import WarmProcessPool
+
 os_name = os.name
 handle_exception_log = LogManager('function_error').get_logger_and_add_handlers()
 run_times_log = LogManager('run_many_times').get_logger_and_add_handlers(20)
@@ -50,126 +69,559 @@ def run_many_times(times=1):
     return _run_many_times
 
 
+class RetryBudget:
+    """
+    重试预算，令牌桶实现，多个被handle_exception装饰的函数可以共用一个，把整个进程的重试次数限制在总调用量的一定比例以内。
+    每次调用往桶里存 ratio 个令牌，每次重试取走1个令牌，令牌不够就不重试了。
+    另外每秒固定补充 min_per_second 个令牌，调用量很小的时候也能重试。
+    避免下游部分故障时所有实例一起成倍重试，把下游彻底打垮。
+    """
+
+    def __init__(self, ratio=0.2, min_per_second=1.0, max_tokens=100.0):
+        """
+        :param ratio: 重试次数占调用次数的最大比例
+        :param min_per_second: 每秒至少允许重试的次数
+        :param max_tokens: 令牌桶最多积累多少个令牌
+        """
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_tokens = max_tokens
+        self._tokens = max_tokens
+        self._last_time = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.max_tokens, self._tokens + (now - self._last_time) * self.min_per_second)
+        self._last_time = now
+
+    def deposit(self):
+        """每次调用(不包括重试)存入令牌"""
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    def try_withdraw(self):
+        """每次重试之前取令牌，返回是否允许重试"""
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            return False
+
+
 # noinspection PyIncorrectDocstring
-def handle_exception(retry_times=0, error_detail_level=0, is_throw_error=False, time_sleep=0):
+def handle_exception(retry_times=0, error_detail_level=0, is_throw_error=False, time_sleep=0, backoff_multiplier=1,
+                     max_sleep=None, jitter=False, retry_on=(Exception,), give_up_on=(), retry_if_result=None,
+                     retry_budget: RetryBudget = None):
     """捕获函数错误的装饰器,重试并打印日志
     :param retry_times : 重试次数
     :param error_detail_level :为0打印exception提示，为1打印3层深度的错误堆栈，为2打印所有深度层次的错误堆栈
     :param is_throw_error : 在达到最大次数时候是否重新抛出错误
+    :param time_sleep : 第一次重试之前等待的秒数
+    :param backoff_multiplier : 每次重试的等待时间是上一次的多少倍，为1则每次等待同样的时间，为2则指数退避
+    :param max_sleep : 每次等待的最大秒数
+    :param jitter : 为True时使用full jitter，在0到计算出来的等待时间之间随机等待，避免多个实例同时重试
+    :param retry_on : 只有这些类型的异常才重试，其他异常直接当作最终失败
+    :param give_up_on : 这些类型的异常不重试，直接当作最终失败
+    :param retry_if_result : 函数的返回值传给这个函数，返回True则把这个结果当作失败进行重试，重试次数用完返回最后一次的结果
+    :param retry_budget : RetryBudget实例，预算不足时不再重试
     :type error_detail_level: int
     """
 
     if error_detail_level not in [0, 1, 2]:
         raise Exception('error_detail_level参数必须设置为0 、1 、2')
 
+    def _get_sleep_seconds(i):
+        seconds = time_sleep * backoff_multiplier ** i
+        if max_sleep is not None:
+            seconds = min(seconds, max_sleep)
+        if jitter:
+            seconds = random.uniform(0, seconds)
+        return seconds
+
+    def _can_retry(i):
+        return i < retry_times and (retry_budget is None or retry_budget.try_withdraw())
+
     def _handle_exception(func):
         @wraps(func)
         def __handle_exception(*args, **keyargs):
+            if retry_budget is not None:
+                retry_budget.deposit()
             for i in range(0, retry_times + 1):
                 try:
                     result = func(*args, **keyargs)
-                    if i:
-                        handle_exception_log.debug(
-                            u'%s\n调用成功，调用方法--> [  %s  ] 第  %s  次重试成功' % ('# ' * 40, func.__name__, i))
-                    return result
-
                 except Exception as e:
-                    error_info = ''
-                    if error_detail_level == 0:
-                        error_info = '错误类型是：' + str(e.__class__) + '  ' + str(e)
-                    elif error_detail_level == 1:
-                        error_info = '错误类型是：' + str(e.__class__) + '  ' + traceback.format_exc(limit=3)
-                    elif error_detail_level == 2:
-                        error_info = '错误类型是：' + str(e.__class__) + '  ' + traceback.format_exc()
-
-                    handle_exception_log.error(
-                        u'%s\n记录错误日志，调用方法--> [  %s  ] 第  %s  次错误重试， %s\n' % ('- ' * 40, func.__name__, i, error_info))
-                    if i == retry_times and is_throw_error:  # 达到最大错误次数后，重新抛出错误
-                        raise e
-                time.sleep(time_sleep)
+                    if handle_exception_log.isEnabledFor(logging.ERROR):  # 日志级别不输出时不格式化错误堆栈
+                        error_info = ''
+                        if error_detail_level == 0:
+                            error_info = '错误类型是：' + str(e.__class__) + '  ' + str(e)
+                        elif error_detail_level == 1:
+                            error_info = '错误类型是：' + str(e.__class__) + '  ' + traceback.format_exc(limit=3)
+                        elif error_detail_level == 2:
+                            error_info = '错误类型是：' + str(e.__class__) + '  ' + traceback.format_exc()
+
+                        handle_exception_log.error(
+                            u'%s\n记录错误日志，调用方法--> [  %s  ] 第  %s  次错误重试， %s\n', '- ' * 40, func.__name__, i,
+                            error_info)
+                    if not isinstance(e, retry_on) or isinstance(e, give_up_on) or not _can_retry(i):
+                        if is_throw_error:  # 达到最大错误次数或者不可重试的错误，重新抛出错误
+                            raise e
+                        return None
+                else:
+                    if retry_if_result is None or not retry_if_result(result):
+                        if i:
+                            handle_exception_log.debug(
+                                u'%s\n调用成功，调用方法--> [  %s  ] 第  %s  次重试成功', '# ' * 40, func.__name__, i)
+                        return result
+                    handle_exception_log.warning(u'调用方法--> [  %s  ] 第  %s  次返回的结果需要重试', func.__name__, i)
+                    if not _can_retry(i):
+                        return result
+                time.sleep(_get_sleep_seconds(i))
 
         return __handle_exception
 
     return _handle_exception
 
 
+class CircuitBreakerOpenError(Exception):
+    """熔断器处于打开状态，调用被直接拒绝"""
+
+
+class _BreakerWindow:
+    """最近window_size次调用的结果，环形缓冲区，覆盖旧位置时同步增减失败数和慢调用数，记录一次结果是O(1)的。
+    只用窗口自己的小锁，不和熔断器状态切换抢锁"""
+    __slots__ = ('failed', 'slow', 'calls', 'failed_count', 'slow_count', 'lock')
+
+    def __init__(self, size):
+        self.failed = bytearray(size)
+        self.slow = bytearray(size)
+        self.calls = 0
+        self.failed_count = 0
+        self.slow_count = 0
+        self.lock = threading.Lock()
+
+
+class CircuitBreaker:
+    """
+    熔断器，有 closed open half_open 三种状态。
+    closed 状态下统计最近 window_size 次调用的失败率和慢调用率，超过阈值就打开熔断器，
+    open 状态下所有调用直接抛出 CircuitBreakerOpenError (或者调用fallback)，不再请求已经挂掉的下游，
+    过了 open_seconds 秒后进入 half_open 状态，只放 half_open_max_calls 个探测调用过去，全部成功则关闭熔断器，有一个失败则重新打开。
+    closed 状态下的调用只读一次状态属性，记录结果只用统计窗口自己的锁，只有状态切换时才加熔断器的锁。
+    每次状态切换代数加一，探测调用带着发出时的代数，状态已经变了之后才返回的过期探测结果直接忽略。
+    可以和 handle_exception 、 timeout 叠加使用，timeout 放在里层时超时也算失败，
+    handle_exception 放在外层时建议设置 give_up_on=(CircuitBreakerOpenError,) ，熔断时不再重试。
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+    logger = LogManager('circuit_breaker').get_logger_and_add_handlers()
+
+    def __init__(self, failure_rate_threshold=0.5, slow_call_rate_threshold=1.0, slow_call_seconds=None,
+                 window_size=100, min_calls=10, open_seconds=30, half_open_max_calls=3,
+                 failure_exceptions=(Exception,), fallback=None, name=''):
+        """
+        :param failure_rate_threshold: 失败率达到多少时打开熔断器
+        :param slow_call_rate_threshold: 慢调用率达到多少时打开熔断器
+        :param slow_call_seconds: 运行超过多少秒算慢调用，None为不统计慢调用
+        :param window_size: 统计最近多少次调用
+        :param min_calls: 至少调用了多少次才开始计算失败率
+        :param open_seconds: 打开之后多少秒进入半开状态
+        :param half_open_max_calls: 半开状态下放行的探测调用次数
+        :param failure_exceptions: 哪些异常算失败，其他异常照常抛出但不算失败
+        :param fallback: 熔断时调用这个函数(传入同样的参数)返回结果，None则抛出CircuitBreakerOpenError
+        :param name: 熔断器名字，用于日志，默认是被装饰函数的名字
+        """
+        self.failure_rate_threshold = failure_rate_threshold
+        self.slow_call_rate_threshold = slow_call_rate_threshold
+        self.slow_call_seconds = slow_call_seconds
+        self.window_size = window_size
+        self.min_calls = min_calls
+        self.open_seconds = open_seconds
+        self.half_open_max_calls = half_open_max_calls
+        self.failure_exceptions = failure_exceptions
+        self.fallback = fallback
+        self.name = name
+        self.state = self.CLOSED
+        self._window = _BreakerWindow(window_size)
+        self._lock = threading.Lock()
+        self._open_until = 0
+        self._generation = 0
+        self._half_open_inflight = 0
+        self._half_open_successes = 0
+        self._rejected = 0
+
+    def _trip(self):
+        """需要在锁里面调用"""
+        self.state = self.OPEN
+        self._generation += 1
+        self._open_until = time.monotonic() + self.open_seconds
+        self.logger.warning(f'熔断器 [{self.name}] 打开，{self.open_seconds} 秒内的调用将被直接拒绝')
+
+    def _acquire_permission(self):
+        """非closed状态时调用，半开状态的探测调用返回当前代数，否则返回None，不允许调用时抛出CircuitBreakerOpenError"""
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.monotonic() < self._open_until:
+                    self._rejected += 1
+                    raise CircuitBreakerOpenError(f'熔断器 [{self.name}] 处于打开状态')
+                self.state = self.HALF_OPEN
+                self._generation += 1
+                self._half_open_inflight = 0
+                self._half_open_successes = 0
+                self.logger.info(f'熔断器 [{self.name}] 进入半开状态')
+            if self.state == self.HALF_OPEN:
+                if self._half_open_inflight + self._half_open_successes >= self.half_open_max_calls:
+                    self._rejected += 1
+                    raise CircuitBreakerOpenError(f'熔断器 [{self.name}] 处于半开状态，探测调用名额已用完')
+                self._half_open_inflight += 1
+                return self._generation
+            return None
+
+    def _on_probe_result(self, generation, failed):
+        with self._lock:
+            if generation != self._generation:  # 发出探测之后状态已经切换过，名额计数也已经重置
+                return
+            self._half_open_inflight -= 1
+            if failed:
+                self._trip()
+                return
+            self._half_open_successes += 1
+            if self._half_open_successes >= self.half_open_max_calls:
+                self._window = _BreakerWindow(self.window_size)
+                self.state = self.CLOSED
+                self._generation += 1
+                self.logger.info(f'熔断器 [{self.name}] 关闭')
+
+    def _record(self, failed, slow):
+        window = self._window
+        with window.lock:
+            position = window.calls % self.window_size
+            window.calls += 1
+            window.failed_count += failed - window.failed[position]
+            window.slow_count += slow - window.slow[position]
+            window.failed[position] = failed
+            window.slow[position] = slow
+            total_calls, failed_count, slow_count = window.calls, window.failed_count, window.slow_count
+        if (failed or slow) and total_calls >= self.min_calls:  # 成功的调用不可能让熔断器打开，不用计算
+            calls = min(total_calls, self.window_size)
+            if (failed_count / calls >= self.failure_rate_threshold or
+                    (slow and slow_count / calls >= self.slow_call_rate_threshold)):
+                with self._lock:
+                    if self.state == self.CLOSED and self._window is window:
+                        self._trip()
+
+    def stats(self):
+        window = self._window
+        return {'state': self.state, 'failed': window.failed_count, 'slow': window.slow_count,
+                'rejected': self._rejected}
+
+    def __call__(self, func):
+        if not self.name:
+            self.name = func.__name__
+
+        @wraps(func)
+        def _circuit_breaker(*args, **kwargs):
+            probe_generation = None
+            if self.state is not self.CLOSED:
+                try:
+                    probe_generation = self._acquire_permission()
+                except CircuitBreakerOpenError:
+                    if self.fallback is not None:
+                        return self.fallback(*args, **kwargs)
+                    raise
+            t0 = time.perf_counter()
+            failed = True
+            try:
+                result = func(*args, **kwargs)
+                failed = False
+                return result
+            except self.failure_exceptions:
+                raise
+            except BaseException:
+                failed = False
+                raise
+            finally:
+                slow = self.slow_call_seconds is not None and time.perf_counter() - t0 >= self.slow_call_seconds
+                if probe_generation is not None:
+                    self._on_probe_result(probe_generation, failed or slow)
+                else:
+                    self._record(failed, slow)
+
+        _circuit_breaker.breaker = self
+        return _circuit_breaker
+
+
+def circuit_breaker(failure_rate_threshold=0.5, slow_call_rate_threshold=1.0, slow_call_seconds=None,
+                    window_size=100, min_calls=10, open_seconds=30, half_open_max_calls=3,
+                    failure_exceptions=(Exception,), fallback=None, name=None):
+    """熔断器装饰器，参数见 CircuitBreaker 。被装饰的函数的 .breaker 属性可以查看状态和统计"""
+    return CircuitBreaker(failure_rate_threshold, slow_call_rate_threshold, slow_call_seconds, window_size, min_calls,
+                          open_seconds, half_open_max_calls, failure_exceptions, fallback, name or '')
+
+
 def keep_circulating(time_sleep=0.001, exit_if_function_run_sucsess=False, is_display_detail_exception=True, block=True,
-                     daemon=False):
+                     daemon=False, mode=Job.FIXED_DELAY, jitter=0, overrun_policy='skip', scheduler: Scheduler = None,
+                     adaptive=False, max_time_sleep=1.0, backoff_multiplier=2, idle_if_falsy=True):
     """间隔一段时间，一直循环运行某个方法的装饰器
     :param time_sleep :循环的间隔时间
     :param exit_if_function_run_sucsess :如果成功了就退出循环
     :param is_display_detail_exception
-    :param block :是否阻塞主主线程，False时候开启一个新的线程运行while 1。
-    :param daemon: 如果使用线程，那么是否使用守护线程，使这个while 1有机会自动结束。
+    :param block :是否阻塞主主线程，False时候注册到共享的调度器里面运行，返回可以 stop() pause() resume() stats() 的任务句柄，
+                  不再是每个循环单独开一个线程。
+    :param daemon: 不阻塞时，为False则这个循环停止之前程序不会退出，为True则程序可以自动结束。
+    :param mode: 不阻塞时的调度方式，fixed_delay 每次运行结束后间隔time_sleep秒， fixed_rate 每次运行开始间隔time_sleep秒
+    :param jitter: 不阻塞时每次运行时间加上0到jitter秒的随机偏移
+    :param overrun_policy: fixed_rate模式一次运行超过了间隔时怎么处理，见 Job
+    :param scheduler: 使用指定的调度器，默认使用全局共享的调度器
+    :param adaptive: 自适应间隔，函数返回IDLE或者假值(没有活干)时间隔逐渐乘以backoff_multiplier直到max_time_sleep，
+                     有活干时立即回到time_sleep。不阻塞时可以在任务句柄的 current_interval 和 stats() 里面查看当前间隔和利用率。
+    :param max_time_sleep: 自适应模式下间隔的上限
+    :param backoff_multiplier: 自适应模式下每次空闲间隔乘以多少
+    :param idle_if_falsy: 自适应模式下返回假值是否算空闲，为False时只有返回IDLE才算空闲
     """
     if not hasattr(keep_circulating, 'keep_circulating_log'):
         keep_circulating.log = LogManager('keep_circulating').get_logger_and_add_handlers()
 
     def _keep_circulating(func):
+        def _log_error(e):
+            msg = func.__name__ + '   运行出错\n ' + traceback.format_exc(
+                limit=10) if is_display_detail_exception else str(e)
+            keep_circulating.log.error(msg)
+
+        def _new_adaptive_interval():
+            if adaptive:
+                return AdaptiveInterval(time_sleep, max_time_sleep, backoff_multiplier, idle_if_falsy)
+            return None
+
         @wraps(func)
         def __keep_circulating(*args, **kwargs):
 
             # noinspection PyBroadException
             def ___keep_circulating():
+                adaptive_interval = _new_adaptive_interval()
                 while 1:
+                    result = None
+                    succeeded = False
                     try:
                         result = func(*args, **kwargs)
+                        succeeded = True
                         if exit_if_function_run_sucsess:
                             return result
                     except Exception as e:
-                        msg = func.__name__ + '   运行出错\n ' + traceback.format_exc(
-                            limit=10) if is_display_detail_exception else str(e)
-                        keep_circulating.log.error(msg)
+                        _log_error(e)
                     finally:
-                        time.sleep(time_sleep)
+                        if adaptive_interval is None:
+                            time.sleep(time_sleep)
+                        else:
+                            time.sleep(adaptive_interval.update(result, succeeded))
 
             if block:
                 return ___keep_circulating()
             else:
-                threading.Thread(target=___keep_circulating, daemon=daemon).start()
+                return (scheduler or get_default_scheduler()).schedule(
+                    func, args, kwargs, interval=time_sleep, mode=mode, jitter=jitter, overrun_policy=overrun_policy,
+                    stop_on_success=exit_if_function_run_sucsess, error_handler=_log_error, daemon=daemon,
+                    adaptive=_new_adaptive_interval())
 
         return __keep_circulating
 
     return _keep_circulating
 
 
-def synchronized(func):
-    """线程锁装饰器，可以加在单例模式上"""
-    func.__lock__ = threading.Lock()
+class _LockStats:
+    """锁的获取次数、需要等待的次数和等待时间，record 需要由调用方保证不会并发调用"""
+    __slots__ = ('acquisitions', 'contended', 'wait_ns_total', 'max_wait_ns')
+
+    def __init__(self):
+        self.acquisitions = 0
+        self.contended = 0
+        self.wait_ns_total = 0
+        self.max_wait_ns = 0
+
+    def record(self, wait_ns):
+        """:param wait_ns: 等待了多少纳秒，不需要等待时为None"""
+        self.acquisitions += 1
+        if wait_ns is not None:
+            self.contended += 1
+            self.wait_ns_total += wait_ns
+            self.max_wait_ns = max(self.max_wait_ns, wait_ns)
+
+    def to_dict(self):
+        return {'acquisitions': self.acquisitions, 'contended': self.contended,
+                'wait_seconds_total': self.wait_ns_total / 1e9, 'max_wait_seconds': self.max_wait_ns / 1e9}
 
-    @wraps(func)
-    def lock_func(*args, **kwargs):
-        with func.__lock__:
-            return func(*args, **kwargs)
 
-    return lock_func
+class _KeyedLocks:
+    """
+    按key分配的锁，引用计数为0时立即删除，key再多也只保存正在使用的锁。
+    同时统计获取次数、需要等待的次数和等待时间。
+    """
+
+    def __init__(self, lock_factory):
+        self._lock_factory = lock_factory
+        self._locks = {}  # key -> [锁, 引用计数]
+        self._mutex = threading.Lock()
+        self._stats = _LockStats()
+
+    def checkout(self, key):
+        with self._mutex:
+            entry = self._locks.get(key)
+            if entry is None:
+                entry = self._locks[key] = [self._lock_factory(), 0]
+            entry[1] += 1
+            return entry[0]
+
+    def checkin(self, key, wait_ns):
+        with self._mutex:
+            entry = self._locks[key]
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+            self._stats.record(wait_ns)
+
+    def stats(self):
+        with self._mutex:
+            return dict(self._stats.to_dict(), active_keys=len(self._locks))
+
+
+def synchronized(func=None, *, key=None, reentrant=False):
+    """
+    线程锁装饰器，可以加在单例模式上
+    传入key时按key加锁，只有key相同的调用才会互相等待，例如 @synchronized(key=lambda user_id, *args, **kwargs: user_id) ，
+    每个key的锁在没有调用使用时自动删除。
+    装饰后的函数的 lock_stats() 返回获取次数、等待次数和等待时间，按key加锁时还有正在使用的key的数量 active_keys 。
+    被装饰的是 async def 定义的协程函数时使用 asyncio.Lock 。
+    :param key: 根据调用参数返回锁的key的函数，参数和被装饰的函数一样，None为整个函数一把锁
+    :param reentrant: 是否使用可重入锁 threading.RLock ，同一个线程里面递归调用不会死锁，协程函数不支持
+    """
+
+    def _synchronized(fun):
+        is_coroutine = asyncio.iscoroutinefunction(fun)
+        if is_coroutine and reentrant:
+            raise ValueError('asyncio.Lock 不支持重入')
+        lock_factory = asyncio.Lock if is_coroutine else (threading.RLock if reentrant else threading.Lock)
+        perf_counter_ns = time.perf_counter_ns
+        if key is None:
+            lock = fun.__lock__ = lock_factory()
+            lock_stats = _LockStats()  # 拿到锁之后才更新统计，不用另外加锁
+            if is_coroutine:
+                @wraps(fun)
+                async def lock_func(*args, **kwargs):
+                    wait_ns = None
+                    if lock.locked():
+                        t0 = perf_counter_ns()
+                        await lock.acquire()
+                        wait_ns = perf_counter_ns() - t0
+                    else:
+                        await lock.acquire()
+                    try:
+                        lock_stats.record(wait_ns)
+                        return await fun(*args, **kwargs)
+                    finally:
+                        lock.release()
+            else:
+                @wraps(fun)
+                def lock_func(*args, **kwargs):
+                    wait_ns = None
+                    if not lock.acquire(False):
+                        t0 = perf_counter_ns()
+                        lock.acquire()
+                        wait_ns = perf_counter_ns() - t0
+                    try:
+                        lock_stats.record(wait_ns)
+                        return fun(*args, **kwargs)
+                    finally:
+                        lock.release()
+
+            lock_func.lock_stats = lock_stats.to_dict
+            return lock_func
+
+        keyed_locks = _KeyedLocks(lock_factory)
+
+        if is_coroutine:
+            @wraps(fun)
+            async def keyed_lock_func(*args, **kwargs):
+                lock_key = key(*args, **kwargs)
+                lock = keyed_locks.checkout(lock_key)
+                wait_ns = None
+                try:
+                    if lock.locked():
+                        t0 = perf_counter_ns()
+                        await lock.acquire()
+                        wait_ns = perf_counter_ns() - t0
+                    else:
+                        await lock.acquire()
+                except BaseException:  # 等待的时候被取消了
+                    keyed_locks.checkin(lock_key, wait_ns)
+                    raise
+                try:
+                    return await fun(*args, **kwargs)
+                finally:
+                    lock.release()
+                    keyed_locks.checkin(lock_key, wait_ns)
+        else:
+            @wraps(fun)
+            def keyed_lock_func(*args, **kwargs):
+                lock_key = key(*args, **kwargs)
+                lock = keyed_locks.checkout(lock_key)
+                wait_ns = None
+                if not lock.acquire(False):
+                    t0 = perf_counter_ns()
+                    lock.acquire()
+                    wait_ns = perf_counter_ns() - t0
+                try:
+                    return fun(*args, **kwargs)
+                finally:
+                    lock.release()
+                    keyed_locks.checkin(lock_key, wait_ns)
+
+        keyed_lock_func.lock_stats = keyed_locks.stats
+        return keyed_lock_func
+
+    if func is not None:
+        return _synchronized(func)
+    return _synchronized
 
 ClSX = TypeVar('CLSX')
 
 def singleton(cls:ClSX)  -> ClSX:
     """
     单例模式装饰器,新加入线程锁，更牢固的单例模式，主要解决多线程如100线程同时实例化情况下可能会出现三例四例的情况,实测。
+    每个类一把锁，双重检查，实例创建之后的调用不加锁。
     """
-    _instance = {}
-    singleton.__lock = threading.Lock()
+    lock = threading.Lock()
+    instance = MISSING
 
     @wraps(cls)
     def _singleton(*args, **kwargs):
-        with singleton.__lock:
-            if cls not in _instance:
-                _instance[cls] = cls(*args, **kwargs)
-            return _instance[cls]
+        nonlocal instance
+        if instance is MISSING:
+            with lock:
+                if instance is MISSING:
+                    instance = cls(*args, **kwargs)
+        return instance
 
     return _singleton
 
 
 class SingletonMeta(type):
+    """单例元类，每个类一把锁，双重检查，实例创建之后的调用不加锁"""
     _instances = {}
 
+    def __init__(cls, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        cls._singleton_lock = threading.Lock()
+
     def __call__(cls, *args, **kwargs):
-        if cls not in cls._instances:
-            cls._instances[cls] = super().__call__(*args, **kwargs)
-        return cls._instances[cls]
+        instance = cls._instances.get(cls)
+        if instance is None:
+            with cls._singleton_lock:
+                instance = cls._instances.get(cls)
+                if instance is None:
+                    instance = cls._instances[cls] = super().__call__(*args, **kwargs)
+        return instance
 
 class SingletonBaseCall(metaclass=SingletonMeta):
     """
@@ -191,45 +643,54 @@ class SingletonBaseCall(metaclass=SingletonMeta):
 
 
 class SingletonBaseNew:
+    """单例基类，每个子类各自一个实例和一把锁，双重检查，实例创建之后的调用不加锁"""
     _instance = None
+    _singleton_lock = threading.Lock()
 
     def __new__(cls, *args, **kwargs):
-        if not cls._instance:
-            cls._instance = super().__new__(cls)
+        if cls._instance is None:
+            with cls._singleton_lock:
+                if cls._instance is None:
+                    cls._instance = super().__new__(cls)
         return cls._instance
 
     def __init_subclass__(cls, **kwargs):
         super().__init_subclass__(**kwargs)
-        # 可以在此处添加对子类的额外处理，比如检查其是否符合单例要求等
+        # 每个子类单独保存实例和锁，子类不会拿到父类的实例
+        cls._instance = None
+        cls._singleton_lock = threading.Lock()
 
 class SingletonBaseCustomInit(metaclass=abc.ABCMeta):
+    """单例基类，实例只在第一次创建时调用 _custom_init 初始化，每个子类各自一个实例和一把锁"""
     _instance = None
+    _singleton_lock = threading.Lock()
 
     def __new__(cls, *args, **kwargs):
-        if not cls._instance:
-            cls._instance = super().__new__(cls)
-            cls._instance._custom_init(*args, **kwargs)
+        if cls._instance is None:
+            with cls._singleton_lock:
+                if cls._instance is None:
+                    instance = super().__new__(cls)
+                    instance._custom_init(*args, **kwargs)
+                    cls._instance = instance  # 初始化完成之后才发布，别的线程不会拿到没有初始化完的实例
         return cls._instance
 
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._instance = None
+        cls._singleton_lock = threading.Lock()
+
     def _custom_init(self, *args, **kwargs):
         raise NotImplemented
 
 
 def flyweight(cls):
     _instance = {}
-
-    def _make_arguments_to_key(args, kwds):
-        key = args
-        if kwds:
-            sorted_items = sorted(kwds.items())
-            for item in sorted_items:
-                key += item
-        return key
+    make_key = ArgumentsKeyMaker(cls)
 
     @synchronized
     @wraps(cls)
     def _flyweight(*args, **kwargs):
-        cache_key = f'{cls}_{_make_arguments_to_key(args, kwargs)}'
+        cache_key = make_key(args, kwargs)
         # nb_print(cache_key)
         if cache_key not in _instance:
             _instance[cache_key] = cls(*args, **kwargs)
@@ -238,22 +699,90 @@ def flyweight(cls):
     return _flyweight
 
 
-def timer(func):
-    """计时器装饰器，只能用来计算函数运行时间"""
-    if not hasattr(timer, 'log'):
-        timer.log = LogManager(f'timer_{func.__name__}').get_logger_and_add_handlers(
-            log_filename=f'timer_{func.__name__}.log')
+_timer_histograms = {}  # 函数限定名 -> 耗时直方图
+_timer_log = None
+
+
+def _timer_flush(histogram):
+    snapshot = histogram.snapshot(reset=True)
+    if snapshot['count']:
+        _timer_log.debug(f'[ {histogram.name} ] 最近{round(time.time() - snapshot["since"], 1)}秒 调用{snapshot["count"]}次 '
+                         f'p50 {snapshot["p50_ms"]:.3f}ms p90 {snapshot["p90_ms"]:.3f}ms '
+                         f'p99 {snapshot["p99_ms"]:.3f}ms max {snapshot["max_ms"]:.3f}ms')
+
+
+def timer(func=None, *, flush_interval=60):
+    """
+    计时器装饰器，计算函数运行时间。
+    每次调用只记录到这个函数自己的耗时直方图里面，不写日志，开销在1微秒左右；
+    每隔flush_interval秒把这段时间的调用次数和p50 p90 p99 max写一行日志到 timer.log 然后清零。
+    装饰后的函数有 timer_snapshot(reset=False) 和 timer_reset() 方法，也可以用 timer_snapshot_all() 获取所有函数的统计。
+    span_tracer.enable() 开启追踪后每次调用是一个span，和 TimerContextManager 的代码块按调用路径关联起来，可以导出火焰图。
+    :param flush_interval: 多少秒写一次统计日志，None为不自动写日志，只通过接口获取
+    """
+
+    def _timer_decorator(fun):
+        global _timer_log
+        if _timer_log is None:
+            _timer_log = LogManager('timer').get_logger_and_add_handlers(log_filename='timer.log')
+        name = f'{fun.__module__}.{fun.__qualname__}'
+        histogram = _timer_histograms.setdefault(name, LatencyHistogram(name))
+        record = histogram.record
+        perf_counter_ns = time.perf_counter_ns
+        flush_job = []
+        _flush_lock = threading.Lock()
+        need_flush_job = [flush_interval is not None]
+
+        def _start_flush():
+            # 第一次调用时才启动定时写日志的任务，只导入模块不会启动调度线程
+            with _flush_lock:
+                if not flush_job:
+                    flush_job.append(get_default_scheduler().schedule(
+                        _timer_flush, (histogram,), interval=flush_interval, name=f'timer_flush_{name}',
+                        run_immediately=False))
+
+        if asyncio.iscoroutinefunction(fun):
+            @wraps(fun)
+            async def _timer(*args, **kwargs):
+                if need_flush_job[0]:
+                    need_flush_job[0] = False
+                    _start_flush()
+                span = span_tracer.start_span(name) if span_tracer.enabled else None
+                t0 = perf_counter_ns()
+                try:
+                    return await fun(*args, **kwargs)
+                finally:
+                    record(perf_counter_ns() - t0)
+                    if span is not None:
+                        span_tracer.end_span(span)
+        else:
+            @wraps(fun)
+            def _timer(*args, **kwargs):
+                if need_flush_job[0]:
+                    need_flush_job[0] = False
+                    _start_flush()
+                span = span_tracer.start_span(name) if span_tracer.enabled else None
+                t0 = perf_counter_ns()
+                try:
+                    return fun(*args, **kwargs)
+                finally:
+                    record(perf_counter_ns() - t0)
+                    if span is not None:
+                        span_tracer.end_span(span)
+
+        _timer.timer_histogram = histogram
+        _timer.timer_snapshot = histogram.snapshot
+        _timer.timer_reset = histogram.reset
+        return _timer
+
+    if func is not None:
+        return _timer_decorator(func)
+    return _timer_decorator
 
-    @wraps(func)
-    def _timer(*args, **kwargs):
-        t1 = time.time()
-        result = func(*args, **kwargs)
-        t2 = time.time()
-        t_spend = round(t2 - t1, 2)
-        timer.log.debug('执行[ {} ]方法用时 {} 秒'.format(func.__name__, t_spend))
-        return result
 
-    return _timer
+def timer_snapshot_all(reset=False):
+    """所有被timer装饰的函数的耗时统计"""
+    return {name: histogram.snapshot(reset) for name, histogram in list(_timer_histograms.items())}
 
 
 # noinspection PyPep8Naming
@@ -324,57 +853,214 @@ def cached_method_result_for_instance(fun):
 
 class FunctionResultCacher:
     logger = LogManager('FunctionResultChche').get_logger_and_add_handlers()
-    func_result_dict = {}
+    cache_engine = LruTtlCache()
+    _single_flight = SingleFlight()
+    refresh_workers = 4  # 后台刷新缓存的线程数
+    _refresh_executor = None
+    _refresh_lock = threading.Lock()
+    _refreshing_keys = set()
+    _async_inflight = {}  # (事件循环, 命名空间, key) -> 正在计算的asyncio.Task
+    _async_refresh_tasks = set()
+    _namespace_seq = itertools.count()
     """
-    {
-        (f1,(1,2,3,4)):(10,1532066199.739),
-        (f2,(5,6,7,8)):(26,1532066211.645),
-    }
+    所有被装饰的函数共用一个有界缓存引擎，每个函数是一个命名空间。
+    可以用 FunctionResultCacher.configure(max_entries=..., max_bytes=...) 调整上限，
+    或者 FunctionResultCacher.configure(backend=SqliteCacheBackend('/tmp/func_cache.db')) 让多个进程共享缓存并且重启后不丢失。
     """
 
     @classmethod
-    def cached_function_result_for_a_time(cls, cache_time: float):
+    def configure(cls, max_entries=100000, max_bytes=100 * 1000 * 1000, backend: CacheBackend = None):
         """
-        函数的结果缓存一段时间装饰器,不要装饰在返回结果是超大字符串或者其他占用大内存的数据结构上的函数上面。
+        替换缓存引擎，之前的内存缓存会丢失。
+        :param max_entries: 所有函数最多缓存多少个结果
+        :param max_bytes: 所有缓存的结果估算最多占用多少字节
+        :param backend: 自定义的缓存后端，传了这个则忽略上面两个参数
+        """
+        cls.cache_engine = backend if backend is not None else LruTtlCache(max_entries=max_entries,
+                                                                            max_bytes=max_bytes)
+
+    @classmethod
+    def _get_engine(cls, backend):
+        return backend if backend is not None else cls.cache_engine
+
+    @classmethod
+    def _engine_call(cls, backend, namespace_of, method):
+        engine = cls._get_engine(backend)
+        return getattr(engine, method)(namespace_of(engine))
+
+    @classmethod
+    def _get_refresh_executor(cls):
+        if cls._refresh_executor is None:
+            with cls._refresh_lock:
+                if cls._refresh_executor is None:
+                    cls._refresh_executor = ThreadPoolExecutor(cls.refresh_workers,
+                                                               thread_name_prefix='FunctionResultCacherRefresh')
+        return cls._refresh_executor
+
+    @classmethod
+    def _schedule_refresh(cls, engine, fun, fun_namespace, key, args, kwargs, cache_time, stale_ttl):
+        """后台刷新一个key，同一个key同一时刻只会有一个刷新任务"""
+        with cls._refresh_lock:
+            if (fun_namespace, key) in cls._refreshing_keys:
+                return
+            cls._refreshing_keys.add((fun_namespace, key))
+
+        def _refresh():
+            try:
+                result = fun(*args, **kwargs)
+                engine.set(fun_namespace, key, result, cache_time, stale_ttl)
+            except Exception as e:  # 刷新失败保留旧值，等下次访问再刷新
+                cls.logger.error(f'函数 [{fun.__name__}] 后台刷新缓存出错 {type(e)} {e}')
+            finally:
+                with cls._refresh_lock:
+                    cls._refreshing_keys.discard((fun_namespace, key))
+
+        cls._get_refresh_executor().submit(_refresh)
+
+    @classmethod
+    def _schedule_async_refresh(cls, engine, fun, fun_namespace, key, args, kwargs, cache_time, stale_ttl):
+        """异步函数的后台刷新，在当前事件循环里面起一个task，同一个key同一时刻只会有一个刷新任务"""
+        with cls._refresh_lock:
+            if (fun_namespace, key) in cls._refreshing_keys:
+                return
+            cls._refreshing_keys.add((fun_namespace, key))
+
+        async def _refresh():
+            try:
+                result = await fun(*args, **kwargs)
+                engine.set(fun_namespace, key, result, cache_time, stale_ttl)
+            except Exception as e:
+                cls.logger.error(f'函数 [{fun.__name__}] 后台刷新缓存出错 {type(e)} {e}')
+            finally:
+                with cls._refresh_lock:
+                    cls._refreshing_keys.discard((fun_namespace, key))
+
+        task = asyncio.ensure_future(_refresh())
+        cls._async_refresh_tasks.add(task)  # 保持引用，防止task还没运行完就被垃圾回收
+        task.add_done_callback(cls._async_refresh_tasks.discard)
+
+    @staticmethod
+    def _need_refresh(entry, refresh_ahead, refresh_ahead_min_hits):
+        now = time.time()
+        return not entry.is_fresh(now) or (
+                refresh_ahead and entry.fresh_until - now < refresh_ahead and entry.hits >= refresh_ahead_min_hits)
+
+    @classmethod
+    def _async_compute_done(cls, inflight_key, task):
+        if cls._async_inflight.get(inflight_key) is task:
+            del cls._async_inflight[inflight_key]
+        if not task.cancelled():
+            task.exception()  # 标记异常已被取出，等待者都被取消了时不会打印 exception was never retrieved
+
+    @classmethod
+    def _cached_coroutine_function(cls, fun, namespace_of, make_key, backend, cache_time, wait_timeout, stale_ttl,
+                                   refresh_ahead, refresh_ahead_min_hits):
+        """
+        async def 函数的缓存，缓存的是await之后的结果而不是协程对象。
+        同一个事件循环里面并发await同样参数的调用，共用一个正在计算的asyncio.Task，只会真正执行一次。
+        计算在单独的task里面运行，发起计算的调用方被取消时计算继续进行，等待同一个结果的其他调用方不受影响。
+        """
+
+        @wraps(fun)
+        async def __cached_coroutine_function(*args, **kwargs):
+            engine = cls._get_engine(backend)
+            fun_namespace = namespace_of(engine)
+            key = make_key(args, kwargs)
+            entry = engine.get_entry(fun_namespace, key)
+            if entry is not None:
+                if cls._need_refresh(entry, refresh_ahead, refresh_ahead_min_hits):
+                    cls._schedule_async_refresh(engine, fun, fun_namespace, key, args, kwargs, cache_time, stale_ttl)
+                return entry.value
+
+            loop = asyncio.get_event_loop()
+            inflight_key = (loop, fun_namespace, key)
+            task = cls._async_inflight.get(inflight_key)
+            if task is not None:
+                return await asyncio.wait_for(asyncio.shield(task), wait_timeout)
+
+            async def _compute():
+                cls.logger.debug('函数 [{}] 此次不能使用缓存'.format(fun.__name__))
+                result = await fun(*args, **kwargs)
+                engine.set(fun_namespace, key, result, cache_time, stale_ttl)
+                return result
+
+            task = cls._async_inflight[inflight_key] = loop.create_task(_compute())
+            task.add_done_callback(functools.partial(cls._async_compute_done, inflight_key))
+            return await asyncio.shield(task)
+
+        __cached_coroutine_function.cache_stats = lambda: cls._engine_call(backend, namespace_of, 'stats')
+        __cached_coroutine_function.cache_clear = lambda: cls._engine_call(backend, namespace_of, 'clear')
+        return __cached_coroutine_function
+
+    @classmethod
+    def cached_function_result_for_a_time(cls, cache_time: float, namespace: str = None, single_flight=False,
+                                          wait_timeout: float = None, stale_ttl: float = 0,
+                                          refresh_ahead: float = 0, refresh_ahead_min_hits=2,
+                                          backend: CacheBackend = None, typed=False):
+        """
+        函数的结果缓存一段时间装饰器。缓存超过上限时按LRU淘汰，过期的结果会被清理掉。
         :param cache_time :缓存的时间
+        :param namespace :缓存的命名空间，默认是函数的 模块名.限定名 。
+                          内存缓存里面默认再加上每个被装饰函数自己的序号，同一个工厂函数返回的多个闭包限定名相同，不能共用结果；
+                          SqliteCacheBackend 这类跨进程的后端只用 模块名.限定名 ，各个进程才能共用缓存
+        :param single_flight :为True时同一个函数同样的参数同一时刻只有一个线程去计算，其他线程等待它的结果，防止缓存击穿。
+        :param wait_timeout :single_flight模式下等待别的线程计算结果的最长秒数，超时抛出TimeoutError，None为一直等待
+        :param stale_ttl :过了cache_time之后，再过多少秒以内仍然立即返回旧值，同时在后台线程池刷新一次缓存。
+        :param refresh_ahead :离cache_time到期还剩多少秒时，提前在后台刷新访问频繁的key
+        :param refresh_ahead_min_hits :一个缓存结果被命中多少次以上才算访问频繁，才会提前刷新
+        :param backend :这个函数单独使用的缓存后端，例如 SqliteCacheBackend，None则使用 FunctionResultCacher.cache_engine
+        :param typed :为True时参数类型不同的调用分开缓存，例如 f(1) 和 f(1.0)
         :type cache_time : float
+        也可以装饰 async def 函数，缓存await之后的结果，并发的同样参数的调用共用一次计算，wait_timeout同样有效。
         """
 
         def _cached_function_result_for_a_time(fun):
+            if namespace:
+                shared_namespace = local_namespace = namespace
+            else:
+                shared_namespace = f'{fun.__module__}.{fun.__qualname__}'
+                local_namespace = f'{shared_namespace}#{next(cls._namespace_seq)}'
+
+            def namespace_of(engine):
+                # 缓存引擎可以在装饰之后才用 configure 替换，所以每次调用时按当前的引擎决定命名空间
+                return local_namespace if isinstance(engine, LruTtlCache) else shared_namespace
+
+            make_key = ArgumentsKeyMaker(fun, typed)
+            if asyncio.iscoroutinefunction(fun):
+                return cls._cached_coroutine_function(fun, namespace_of, make_key, backend, cache_time,
+                                                      wait_timeout, stale_ttl, refresh_ahead, refresh_ahead_min_hits)
 
             @wraps(fun)
             def __cached_function_result_for_a_time(*args, **kwargs):
-                # print(cls.func_result_dict)
-                # if len(cls.func_result_dict) > 1024:
-                if sys.getsizeof(cls.func_result_dict) > 100 * 1000 * 1000:
-                    cls.func_result_dict.clear()
-
-                key = cls._make_arguments_to_key(args, kwargs)
-                if (fun, key) in cls.func_result_dict and time.time() - cls.func_result_dict[(fun, key)][1] < cache_time:
-                    return cls.func_result_dict[(fun, key)][0]
-                else:
-                    if (fun, key) in cls.func_result_dict and time.time() - cls.func_result_dict[(fun, key)][1] < cache_time:
-                        return cls.func_result_dict[(fun, key)][0]
-                    else:
-                        cls.logger.debug('函数 [{}] 此次不能使用缓存'.format(fun.__name__))
-                        result = fun(*args, **kwargs)
-                        cls.func_result_dict[(fun, key)] = (result, time.time())
-                        return result
-
+                engine = cls._get_engine(backend)
+                fun_namespace = namespace_of(engine)
+                key = make_key(args, kwargs)
+                entry = engine.get_entry(fun_namespace, key)
+                if entry is not None:
+                    if cls._need_refresh(entry, refresh_ahead, refresh_ahead_min_hits):
+                        cls._schedule_refresh(engine, fun, fun_namespace, key, args, kwargs, cache_time, stale_ttl)
+                    return entry.value
+
+                def _compute():
+                    if single_flight:  # 拿到计算权之前，上一个计算者可能刚刚写入了缓存。用peek，入口处已经记过一次未命中了
+                        result_in_cache = engine.peek(fun_namespace, key)
+                        if result_in_cache is not MISSING:
+                            return result_in_cache
+                    cls.logger.debug('函数 [{}] 此次不能使用缓存'.format(fun.__name__))
+                    result_new = fun(*args, **kwargs)
+                    engine.set(fun_namespace, key, result_new, cache_time, stale_ttl)
+                    return result_new
+
+                if single_flight:
+                    return cls._single_flight.do((fun_namespace, key), _compute, wait_timeout)
+                return _compute()
+
+            __cached_function_result_for_a_time.cache_stats = lambda: cls._engine_call(backend, namespace_of, 'stats')
+            __cached_function_result_for_a_time.cache_clear = lambda: cls._engine_call(backend, namespace_of, 'clear')
             return __cached_function_result_for_a_time
 
         return _cached_function_result_for_a_time
 
-    @staticmethod
-    def _make_arguments_to_key(args, kwds):
-        key = args
-        if kwds:
-            sorted_items = sorted(kwds.items())
-            for item in sorted_items:
-                key += item
-        return key  # 元祖可以相加。
-
-
 def deprecated(fn):
     """Mark a function as deprecated and warn the user on use."""
 
@@ -387,26 +1073,147 @@ def deprecated(fn):
     return wrapper
 
 
+_lock_renew_scheduler = None
+_lock_renew_scheduler_lock = threading.Lock()
+
+
+def _get_lock_renew_scheduler():
+    """redis锁续期专用的调度器，不和 keep_circulating 这些用户任务共用工作线程，用户任务长时间阻塞也不会耽误续期"""
+    global _lock_renew_scheduler
+    if _lock_renew_scheduler is None:
+        with _lock_renew_scheduler_lock:
+            if _lock_renew_scheduler is None:
+                _lock_renew_scheduler = Scheduler(max_workers=4, name='RedisLockRenew')
+    return _lock_renew_scheduler
+
+
 class RedisDistributedLockContextManager(LoggerMixin):
     """
     分布式redis锁上下文管理.
+    获取锁只需要一次 SET NX PX ；释放锁用Lua脚本比较锁的值是自己的才删除，不会误删锁过期之后别人获得的锁，同时发布释放通知。
+    可以阻塞等待获取锁，等待期间订阅释放通知，锁一释放立即重试，收不到通知时(例如持有者崩溃锁自然过期)按带抖动的指数退避重试。
+    获得锁之后有看门狗定时续期，代码块运行时间超过 expire_seconds 也不会丢锁；进程崩溃时锁最多 expire_seconds 后自动释放。
+
+        with RedisDistributedLockContextManager(redis_client, 'lock_key', blocking_timeout=10) as lock:
+            if lock:
+                ...
     """
 
-    def __init__(self, redis_client, redis_lock_key, expire_seconds=30):
+    _RELEASE_LUA = '''
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('DEL', KEYS[1])
+    redis.call('PUBLISH', ARGV[2], ARGV[1])
+    return 1
+end
+return 0
+'''
+    _RENEW_LUA = '''
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+'''
+
+    def __init__(self, redis_client, redis_lock_key, expire_seconds=30, blocking_timeout=0, auto_renew=True,
+                 max_retry_interval=0.5):
+        """
+        :param redis_client: redis客户端
+        :param redis_lock_key: 锁的key
+        :param expire_seconds: 锁的租期秒数，可以是小数
+        :param blocking_timeout: with语句进入时最多等待多少秒获取锁，0为不等待，None为一直等待
+        :param auto_renew: 是否启动看门狗，每隔 expire_seconds/3 秒续期一次
+        :param max_retry_interval: 阻塞等待时退避重试的最大间隔秒数
+        """
         self.redis_client = redis_client
         self.redis_lock_key = redis_lock_key
         self._expire_seconds = expire_seconds
+        self._blocking_timeout = blocking_timeout
+        self._auto_renew = auto_renew
+        self._max_retry_interval = max_retry_interval
+        self._keys = [redis_lock_key]
+        self._channels = [f'{redis_lock_key}:released']
         self.identifier = str(uuid.uuid4())
         self.has_aquire_lock = False
+        self.lost = False  # 续期时发现锁已经不是自己的了
+        self._renew_job = None
+        self._renew_lock = threading.Lock()  # release 和正在运行的续期之间互斥，区分锁是自己释放的还是真的丢了
+        self._release_script = redis_client.register_script(self._RELEASE_LUA)
+        self._renew_script = redis_client.register_script(self._RENEW_LUA)
+        self._line = None
+        self._file_name = None
+
+    def _try_acquire(self):
+        return bool(self.redis_client.set(self.redis_lock_key, self.identifier,
+                                          px=int(self._expire_seconds * 1000), nx=True))
+
+    def acquire(self, timeout=None):
+        """
+        获取锁，返回是否获得
+        :param timeout: 最多等待多少秒，0为不等待，None为一直等待
+        """
+        if self._try_acquire():
+            return self._on_acquired()
+        if timeout is not None and timeout <= 0:
+            return False
+        deadline = None if timeout is None else time.monotonic() + timeout
+        pubsub = self.redis_client.pubsub(ignore_subscribe_messages=True)
+        try:
+            pubsub.subscribe(*self._channels)
+            interval = 0.01
+            while True:
+                # 订阅之后再试一次，避免在第一次尝试和订阅之间释放的通知被错过
+                if self._try_acquire():
+                    return self._on_acquired()
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                wait = random.uniform(interval / 2, interval)
+                if remaining is not None:
+                    wait = min(wait, remaining)
+                pubsub.get_message(timeout=wait)  # 收到释放通知时提前返回
+                interval = min(interval * 2, self._max_retry_interval)
+        finally:
+            pubsub.close()
+
+    def _on_acquired(self):
+        self.has_aquire_lock = True
+        self.lost = False
+        if self._auto_renew:
+            self._renew_job = _get_lock_renew_scheduler().schedule(
+                self._renew, interval=self._expire_seconds / 3, name=f'renew_redis_lock_{self.redis_lock_key}',
+                run_immediately=False)
+        return True
+
+    def _renew(self):
+        job = self._renew_job
+        if job is None:
+            return
+        if self._renew_script(keys=self._keys, args=[self.identifier, int(self._expire_seconds * 1000)]):
+            return
+        with self._renew_lock:
+            if self._renew_job is not job:  # 续期的过程中 release 已经开始了，锁是自己释放的
+                return
+            self.lost = True
+            job.stop()
+        self.logger.warning(f'redis锁 {self.redis_lock_key} 续期失败，锁已经过期或者被别人持有了')
+
+    def release(self):
+        """释放锁，返回锁是否还是自己的"""
+        with self._renew_lock:
+            job, self._renew_job = self._renew_job, None
+        if job is not None:
+            job.stop()
+        if not self.has_aquire_lock:
+            return False
+        self.has_aquire_lock = False
+        return bool(self._release_script(keys=self._keys, args=[self.identifier, self._channels[0]]))
 
     # noinspection PyProtectedMember,PyUnresolvedReferences
     def __enter__(self):
-        self._line = sys._getframe().f_back.f_lineno  # 调用此方法的代码的函数
-        self._file_name = sys._getframe(1).f_code.co_filename  # 哪个文件调了用此方法
-        self.redis_client.set(self.redis_lock_key, value=self.identifier, ex=self._expire_seconds, nx=True)
-        identifier_in_redis = self.redis_client.get(self.redis_lock_key)
-        if identifier_in_redis and identifier_in_redis.decode() == self.identifier:
-            self.has_aquire_lock = True
+        frame = sys._getframe(1)
+        self._line = frame.f_lineno  # 调用此方法的代码的函数
+        self._file_name = frame.f_code.co_filename  # 哪个文件调了用此方法
+        self.acquire(self._blocking_timeout)
         return self
 
     def __bool__(self):
@@ -414,39 +1221,685 @@ class RedisDistributedLockContextManager(LoggerMixin):
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         if self.has_aquire_lock:
-            self.redis_client.delete(self.redis_lock_key)
-        if self.has_aquire_lock:
+            still_owned = self.release()
             log_msg = f'\n"{self._file_name}:{self._line}" 这行代码获得了redis锁 {self.redis_lock_key}'
             self.logger.info(log_msg)
+            if not still_owned:
+                self.logger.warning(f'\n"{self._file_name}:{self._line}" 释放redis锁 {self.redis_lock_key} 时锁已经不是自己的了')
         else:
             log_msg = f'\n"{self._file_name}:{self._line}" 这行代码没有获得redis锁 {self.redis_lock_key}'
             self.logger.warning(log_msg)
 
 
-def run_in_new_thread(f):
-    @functools.wraps(f)
-    def wrapper(*args, **kwargs):
-        threading.Thread(target=f, args=args, kwargs=kwargs).start()
+class RedisReentrantLock(RedisDistributedLockContextManager):
+    """
+    可重入的redis锁，锁是一个hash，字段是持有者标识，值是持有次数。同一个持有者可以重复获取，释放同样次数之后才真正释放。
+    持有者标识默认是 主机名:进程号:线程随机标识 ，所以同一个线程里面嵌套使用同一个key的锁不会死锁，和 threading.RLock 一样。
+    线程随机标识保存在threading.local里面，不用线程号，因为线程结束后线程号会被新线程复用，新线程不能重入旧线程没释放的锁。
+    """
+    _thread_token = threading.local()
+
+    _ACQUIRE_LUA = '''
+if redis.call('EXISTS', KEYS[1]) == 0 or redis.call('HEXISTS', KEYS[1], ARGV[1]) == 1 then
+    redis.call('HINCRBY', KEYS[1], ARGV[1], 1)
+    redis.call('PEXPIRE', KEYS[1], ARGV[2])
+    return 1
+end
+return 0
+'''
+    _RELEASE_LUA = '''
+if redis.call('HEXISTS', KEYS[1], ARGV[1]) == 0 then
+    return 0
+end
+if redis.call('HINCRBY', KEYS[1], ARGV[1], -1) <= 0 then
+    redis.call('DEL', KEYS[1])
+    redis.call('PUBLISH', ARGV[2], ARGV[1])
+end
+return 1
+'''
+    _RENEW_LUA = '''
+if redis.call('HEXISTS', KEYS[1], ARGV[1]) == 1 then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+'''
+
+    def __init__(self, redis_client, redis_lock_key, expire_seconds=30, blocking_timeout=0, auto_renew=True,
+                 max_retry_interval=0.5, owner=None):
+        """
+        :param owner: 持有者标识，传入同一个标识的锁对象之间可以重入，默认是 主机名:进程号:线程随机标识
+        """
+        super().__init__(redis_client, redis_lock_key, expire_seconds, blocking_timeout, auto_renew, max_retry_interval)
+        self.identifier = owner or f'{socket.gethostname()}:{os.getpid()}:{self._current_thread_token()}'
+        self._acquire_script = redis_client.register_script(self._ACQUIRE_LUA)
+        self._holds = 0
 
-    return wrapper
+    @classmethod
+    def _current_thread_token(cls):
+        token = getattr(cls._thread_token, 'token', None)
+        if token is None:
+            token = cls._thread_token.token = uuid.uuid4().hex
+        return token
+
+    def _try_acquire(self):
+        return bool(self._acquire_script(keys=self._keys, args=[self.identifier, int(self._expire_seconds * 1000)]))
+
+    def _on_acquired(self):
+        self._holds += 1
+        if self._holds == 1:
+            return super()._on_acquired()
+        return True
+
+    def release(self):
+        if not self.has_aquire_lock:
+            return False
+        self._holds -= 1
+        if self._holds > 0:  # 同一个锁对象嵌套使用，外层还持有锁，看门狗继续续期
+            return bool(self._release_script(keys=self._keys, args=[self.identifier, self._channels[0]]))
+        return super().release()
+
+
+class RedisReadLock(RedisDistributedLockContextManager):
+    """
+    读写锁的读锁，多个读者可以同时持有，和写锁互斥。读者保存在有序集合里面，分数是各自的过期时间，
+    崩溃的读者过期之后会被清理，不会一直挡住写者。通过 RedisReadWriteLock(...).read_lock() 创建。
+    """
 
+    _ACQUIRE_LUA = '''
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', now)
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+redis.call('ZADD', KEYS[2], now + tonumber(ARGV[2]), ARGV[1])
+if redis.call('PTTL', KEYS[2]) < tonumber(ARGV[2]) then
+    redis.call('PEXPIRE', KEYS[2], ARGV[2])
+end
+return 1
+'''
+    _RELEASE_LUA = '''
+local removed = redis.call('ZREM', KEYS[2], ARGV[1])
+if removed == 1 and redis.call('ZCARD', KEYS[2]) == 0 then
+    redis.call('PUBLISH', ARGV[2], ARGV[1])
+end
+return removed
+'''
+    _RENEW_LUA = '''
+if redis.call('ZSCORE', KEYS[2], ARGV[1]) then
+    local t = redis.call('TIME')
+    local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+    redis.call('ZADD', KEYS[2], now + tonumber(ARGV[2]), ARGV[1])
+    local ttl = redis.call('PTTL', KEYS[2])
+    if ttl < tonumber(ARGV[2]) then
+        redis.call('PEXPIRE', KEYS[2], ARGV[2])
+    end
+    return 1
+end
+return 0
+'''
+
+    def __init__(self, redis_client, redis_lock_key, expire_seconds=30, blocking_timeout=0, auto_renew=True,
+                 max_retry_interval=0.5):
+        super().__init__(redis_client, redis_lock_key, expire_seconds, blocking_timeout, auto_renew, max_retry_interval)
+        self._keys = [f'{redis_lock_key}:write', f'{redis_lock_key}:readers']
+        self._acquire_script = redis_client.register_script(self._ACQUIRE_LUA)
+
+    def _try_acquire(self):
+        return bool(self._acquire_script(keys=self._keys, args=[self.identifier, int(self._expire_seconds * 1000)]))
+
+
+class RedisWriteLock(RedisDistributedLockContextManager):
+    """读写锁的写锁，没有读者也没有别的写者时才能获得。通过 RedisReadWriteLock(...).write_lock() 创建。"""
+
+    _ACQUIRE_LUA = '''
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', now)
+if redis.call('EXISTS', KEYS[1]) == 1 or redis.call('ZCARD', KEYS[2]) > 0 then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+return 1
+'''
+
+    def __init__(self, redis_client, redis_lock_key, expire_seconds=30, blocking_timeout=0, auto_renew=True,
+                 max_retry_interval=0.5):
+        super().__init__(redis_client, redis_lock_key, expire_seconds, blocking_timeout, auto_renew, max_retry_interval)
+        # 基类的释放和续期脚本只用到第一个key
+        self._keys = [f'{redis_lock_key}:write', f'{redis_lock_key}:readers']
+        self._acquire_script = redis_client.register_script(self._ACQUIRE_LUA)
+
+    def _try_acquire(self):
+        return bool(self._acquire_script(keys=self._keys, args=[self.identifier, int(self._expire_seconds * 1000)]))
+
+
+class RedisReadWriteLock:
+    """
+    分布式读写锁，读多写少的资源用读锁可以并发读，写的时候独占。
 
-def run_in_new_process_only_for_linux(f):
+        rw_lock = RedisReadWriteLock(redis_client, 'config')
+        with rw_lock.read_lock(blocking_timeout=5) as lock:
+            ...
+        with rw_lock.write_lock(blocking_timeout=5) as lock:
+            ...
     """
-    这个只能在linux上使用。linux使用fork，winwows会报错。请使用下一个非装饰器版本。
-    :param f:
-    :return:
+
+    def __init__(self, redis_client, redis_lock_key, expire_seconds=30):
+        self.redis_client = redis_client
+        self.redis_lock_key = redis_lock_key
+        self.expire_seconds = expire_seconds
+
+    def read_lock(self, blocking_timeout=0, **kwargs) -> RedisReadLock:
+        return RedisReadLock(self.redis_client, self.redis_lock_key, self.expire_seconds, blocking_timeout, **kwargs)
+
+    def write_lock(self, blocking_timeout=0, **kwargs) -> RedisWriteLock:
+        return RedisWriteLock(self.redis_client, self.redis_lock_key, self.expire_seconds, blocking_timeout, **kwargs)
+
+
+class RedisMultiLock(RedisDistributedLockContextManager):
+    """
+    一次获取多个key的锁，全部获得或者一个也不获得，一次Lua调用完成，需要20个资源锁的任务只需要一次网络往返。
+    阻塞等待时订阅所有key的释放通知。
     """
 
-    @functools.wraps(f)
-    def wrapper(*args, **kwargs):
-        Process(target=f, args=args, kwargs=kwargs).start()
+    _ACQUIRE_LUA = '''
+for i, key in ipairs(KEYS) do
+    if redis.call('EXISTS', key) == 1 then
+        return 0
+    end
+end
+for i, key in ipairs(KEYS) do
+    redis.call('SET', key, ARGV[1], 'PX', ARGV[2])
+end
+return 1
+'''
+    _RELEASE_LUA = '''
+local released = 0
+for i, key in ipairs(KEYS) do
+    if redis.call('GET', key) == ARGV[1] then
+        redis.call('DEL', key)
+        redis.call('PUBLISH', key .. ':released', ARGV[1])
+        released = released + 1
+    end
+end
+return released == #KEYS and 1 or 0
+'''
+    _RENEW_LUA = '''
+local renewed = 0
+for i, key in ipairs(KEYS) do
+    if redis.call('GET', key) == ARGV[1] then
+        redis.call('PEXPIRE', key, ARGV[2])
+        renewed = renewed + 1
+    end
+end
+return renewed == #KEYS and 1 or 0
+'''
+
+    def __init__(self, redis_client, redis_lock_keys, expire_seconds=30, blocking_timeout=0, auto_renew=True,
+                 max_retry_interval=0.5):
+        """
+        :param redis_lock_keys: 需要同时锁住的key列表，重复的key会去重
+        """
+        keys = sorted(set(redis_lock_keys))
+        super().__init__(redis_client, ','.join(keys), expire_seconds, blocking_timeout, auto_renew, max_retry_interval)
+        self._keys = keys
+        self._channels = [f'{key}:released' for key in keys]
+        self._acquire_script = redis_client.register_script(self._ACQUIRE_LUA)
+
+    def _try_acquire(self):
+        if not self._keys:
+            return True
+        return bool(self._acquire_script(keys=self._keys, args=[self.identifier, int(self._expire_seconds * 1000)]))
+
+
+class RedisLockNotAcquiredError(Exception):
+    """redis_lock装饰器在blocking_timeout之内没有获得锁"""
+
+
+def redis_lock(redis_client, key_template, expire_seconds=30, blocking_timeout=None, reentrant=False):
+    """
+    redis分布式锁装饰器，锁的key根据函数参数生成。
+
+        @redis_lock(redis_client, 'order:{order_id}', blocking_timeout=10)
+        def pay(order_id, amount):
+            ...
+
+        @redis_lock(redis_client, ['account:{from_id}', 'account:{to_id}'])
+        def transfer(from_id, to_id, amount):
+            ...
+
+    :param key_template: key模板，用 str.format 按参数名渲染，传入列表时一次原子地获取多个key的锁
+    :param blocking_timeout: 最多等待多少秒获取锁，0为不等待，None为一直等待，没有获得锁时抛出 RedisLockNotAcquiredError
+    :param reentrant: 是否使用可重入锁，同一个线程里面递归调用或者调用别的锁住同一个key的函数时不会死锁，只支持单个key
+    """
+    if reentrant and not isinstance(key_template, str):
+        raise ValueError('可重入锁只支持单个key')
+
+    def _redis_lock(func):
+        signature = inspect.signature(func)
+
+        def _render(args, kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            if isinstance(key_template, str):
+                return key_template.format(**bound.arguments)
+            return [template.format(**bound.arguments) for template in key_template]
+
+        @wraps(func)
+        def __redis_lock(*args, **kwargs):
+            key = _render(args, kwargs)
+            if reentrant:
+                lock = RedisReentrantLock(redis_client, key, expire_seconds)
+            elif isinstance(key, str):
+                lock = RedisDistributedLockContextManager(redis_client, key, expire_seconds)
+            else:
+                lock = RedisMultiLock(redis_client, key, expire_seconds)
+            if not lock.acquire(blocking_timeout):
+                raise RedisLockNotAcquiredError(f'{func.__name__} 在 {blocking_timeout} 秒内没有获得redis锁 {key}')
+            try:
+                return func(*args, **kwargs)
+            finally:
+                lock.release()
+
+        return __redis_lock
+
+    return _redis_lock
+
+
+class RateLimitExceeded(Exception):
+    """非阻塞模式下没有令牌，或者阻塞模式下需要等待的时间超过了max_wait"""
+
+
+class TokenBucket:
+    """
+    进程内的令牌桶。每次取令牌只在锁里面做几次加减法。
+    阻塞模式是预约令牌：先扣掉令牌(可以扣成负数)，然后在锁外面精确睡眠到这个令牌生成的时刻，不需要循环轮询。
+    """
+
+    def __init__(self, rate, burst=None):
+        """
+        :param rate: 每秒生成多少个令牌
+        :param burst: 桶的容量，即允许的突发调用次数，默认和rate一样，至少为1
+        """
+        self.rate = rate
+        self.burst = burst if burst is not None else max(rate, 1)
+        self._tokens = self.burst
+        self._last_time = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, block=True, max_wait=None):
+        """取一个令牌，返回需要等待的秒数。非阻塞模式下没有令牌，或者需要等待的时间超过max_wait时抛出RateLimitExceeded"""
+        with self._lock:
+            now = time.monotonic()
+            tokens = min(self.burst, self._tokens + (now - self._last_time) * self.rate)
+            self._last_time = now
+            wait_seconds = 0 if tokens >= 1 else (1 - tokens) / self.rate
+            if wait_seconds and (not block or (max_wait is not None and wait_seconds > max_wait)):
+                self._tokens = tokens
+                raise RateLimitExceeded(f'没有令牌，需要等待 {wait_seconds:.3f} 秒')
+            self._tokens = tokens - 1
+            return wait_seconds
+
+
+class RedisTokenBucket:
+    """
+    分布式令牌桶，多个进程多台机器共用同一个限流额度。
+    和 RedisDistributedLockContextManager 一样传入redis客户端。一次Lua脚本调用原子地完成补充令牌和取令牌，时间使用redis服务器的时间，
+    不受各台机器时钟偏差的影响。阻塞模式同样是预约令牌，返回需要睡眠的秒数。
+    """
+
+    _LUA = '''
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local block = tonumber(ARGV[3])
+local max_wait = tonumber(ARGV[4])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1])
+local ts = tonumber(state[2])
+if tokens == nil then
+    tokens = burst
+    ts = now
+end
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local wait = 0
+if tokens < 1 then
+    wait = (1 - tokens) / rate
+end
+if wait > 0 and (block == 0 or (max_wait >= 0 and wait > max_wait)) then
+    redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+    return {0, tostring(wait)}
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens - 1), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil((burst / rate + wait) * 1000) + 1000)
+return {1, tostring(wait)}
+'''
+
+    def __init__(self, redis_client, redis_key, rate, burst=None):
+        """
+        :param redis_client: redis客户端
+        :param redis_key: 保存令牌桶状态的key，使用同一个key的所有进程共享额度
+        """
+        self.redis_client = redis_client
+        self.redis_key = redis_key
+        self.rate = rate
+        self.burst = burst if burst is not None else max(rate, 1)
+        self._script = redis_client.register_script(self._LUA)
+
+    def reserve(self, block=True, max_wait=None):
+        acquired, wait_seconds = self._script(keys=[self.redis_key], args=[
+            self.rate, self.burst, int(block), -1 if max_wait is None else max_wait])
+        wait_seconds = float(wait_seconds)
+        if not acquired:
+            raise RateLimitExceeded(f'{self.redis_key} 没有令牌，需要等待 {wait_seconds:.3f} 秒')
+        return wait_seconds
+
+
+def rate_limit(rate, burst=None, block=True, max_wait=None, redis_client=None, redis_key=None):
+    """
+    限制函数调用频率的装饰器。
+    :param rate: 每秒最多调用多少次，可以是小数，例如0.5表示每2秒一次
+    :param burst: 允许的突发调用次数，默认和rate一样
+    :param block: 为True时没有令牌就睡眠到下一个令牌生成的时刻再调用，为False时直接抛出RateLimitExceeded
+    :param max_wait: 阻塞模式下最多等待多少秒，需要等待更久则抛出RateLimitExceeded，None为不限制
+    :param redis_client: 传入redis客户端则使用分布式限流，所有使用同一个redis_key的进程共享额度
+    :param redis_key: 分布式限流的key，默认是 rate_limit:模块名.函数名
+    """
+
+    def _rate_limit(func):
+        if redis_client is not None:
+            bucket = RedisTokenBucket(redis_client, redis_key or f'rate_limit:{func.__module__}.{func.__qualname__}',
+                                      rate, burst)
+        else:
+            bucket = TokenBucket(rate, burst)
+
+        @wraps(func)
+        def __rate_limit(*args, **kwargs):
+            wait_seconds = bucket.reserve(block, max_wait)
+            if wait_seconds > 0:
+                time.sleep(wait_seconds)
+            return func(*args, **kwargs)
+
+        __rate_limit.bucket = bucket
+        return __rate_limit
+
+    return _rate_limit
+
+
+def _deliver_bulk_results(batch, results):
+    """把批量调用的结果分发给每个调用方的future，结果的形状不对时抛出异常，由调用者让整批失败"""
+    items = [item for item, _ in batch]
+    if isinstance(results, dict):
+        results = [results[item] if item in results else KeyError(item) for item in items]
+    else:
+        results = list(results) if results is not None else []
+        if len(results) != len(items):
+            raise ValueError(f'批量函数返回了 {len(results)} 个结果，但是传入了 {len(items)} 个参数')
+    for (_, future), result in zip(batch, results):
+        if future.done():  # 调用方已经取消了
+            continue
+        if isinstance(result, BaseException):
+            future.set_exception(result)
+        else:
+            future.set_result(result)
+
+
+def _fail_bulk_results(batch, error):
+    """批量调用或者分发结果出错时，这一批里面还没有结果的调用方都收到这个异常"""
+    for _, future in batch:
+        if not future.done():
+            future.set_exception(error)
 
-    return wrapper
+
+class _ThreadBatcher:
+    """同步版本，后台收集线程从队列中取出调用，凑够一批或者等待超时后调用批量函数"""
+
+    def __init__(self, func, max_size, max_wait, workers):
+        self.func = func
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self.workers = workers
+        self.batches = 0
+        self.items = 0
+        self._queue = queue.SimpleQueue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._executor = None
+
+    def submit(self, item):
+        future = Future()
+        self._queue.put((item, future))
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    if self.workers > 1:
+                        self._executor = BoundedThreadPoolExecutor(
+                            self.workers, thread_name_prefix=f'batched-{self.func.__name__}', log_exceptions=False)
+                    self._thread = threading.Thread(target=self._collect, daemon=True,
+                                                    name=f'batched-collector-{self.func.__name__}')
+                    self._thread.start()
+        return future
+
+    def _collect(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                    continue
+                except queue.Empty:
+                    pass
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            if self._executor is None:
+                self._run(batch)
+            else:
+                self._executor.submit(self._run, batch)
+
+    def _run(self, batch):
+        with self._lock:
+            self.batches += 1
+            self.items += len(batch)
+        try:
+            _deliver_bulk_results(batch, self.func([item for item, _ in batch]))
+        except BaseException as e:  # noqa 批量函数返回的结果形状不对也算出错，收集线程不能退出，否则之后的调用永远等不到结果
+            _fail_bulk_results(batch, e)
+
+
+class _AsyncBatcher:
+    """异步版本，每个事件循环一个，第一个调用进来时定一个max_wait之后的定时器，到时或者凑够一批就创建任务调用批量函数"""
+
+    def __init__(self, func, max_size, max_wait, loop):
+        self.func = func
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self.batches = 0
+        self.items = 0
+        self._loop = loop
+        self._pending = []
+        self._timer = None
+        self._tasks = set()
+
+    async def call(self, item):
+        future = self._loop.create_future()
+        self._pending.append((item, future))
+        if len(self._pending) >= self.max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = self._loop.call_later(self.max_wait, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = self._loop.create_task(self._run(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch):
+        self.batches += 1
+        self.items += len(batch)
+        try:
+            _deliver_bulk_results(batch, await self.func([item for item, _ in batch]))
+        except asyncio.CancelledError as e:
+            _fail_bulk_results(batch, e)
+            raise
+        except BaseException as e:  # noqa
+            _fail_bulk_results(batch, e)
+
+
+def batched(max_size=100, max_wait_ms=5, workers=1):
+    """
+    微批量装饰器，装饰一个接收列表参数的批量函数 f_bulk(items) ，调用方仍然一个一个地调用 f(item) 拿到自己的结果。
+    后台把同一时间段内的调用凑成一批，只调用一次批量函数，适合 redis mget 、sql in 查询、http批量接口，大幅减少网络往返次数。
+    批量函数返回和items一样长、顺序一致的列表，或者返回以item为键的字典(字典里面没有的item会收到KeyError)。
+    某个位置的结果是异常实例时，只有对应的调用方收到这个异常；批量函数本身抛出异常时这一批的调用方都收到这个异常。
+    批量函数是 async def 定义的时候，装饰后的函数也是协程函数，同一个事件循环里面的调用凑成一批。
+
+    :param max_size: 每批最多多少个item，凑够了立即调用
+    :param max_wait_ms: 第一个item进来后最多等待多少毫秒凑批
+    :param workers: 同步版本同时运行的批量调用数量，默认1即批量调用串行运行
+    """
+    max_wait = max_wait_ms / 1000
+
+    def _batched(func):
+        if asyncio.iscoroutinefunction(func):
+            batchers = weakref.WeakKeyDictionary()
+
+            def _get_batcher():
+                loop = asyncio.get_running_loop()
+                batcher = batchers.get(loop)
+                if batcher is None:
+                    batcher = batchers[loop] = _AsyncBatcher(func, max_size, max_wait, loop)
+                return batcher
+
+            @functools.wraps(func)
+            async def __batched(item):
+                return await _get_batcher().call(item)
+
+            def batch_stats():
+                return {'batches': sum(b.batches for b in batchers.values()),
+                        'items': sum(b.items for b in batchers.values())}
+        else:
+            batcher = _ThreadBatcher(func, max_size, max_wait, workers)
+
+            @functools.wraps(func)
+            def __batched(item):
+                return batcher.submit(item).result()
+
+            def batch_stats():
+                return {'batches': batcher.batches, 'items': batcher.items}
+
+        __batched.bulk = func
+        __batched.batch_stats = batch_stats
+        return __batched
+
+    return _batched
+
+
+def run_in_new_thread(f=None, *, pool_name='run_in_new_thread', max_workers=64, queue_size=10000,
+                      rejection_policy='block'):
+    """
+    在线程池中运行函数，调用立即返回 concurrent.futures.Future ，可以获取返回值和异常。
+    使用有界的共享线程池，突发大量调用时不会无限制地创建线程。可以直接 @run_in_new_thread 也可以传参数。
+    同名的线程池是共享的，第一次创建时的参数生效。解释器退出时会等待已提交的任务运行完成。
+    :param pool_name: 线程池名字，不同用途的函数可以用不同名字隔离开，互相不抢线程
+    :param max_workers: 最大线程数
+    :param queue_size: 等待运行的任务数量上限
+    :param rejection_policy: 队列满了时的处理方式，block 阻塞调用方；reject 抛出RejectedExecutionError；caller_runs 在调用方线程直接运行
+    """
+
+    def _run_in_new_thread(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return get_thread_pool(pool_name, max_workers, queue_size, rejection_policy).submit(func, *args, **kwargs)
+
+        return wrapper
+
+    if f is not None:
+        return _run_in_new_thread(f)
+    return _run_in_new_thread
+
+
+def run_in_new_process_only_for_linux(f=None, *, pool: WarmProcessPool = None):
+    """
+    在常驻进程池中运行函数，调用立即返回 concurrent.futures.Future ，不用每次调用都创建新进程。
+    被装饰的函数是模块级别的函数时，参数和返回值必须能pickle，大的bytes和numpy数组参数通过共享内存传递。
+    闭包、类里面的函数这类在工作进程里面按名字找不到的函数，退回到每次调用fork一个新进程运行，只能在linux上使用。
+    装饰后的函数有 map 方法，自动分块批量运行，例如 list(f.map(range(10000)))。
+    :param pool: 使用指定的进程池，默认使用全局共享的进程池
+    """
+
+    def _run_in_new_process(func):
+        importable = '<' not in func.__qualname__  # <locals> <lambda> 在工作进程里面按名字找不到
+        fork_executor = None if importable else process_pool.ForkExecutor()
+
+        def _get_pool():
+            if fork_executor is not None:
+                return fork_executor
+            return pool or process_pool.get_default_pool()
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if process_pool.in_worker():  # 已经在工作进程里面了，例如在另一个进程任务里面调用，直接运行
+                future = Future()
+                try:
+                    future.set_result(func(*args, **kwargs))
+                except Exception as e:
+                    future.set_exception(e)
+                return future
+            return _get_pool().submit(process_pool._FunctionRef(func) if importable else func, *args, **kwargs)
+
+        def _map(*iterables, timeout=None, chunksize=None):
+            return _get_pool().map(process_pool._FunctionRef(func) if importable else func, *iterables,
+                                   timeout=timeout, chunksize=chunksize)
+
+        wrapper.__process_isolated__ = True
+        wrapper.map = _map
+        return wrapper
+
+    if f is not None:
+        return _run_in_new_process(f)
+    return _run_in_new_process
 
 
 def run_with_specify_process(proccess_num, f, *args, **kwargs):
-    [Process(target=f, args=args, kwargs=kwargs).start() for _ in range(proccess_num)]
+    """
+    同时在proccess_num个进程里面运行 f(*args, **kwargs) ，返回Future列表。
+    进程数量不超过全局共享进程池的大小时复用共享进程池，否则临时创建一个这么多进程的进程池，全部运行完成后关闭。
+    f 不能pickle时(lambda、闭包等)，每个进程单独fork出来运行，只能在linux上使用。
+    """
+    if not process_pool.picklable(f):
+        executor = process_pool.ForkExecutor()
+        return [executor.submit(f, *args, **kwargs) for _ in range(proccess_num)]
+    if proccess_num <= process_pool.default_pool_size():
+        pool = process_pool.get_default_pool()
+        return [pool.submit(f, *args, **kwargs) for _ in range(proccess_num)]
+    pool = WarmProcessPool(proccess_num)
+    futures = [pool.submit(f, *args, **kwargs) for _ in range(proccess_num)]
+    remaining = [proccess_num]
+    lock = threading.Lock()
+
+    def _on_done(_):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                pool.shutdown(wait=False)
+
+    for future in futures:
+        future.add_done_callback(_on_done)
+    return futures
 
 
 def add_cors_according_is_mtfy_app_gw(response):
@@ -469,6 +1922,11 @@ def add_cors_according_is_mtfy_app_gw(response):
 
 
 # noinspection PyMethodMayBeStatic
+@run_in_new_process_only_for_linux
+def _test_square_in_process(x):
+    return x * x
+
+
 class _Test(unittest.TestCase):
     @unittest.skip
     def test_superposition(self):
@@ -494,6 +1952,387 @@ class _Test(unittest.TestCase):
 
         f3()
 
+    def test_handle_exception_backoff_and_filters(self):
+        """测试指数退避、异常过滤、结果判断和重试预算"""
+        call_list = []
+        sleep_list = []
+        original_sleep = time.sleep
+        time.sleep = sleep_list.append
+        try:
+            @handle_exception(4, time_sleep=0.1, backoff_multiplier=2, max_sleep=0.3, is_throw_error=True)
+            def f_error():
+                call_list.append(1)
+                raise ValueError('error')
+
+            with self.assertRaises(ValueError):
+                f_error()
+            self.assertEqual((len(call_list), sleep_list), (5, [0.1, 0.2, 0.3, 0.3]))
+
+            @handle_exception(3, give_up_on=(KeyError,), is_throw_error=True)
+            def f_give_up():
+                call_list.append(1)
+                raise KeyError('k')
+
+            call_list.clear()
+            with self.assertRaises(KeyError):
+                f_give_up()
+            self.assertEqual(len(call_list), 1)
+
+            @handle_exception(3, retry_if_result=lambda r: r is None)
+            def f_result():
+                call_list.append(1)
+                return None if len(call_list) < 2 else 'ok'
+
+            call_list.clear()
+            self.assertEqual(f_result(), 'ok')
+
+            @handle_exception(5, retry_budget=RetryBudget(ratio=0, min_per_second=0, max_tokens=2))
+            def f_budget():
+                call_list.append(1)
+                raise ValueError('error')
+
+            call_list.clear()
+            f_budget()
+            self.assertEqual(len(call_list), 3)  # 预算只够重试2次
+        finally:
+            time.sleep = original_sleep
+
+    def test_circuit_breaker(self):
+        """测试熔断器的打开、半开、关闭"""
+        is_backend_down = [True]
+
+        @circuit_breaker(failure_rate_threshold=0.5, window_size=10, min_calls=4, open_seconds=0.1,
+                         half_open_max_calls=2)
+        def f15():
+            if is_backend_down[0]:
+                raise ConnectionError('backend down')
+            return 'ok'
+
+        self.assertEqual(f15.breaker.name, 'f15')
+        self.assertEqual(circuit_breaker(name='payment_api')(lambda: 1).breaker.name, 'payment_api')
+        for _ in range(4):
+            with self.assertRaises(ConnectionError):
+                f15()
+        self.assertEqual(f15.breaker.state, CircuitBreaker.OPEN)
+        with self.assertRaises(CircuitBreakerOpenError):
+            f15()
+        time.sleep(0.11)
+        with self.assertRaises(ConnectionError):
+            f15()  # 半开状态的探测调用失败，重新打开
+        self.assertEqual(f15.breaker.state, CircuitBreaker.OPEN)
+        is_backend_down[0] = False
+        time.sleep(0.11)
+        self.assertEqual([f15(), f15(), f15()], ['ok'] * 3)
+        self.assertEqual(f15.breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(f15.breaker.stats()['failed'], 0)
+
+    def test_circuit_breaker_stale_probe(self):
+        """测试上一轮半开状态发出的慢探测在下一轮半开状态返回时被忽略，不会把探测名额算错"""
+        in_slow_probe = threading.Event()
+        finish_slow_probe = threading.Event()
+        mode = ['fail']
+
+        @circuit_breaker(window_size=10, min_calls=2, open_seconds=0.1, half_open_max_calls=2)
+        def f32():
+            if mode[0] == 'slow':
+                in_slow_probe.set()
+                finish_slow_probe.wait()
+                return 'ok'
+            if mode[0] == 'fail':
+                raise ConnectionError('backend down')
+            return 'ok'
+
+        for _ in range(2):
+            with self.assertRaises(ConnectionError):
+                f32()
+        breaker = f32.breaker
+        self.assertEqual(breaker.stats()['failed'], 2)
+        time.sleep(0.11)
+        mode[0] = 'slow'
+        slow_probe = threading.Thread(target=f32)
+        slow_probe.start()
+        in_slow_probe.wait()
+        mode[0] = 'fail'
+        with self.assertRaises(ConnectionError):
+            f32()  # 同一轮的另一个探测失败，重新打开
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        time.sleep(0.11)
+        mode[0] = 'ok'
+        self.assertEqual(f32(), 'ok')  # 新一轮半开状态，占用一个探测名额
+        finish_slow_probe.set()
+        slow_probe.join()
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)  # 过期探测的成功不能算到这一轮
+        self.assertEqual(breaker._half_open_inflight, 0)
+        self.assertEqual(breaker._half_open_successes, 1)
+        self.assertEqual(f32(), 'ok')
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_circuit_breaker_window_counts(self):
+        """测试环形窗口覆盖旧结果时失败数和慢调用数同步更新"""
+        breaker = CircuitBreaker(failure_rate_threshold=1.1, slow_call_rate_threshold=1.1, window_size=4, min_calls=1)
+        for failed, slow in [(1, 0), (1, 1), (0, 1), (0, 0), (0, 0), (1, 0)]:
+            breaker._record(failed, slow)
+        window = breaker._window
+        self.assertEqual((window.failed_count, window.slow_count), (window.failed.count(1), window.slow.count(1)))
+        self.assertEqual(breaker.stats()['failed'], 1)
+        self.assertEqual(breaker.stats()['slow'], 1)
+
+    def test_rate_limit(self):
+        """测试令牌桶限流，阻塞模式精确等待，非阻塞模式直接拒绝"""
+
+        @rate_limit(20, burst=2)
+        def f16():
+            return time.monotonic()
+
+        times = [f16() for _ in range(6)]
+        self.assertLess(times[1] - times[0], 0.02)  # 突发的2次不等待
+        self.assertAlmostEqual(times[-1] - times[1], 4 / 20, delta=0.03)
+
+        @rate_limit(1, block=False)
+        def f17():
+            return 'ok'
+
+        self.assertEqual(f17(), 'ok')
+        with self.assertRaises(RateLimitExceeded):
+            f17()
+
+    def test_rate_limit_redis(self):
+        try:
+            import fakeredis
+        except ImportError:
+            self.skipTest('需要安装 fakeredis[lua]')
+        redis_client = fakeredis.FakeRedis()
+
+        @rate_limit(10, burst=3, block=False, redis_client=redis_client, redis_key='test_rate_limit')
+        def f18():
+            return 'ok'
+
+        results = []
+        for _ in range(5):
+            try:
+                results.append(f18())
+            except RateLimitExceeded:
+                results.append('limited')
+        self.assertEqual(results, ['ok'] * 3 + ['limited'] * 2)
+        bucket = RedisTokenBucket(redis_client, 'test_rate_limit', 10, burst=3)
+        self.assertAlmostEqual(bucket.reserve(block=True), 0.1, delta=0.03)  # 阻塞模式预约下一个令牌
+
+    def test_redis_distributed_lock(self):
+        try:
+            import fakeredis
+        except ImportError:
+            self.skipTest('需要安装 fakeredis[lua]')
+        redis_client = fakeredis.FakeRedis()
+        with RedisDistributedLockContextManager(redis_client, 'test_lock') as lock1:
+            self.assertTrue(lock1)
+            with RedisDistributedLockContextManager(redis_client, 'test_lock') as lock2:
+                self.assertFalse(lock2)
+        self.assertIsNone(redis_client.get('test_lock'))
+
+        # 锁过期后被别人获得，释放时不能删除别人的锁
+        lock1 = RedisDistributedLockContextManager(redis_client, 'test_lock', expire_seconds=0.1, auto_renew=False)
+        self.assertTrue(lock1.acquire(0))
+        time.sleep(0.15)
+        lock2 = RedisDistributedLockContextManager(redis_client, 'test_lock')
+        self.assertTrue(lock2.acquire(0))
+        self.assertFalse(lock1.release())
+        self.assertEqual(redis_client.get('test_lock').decode(), lock2.identifier)
+
+        # 阻塞等待，释放后通过通知立即获得
+        threading.Timer(0.2, lock2.release).start()
+        lock3 = RedisDistributedLockContextManager(redis_client, 'test_lock', max_retry_interval=5)
+        t0 = time.monotonic()
+        self.assertTrue(lock3.acquire(timeout=3))
+        self.assertLess(time.monotonic() - t0, 1)
+        self.assertFalse(RedisDistributedLockContextManager(redis_client, 'test_lock').acquire(timeout=0.1))
+        lock3.release()
+
+        # 看门狗续期
+        with RedisDistributedLockContextManager(redis_client, 'test_lock', expire_seconds=0.3) as lock4:
+            time.sleep(0.6)
+            self.assertEqual(redis_client.get('test_lock').decode(), lock4.identifier)
+            self.assertFalse(lock4.lost)
+        self.assertIsNone(redis_client.get('test_lock'))
+
+        # 续期的过程中锁被释放，不能当成丢锁
+        lock5 = RedisDistributedLockContextManager(redis_client, 'test_lock')
+        self.assertTrue(lock5.acquire(0))
+        renew_script = lock5._renew_script
+
+        def _renew_while_releasing(keys, args):
+            lock5.release()
+            return renew_script(keys=keys, args=args)
+
+        lock5._renew_script = _renew_while_releasing
+        lock5._renew()
+        self.assertFalse(lock5.lost)
+
+        # 默认调度器的工作线程全部被用户任务阻塞住时，续期照样进行
+        unblock = threading.Event()
+        scheduler = get_default_scheduler()
+        blocking_jobs = [scheduler.schedule(unblock.wait, interval=10, name=f'test_block_{i}')
+                         for i in range(scheduler.max_workers)]
+        try:
+            with RedisDistributedLockContextManager(redis_client, 'test_lock', expire_seconds=0.3) as lock6:
+                time.sleep(0.6)
+                self.assertEqual(redis_client.get('test_lock').decode(), lock6.identifier)
+        finally:
+            unblock.set()
+            for job in blocking_jobs:
+                job.stop()
+
+    def test_redis_reentrant_read_write_and_multi_lock(self):
+        try:
+            import fakeredis
+        except ImportError:
+            self.skipTest('需要安装 fakeredis[lua]')
+        redis_client = fakeredis.FakeRedis()
+
+        with RedisReentrantLock(redis_client, 'test_rlock') as lock1:
+            self.assertTrue(lock1)
+            with RedisReentrantLock(redis_client, 'test_rlock') as lock2:  # 同一个线程重入
+                self.assertTrue(lock2)
+                self.assertEqual(int(redis_client.hget('test_rlock', lock1.identifier)), 2)
+            self.assertFalse(RedisReentrantLock(redis_client, 'test_rlock', owner='other').acquire(0))
+            other_thread_results = []
+            t = threading.Thread(target=lambda: other_thread_results.append(
+                RedisReentrantLock(redis_client, 'test_rlock').acquire(0)))
+            t.start()
+            t.join()
+            self.assertEqual(other_thread_results, [False])  # 别的线程不能重入
+            self.assertEqual(int(redis_client.hget('test_rlock', lock1.identifier)), 1)
+        self.assertEqual(redis_client.exists('test_rlock'), 0)
+
+        rw_lock = RedisReadWriteLock(redis_client, 'test_rwlock')
+        reader1, reader2, writer = rw_lock.read_lock(), rw_lock.read_lock(), rw_lock.write_lock()
+        self.assertTrue(reader1.acquire(0))
+        self.assertTrue(reader2.acquire(0))
+        self.assertFalse(writer.acquire(0))
+        reader1.release()
+        threading.Timer(0.1, reader2.release).start()
+        self.assertTrue(writer.acquire(2))
+        self.assertFalse(rw_lock.read_lock().acquire(0))
+        writer.release()
+        self.assertTrue(reader1.acquire(0))
+        reader1.release()
+
+        # 租期短的读者不能把读者集合的过期时间缩短到租期长的读者之前
+        long_reader = RedisReadLock(redis_client, 'test_rwlock', expire_seconds=10, auto_renew=False)
+        short_reader = RedisReadLock(redis_client, 'test_rwlock', expire_seconds=0.1, auto_renew=False)
+        self.assertTrue(long_reader.acquire(0))
+        self.assertTrue(short_reader.acquire(0))
+        self.assertGreater(redis_client.pttl('test_rwlock:readers'), 5000)
+        short_reader.release()
+        long_reader.release()
+
+        other = RedisDistributedLockContextManager(redis_client, 'res:3')
+        other.acquire(0)
+        keys = [f'res:{i}' for i in range(20)]
+        self.assertFalse(RedisMultiLock(redis_client, keys).acquire(0))
+        self.assertEqual(redis_client.exists(*keys), 1)  # 全部或者一个也不获得
+        other.release()
+        with RedisMultiLock(redis_client, keys) as multi_lock:
+            self.assertTrue(multi_lock)
+            self.assertEqual(redis_client.exists(*keys), 20)
+        self.assertEqual(redis_client.exists(*keys), 0)
+
+        calls = []
+
+        @redis_lock(redis_client, 'test_order:{order_id}', blocking_timeout=0)
+        def f25(order_id, amount=1):
+            calls.append(redis_client.exists(f'test_order:{order_id}'))
+            return amount
+
+        self.assertEqual(f25(7, amount=3), 3)
+        self.assertEqual(calls, [1])
+        RedisDistributedLockContextManager(redis_client, 'test_order:8').acquire(0)
+        with self.assertRaises(RedisLockNotAcquiredError):
+            f25(8)
+
+        @redis_lock(redis_client, 'test_tree:{node}', reentrant=True, blocking_timeout=0)
+        def f26(node, depth):
+            return depth if depth == 0 else f26(node, depth - 1)
+
+        self.assertEqual(f26('a', 3), 0)
+        self.assertEqual(redis_client.exists('test_tree:a'), 0)
+
+    def test_synchronized_keyed(self):
+        """测试按key加锁，不同key并行，相同key串行，锁用完后删除"""
+        running = {}
+        max_running = {}
+
+        @synchronized(key=lambda user_id, seconds: user_id)
+        def f27(user_id, seconds):
+            running[user_id] = running.get(user_id, 0) + 1
+            max_running[user_id] = max(max_running.get(user_id, 0), running[user_id])
+            time.sleep(seconds)
+            running[user_id] -= 1
+
+        t0 = time.monotonic()
+        with ThreadPoolExecutor(10) as executor:
+            list(executor.map(f27, [i % 5 for i in range(10)], [0.1] * 10))
+        self.assertLess(time.monotonic() - t0, 0.35)  # 5个key并行，每个key两次串行
+        self.assertEqual(set(max_running.values()), {1})
+        stats = f27.lock_stats()
+        self.assertEqual(stats['acquisitions'], 10)
+        self.assertEqual(stats['contended'], 5)
+        self.assertGreater(stats['wait_seconds_total'], 0.3)
+        self.assertEqual(stats['active_keys'], 0)
+
+        @synchronized(key=lambda n: 'same', reentrant=True)
+        def f28(n):
+            return n if n == 0 else f28(n - 1)
+
+        self.assertEqual(f28(3), 0)
+
+        @synchronized(key=lambda user_id: user_id)
+        async def f29(user_id):
+            running[user_id] = running.get(user_id, 0) + 1
+            max_running[user_id] = max(max_running.get(user_id, 0), running[user_id])
+            await asyncio.sleep(0.01)
+            running[user_id] -= 1
+
+        async def main():
+            await asyncio.gather(*[f29(f'async_{i % 2}') for i in range(6)])
+
+        asyncio.run(main())
+        self.assertEqual(max_running['async_0'], 1)
+        self.assertEqual(f29.lock_stats()['contended'], 4)
+
+    def test_synchronized_lock_stats(self):
+        """测试整个函数一把锁时，普通锁、可重入锁和协程函数也有和按key加锁一样的等待统计"""
+
+        @synchronized
+        def f34():
+            time.sleep(0.05)
+
+        with ThreadPoolExecutor(4) as executor:
+            list(executor.map(lambda _: f34(), range(4)))
+        stats = f34.lock_stats()
+        self.assertEqual((stats['acquisitions'], stats['contended']), (4, 3))
+        self.assertGreater(stats['wait_seconds_total'], 0.25)  # 分别等了 0.05 0.1 0.15 秒左右
+        self.assertGreater(stats['max_wait_seconds'], 0.13)
+
+        @synchronized(reentrant=True)
+        def f35(n):
+            time.sleep(0.02)
+            return n if n == 0 else f35(n - 1)
+
+        with ThreadPoolExecutor(2) as executor:
+            self.assertEqual(list(executor.map(f35, [1, 1])), [0, 0])
+        stats = f35.lock_stats()
+        self.assertEqual((stats['acquisitions'], stats['contended']), (4, 1))  # 同一个线程重入不算等待
+
+        @synchronized
+        async def f36():
+            await asyncio.sleep(0.01)
+
+        async def main():
+            await asyncio.gather(*[f36() for _ in range(3)])
+
+        asyncio.run(main())
+        self.assertEqual(f36.lock_stats()['contended'], 2)
+
     @unittest.skip
     def test_run_many_times(self):
         """测试运行5次"""
@@ -505,6 +2344,47 @@ class _Test(unittest.TestCase):
 
         f1()
 
+    def test_singleton_concurrent(self):
+        """100个线程同时实例化，每种单例都只创建一个实例，只初始化一次"""
+        init_counts = collections.Counter()
+
+        def _slow_init(name):
+            init_counts[name] += 1
+            time.sleep(0.01)  # 放大竞争窗口
+
+        @singleton
+        class A1:
+            def __init__(self):
+                _slow_init('singleton')
+
+        class A2(SingletonBaseCall):
+            def __init__(self):
+                _slow_init('SingletonMeta')
+
+        class A3(SingletonBaseNew):
+            pass
+
+        class A4(SingletonBaseCustomInit):
+            def _custom_init(self):
+                _slow_init('SingletonBaseCustomInit')
+
+        class A4Child(A4):
+            pass
+
+        for cls in (A1, A2, A3, A4, A4Child):
+            barrier = threading.Barrier(100)
+
+            def _create():
+                barrier.wait()
+                return id(cls())
+
+            with ThreadPoolExecutor(100) as executor:
+                ids = set(executor.map(lambda _: _create(), range(100)))
+            self.assertEqual(len(ids), 1, cls)
+        self.assertEqual(init_counts, {'singleton': 1, 'SingletonMeta': 1, 'SingletonBaseCustomInit': 2})
+        self.assertIsNot(A4(), A4Child())  # 子类有自己的实例
+        self.assertIsNot(A1, A2)
+
     @unittest.skip
     def test_singleton(self):
         """测试单例模式的装饰器"""
@@ -553,15 +2433,192 @@ class _Test(unittest.TestCase):
         f6()
         print('test block')
 
-    @unittest.skip
+    def test_keep_circulating_handle(self):
+        """测试不阻塞时返回任务句柄，可以停止"""
+        call_list = []
+
+        @keep_circulating(0.02, block=False, daemon=True)
+        def f19(x):
+            call_list.append(x)
+
+        job = f19(1)
+        time.sleep(0.1)
+        job.stop()
+        count = len(call_list)
+        self.assertGreater(count, 2)
+        time.sleep(0.05)
+        self.assertEqual(len(call_list), count)
+        self.assertEqual(job.stats()['runs'], count)
+
+    def test_batched(self):
+        """测试微批量，并发的单个调用合并成批量调用，每个调用方拿到自己的结果或异常"""
+        bulk_calls = []
+
+        @batched(max_size=10, max_wait_ms=20)
+        def f22(items):
+            bulk_calls.append(list(items))
+            return [ValueError(item) if item == 7 else item * 2 for item in items]
+
+        with ThreadPoolExecutor(30) as executor:
+            futures = [executor.submit(f22, i) for i in range(30)]
+            for i, future in enumerate(futures):
+                if i == 7:
+                    self.assertRaises(ValueError, future.result)
+                else:
+                    self.assertEqual(future.result(), i * 2)
+        self.assertEqual(sum(len(items) for items in bulk_calls), 30)
+        self.assertLess(len(bulk_calls), 10)
+        self.assertTrue(all(len(items) <= 10 for items in bulk_calls))
+        self.assertEqual(f22.batch_stats(), {'batches': len(bulk_calls), 'items': 30})
+
+        @batched()
+        def f23(items):
+            return {item: item.upper() for item in items if item != 'b'}
+
+        self.assertEqual(f23('a'), 'A')
+        with self.assertRaises(KeyError):
+            f23('b')
+
+    def test_batched_bad_bulk_result(self):
+        """批量函数返回的结果形状不对或者抛出BaseException时，调用方收到异常，之后的调用仍然正常"""
+        bad_result = [5]
+
+        @batched(max_wait_ms=1)
+        def f30(items):
+            if isinstance(bad_result[0], BaseException):
+                raise bad_result[0]
+            return bad_result[0]
+
+        with self.assertRaises(TypeError):  # 返回的不是列表也不是字典
+            f30(1)
+        bad_result[0] = {1: 'a'}
+        with self.assertRaises(TypeError):  # 返回字典但是参数不可哈希
+            f30([1])
+        bad_result[0] = GeneratorExit()
+        with self.assertRaises(GeneratorExit):
+            f30(1)
+        bad_result[0] = ['ok']
+        self.assertEqual(f30(1), 'ok')
+
+        @batched(max_wait_ms=1)
+        async def f31(items):
+            return 5
+
+        async def main():
+            with self.assertRaises(TypeError):
+                await f31(1)
+
+        asyncio.run(main())
+
+    def test_batched_async(self):
+        """测试异步微批量"""
+        bulk_calls = []
+
+        @batched(max_size=4, max_wait_ms=10)
+        async def f24(items):
+            bulk_calls.append(list(items))
+            await asyncio.sleep(0)
+            if 'bad' in items:
+                raise ConnectionError('bad')
+            return [item * 2 for item in items]
+
+        async def main():
+            self.assertEqual(await asyncio.gather(*[f24(i) for i in range(10)]), [i * 2 for i in range(10)])
+            with self.assertRaises(ConnectionError):
+                await f24('bad')
+
+        asyncio.run(main())
+        self.assertEqual(bulk_calls[:3], [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]])
+
+    def test_run_in_new_thread(self):
+        """测试在线程池运行，返回future"""
+
+        @run_in_new_thread
+        def f20(x):
+            return threading.current_thread().name, x * 2
+
+        name, result = f20(3).result()
+        self.assertEqual(result, 6)
+        self.assertTrue(name.startswith('run_in_new_thread'))
+
+        @run_in_new_thread(pool_name='test_run_in_new_thread', max_workers=2)
+        def f21():
+            time.sleep(0.01)
+            return threading.current_thread().name
+
+        names = {future.result() for future in [f21() for _ in range(20)]}
+        self.assertLessEqual(len(names), 2)
+        self.assertEqual(get_thread_pool('test_run_in_new_thread').metrics()['completed'], 20)
+
+    def test_run_in_new_process(self):
+        """测试在常驻进程池运行，返回future，批量map"""
+        self.assertEqual(_test_square_in_process(3).result(), 9)
+        self.assertEqual(list(_test_square_in_process.map(range(50))), [x * x for x in range(50)])
+        futures = run_with_specify_process(2, os.getpid)
+        self.assertTrue(all(future.result() != os.getpid() for future in futures))
+
+    def test_run_in_new_process_unpicklable(self):
+        """测试闭包和lambda不能发给常驻进程池时，退回到fork新进程运行"""
+        offset = 10
+
+        @run_in_new_process_only_for_linux
+        def add_offset(x):
+            return x + offset, os.getpid()
+
+        result, pid = add_offset(1).result()
+        self.assertEqual(result, 11)
+        self.assertNotEqual(pid, os.getpid())
+        self.assertEqual([r[0] for r in add_offset.map(range(5))], [10, 11, 12, 13, 14])
+        futures = run_with_specify_process(2, lambda: (offset, os.getpid()))
+        self.assertTrue(all(future.result()[0] == offset and future.result()[1] != os.getpid() for future in futures))
+
     def test_timer(self):
         """测试计时器装饰器"""
 
         @timer
-        def f7():
-            time.sleep(2)
-
-        f7()
+        def f7(seconds):
+            time.sleep(seconds)
+
+        for _ in range(9):
+            f7(0.001)
+        f7(0.05)
+        snapshot = f7.timer_snapshot()
+        self.assertEqual(snapshot['count'], 10)
+        self.assertGreaterEqual(snapshot['max_ms'], 50)
+        self.assertLess(snapshot['p50_ms'], 20)
+        self.assertIn(f7.timer_histogram.name, timer_snapshot_all())
+        f7.timer_reset()
+        self.assertEqual(f7.timer_snapshot()['count'], 0)
+
+        @timer(flush_interval=None)
+        async def f7_async():
+            await asyncio.sleep(0.001)
+
+        asyncio.run(f7_async())
+        self.assertEqual(f7_async.timer_snapshot()['count'], 1)
+
+    def test_timer_spans(self):
+        """测试timer装饰的函数互相调用时形成嵌套的span"""
+
+        @timer(flush_interval=None)
+        def f7_inner():
+            time.sleep(0.001)
+
+        @timer(flush_interval=None)
+        def f7_outer():
+            f7_inner()
+            f7_inner()
+
+        span_tracer.reset()
+        span_tracer.enable()
+        try:
+            f7_outer()
+        finally:
+            span_tracer.disable()
+        outer, inner = f7_outer.timer_histogram.name, f7_inner.timer_histogram.name
+        self.assertEqual({row['path']: row['count'] for row in span_tracer.stats()}, {outer: 1, f'{outer};{inner}': 2})
+        self.assertIn(f'{outer};{inner} ', span_tracer.collapsed_stacks())
+        span_tracer.reset()
 
     # noinspection PyArgumentEqualDefault
     @unittest.skip
@@ -578,6 +2635,155 @@ class _Test(unittest.TestCase):
         time.sleep(4)
         print(f10(1, 2, 3, 4))
 
+    def test_cached_function_result_lru(self):
+        """测试缓存超过上限时按LRU淘汰，而不是全部清空"""
+        FunctionResultCacher.configure(max_entries=2)
+        call_list = []
+
+        @FunctionResultCacher.cached_function_result_for_a_time(10)
+        def f11(x):
+            call_list.append(x)
+            return x * 2
+
+        self.assertEqual([f11(1), f11(2), f11(1), f11(3), f11(1), f11(2)], [2, 4, 2, 6, 2, 4])
+        self.assertEqual(call_list, [1, 2, 3, 2])
+        stats = f11.cache_stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['evictions']), (2, 4, 2))
+        FunctionResultCacher.configure()
+
+    def test_cached_function_result_key(self):
+        """测试参数按签名归一化，并且可以传入不可哈希的参数"""
+        call_list = []
+
+        @FunctionResultCacher.cached_function_result_for_a_time(10)
+        def f14(a, b, c=3, d=None):
+            call_list.append(a)
+            return a + b + c
+
+        self.assertEqual([f14(1, 2, 3), f14(1, 2), f14(1, b=2, c=3, d=None), f14(1, 2, d={'x': [1]})], [6, 6, 6, 6])
+        self.assertEqual(len(call_list), 2)
+
+    def test_cached_function_result_stale_while_revalidate(self):
+        """测试过期后先返回旧值，后台刷新"""
+        call_list = []
+
+        @FunctionResultCacher.cached_function_result_for_a_time(0.1, stale_ttl=10)
+        def f12(x):
+            call_list.append(x)
+            return len(call_list)
+
+        self.assertEqual(f12(1), 1)
+        time.sleep(0.15)
+        self.assertEqual(f12(1), 1)  # 旧值立即返回
+        time.sleep(0.1)
+        self.assertEqual(f12(1), 2)  # 后台已经刷新
+        self.assertEqual(len(call_list), 2)
+
+    def test_cached_function_result_single_flight(self):
+        """测试single_flight模式下并发的同样参数的调用只执行一次，每次查缓存只记一次命中或者未命中"""
+        call_list = []
+        leader_started = threading.Event()
+        finish = threading.Event()
+
+        @FunctionResultCacher.cached_function_result_for_a_time(10, single_flight=True)
+        def f33(x):
+            call_list.append(x)
+            leader_started.set()
+            finish.wait()
+            return x * 2
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(f33(1))) for _ in range(10)]
+        threads[0].start()
+        leader_started.wait()
+        [t.start() for t in threads[1:]]
+        while f33.cache_stats()['misses'] < 10:  # 等所有调用都查过缓存，在等待计算结果
+            time.sleep(0.01)
+        finish.set()
+        [t.join() for t in threads]
+        self.assertEqual(call_list, [1])
+        self.assertEqual(results, [2] * 10)
+        stats = f33.cache_stats()
+        self.assertEqual((stats['hits'], stats['misses']), (0, 10))
+        self.assertEqual(f33(1), 2)
+        stats = f33.cache_stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['entries']), (1, 10, 1))
+
+    def test_cached_function_result_closures(self):
+        """测试同一个工厂函数返回的多个闭包各自缓存，不会拿到别的闭包的结果"""
+
+        def make(n):
+            @FunctionResultCacher.cached_function_result_for_a_time(10)
+            def f15(x):
+                return n, x
+
+            return f15
+
+        self.assertEqual([make(1)(0), make(2)(0)], [(1, 0), (2, 0)])
+        f15 = make(3)
+        self.assertEqual([f15(0), f15(0)], [(3, 0), (3, 0)])
+        self.assertEqual(f15.cache_stats()['hits'], 1)
+
+    def test_cached_function_result_sqlite_backend(self):
+        """测试用sqlite后端缓存，别的连接(例如另一个进程)用 模块名.限定名 能读到同一份缓存"""
+        call_list = []
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'cache.db')
+            with SqliteCacheBackend(path) as backend:
+                @FunctionResultCacher.cached_function_result_for_a_time(10, backend=backend)
+                def f17(x, y=2):
+                    call_list.append(x)
+                    return {'sum': x + y}
+
+                self.assertEqual([f17(1), f17(1, y=2), f17(2)], [{'sum': 3}, {'sum': 3}, {'sum': 4}])
+                self.assertEqual(call_list, [1, 2])
+                stats = f17.cache_stats()
+                self.assertEqual((stats['hits'], stats['misses'], stats['entries']), (1, 2, 2))
+                with SqliteCacheBackend(path) as other:
+                    self.assertEqual(other.stats(f'{f17.__module__}.{f17.__qualname__}')['entries'], 2)
+                f17.cache_clear()
+                self.assertEqual(f17.cache_stats()['entries'], 0)
+
+    def test_cached_coroutine_function_result(self):
+        """测试异步函数缓存的是结果，并发调用只执行一次"""
+        call_list = []
+
+        @FunctionResultCacher.cached_function_result_for_a_time(10)
+        async def f13(x):
+            call_list.append(x)
+            await asyncio.sleep(0.05)
+            return x * 2
+
+        async def main():
+            results = await asyncio.gather(*[f13(1) for _ in range(10)])
+            return results + [await f13(1), await f13(2)]
+
+        self.assertEqual(asyncio.run(main()), [2] * 11 + [4])
+        self.assertEqual(call_list, [1, 2])
+
+    def test_cached_coroutine_function_leader_cancelled(self):
+        """测试发起计算的调用方被取消时，等待同一个结果的其他调用方仍然拿到结果"""
+        call_list = []
+
+        @FunctionResultCacher.cached_function_result_for_a_time(10)
+        async def f16(x):
+            call_list.append(x)
+            await asyncio.sleep(0.05)
+            return x * 2
+
+        async def main():
+            leader = asyncio.ensure_future(f16(1))
+            await asyncio.sleep(0.01)
+            follower = asyncio.ensure_future(f16(1))
+            await asyncio.sleep(0.01)
+            leader.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await leader
+            return await follower, await f16(1)
+
+        self.assertEqual(asyncio.run(main()), (2, 2))
+        self.assertEqual(call_list, [1])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,7 +1,9 @@
 """
 超时装饰器
 """
-import sys
+import ctypes
+import heapq
+import queue
 import threading
 
 # noinspection PyUnusedLocal
@@ -10,118 +12,538 @@ import typing
 import functools
 import time
 import signal
+import unittest
 
-class __KThread(threading.Thread):
-    def __init__(self, *args, **kwargs):
-        threading.Thread.__init__(self, *args, **kwargs)
-        self.killed = False
-        self.__run_backup = None
+# noinspection PyPep8Naming
+class TIMEOUT_EXCEPTION(Exception):
+    """function run timeout"""
+    pass
 
-    # noinspection PyAttributeOutsideInit
-    def start(self):
-        """Start the thread."""
-        self.__run_backup = self.run
-        self.run = self.__run  # Force the Thread to install our trace.
-        threading.Thread.start(self)
 
-    def __run(self):
-        """Hacked run function, which installs the trace."""
-        sys.settrace(self.globaltrace)
-        self.__run_backup()
-        self.run = self.__run_backup
+class _WatchdogInterrupt(BaseException):
+    """看门狗注入到超时线程里面的异常，继承BaseException，免得被函数里面的 except Exception 吞掉"""
 
-    def globaltrace(self, frame, why, arg):
-        if why == 'call':
-            return self.localtrace
-        return None
 
-    def localtrace(self, frame, why, arg):
-        if self.killed:
-            if why == 'line':
-                raise SystemExit()
-        return self.localtrace
+def _async_raise(thread_id, exc_type):
+    """在指定线程里面异步抛出异常，exc_type为None时清除还没抛出的异步异常"""
+    ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(thread_id),
+                                               ctypes.py_object(exc_type) if exc_type is not None else None)
 
-    def kill(self):
-        self.killed = True
 
+class _TimeoutJob:
+    __slots__ = ('func', 'args', 'kwargs', 'deadline', 'thread_id', 'finished', 'interrupted', 'result', 'exception',
+                 'done_event')
 
-# noinspection PyPep8Naming
-class TIMEOUT_EXCEPTION(Exception):
-    """function run timeout"""
-    pass
+    def __init__(self, func, args, kwargs, deadline):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.deadline = deadline
+        self.thread_id = None
+        self.finished = False
+        self.interrupted = False
+        self.result = None
+        self.exception = None
+        self.done_event = threading.Event()
+
+    def __lt__(self, other):
+        return self.deadline < other.deadline
+
+
+class _TimeoutWatchdog:
+    """
+    全局唯一的看门狗线程，用最小堆保存所有正在运行的函数的截止时间，精确睡眠到最近的一个截止时间。
+    到期时如果函数还没运行完，就往运行它的线程注入 _WatchdogInterrupt 异常来中断它。
+    不像以前那样用 sys.settrace 每一行都检查一次，函数本身的运行速度不受影响。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()  # 保护job的finished interrupted状态，注入异常和标记完成互斥
+        self._cond = threading.Condition(threading.Lock())
+        self._heap = []
+        self._finished_in_heap = 0
+        self._thread = None
+
+    def _ensure_started(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='TimeoutWatchdog', daemon=True)
+            self._thread.start()
+
+    def watch(self, job):
+        with self._cond:
+            self._ensure_started()
+            heapq.heappush(self._heap, job)
+            if self._heap[0] is job:
+                self._cond.notify()
+
+    def disarm(self, job):
+        """
+        job运行完成后调用，之后看门狗不会再中断这个线程，并且清除已经注入但还没抛出的异常。
+        看门狗对每个job最多注入一次异常，这次注入可能刚好在标记完成之前晚到，落在这里面，所以第一段必须可以重复执行；
+        标记完成并且清除之后不会再有异常，后面的计数只会执行一次。
+        """
+        with self._lock:
+            job.finished = True
+            if job.interrupted:
+                _async_raise(job.thread_id, None)
+        with self._cond:
+            self._finished_in_heap += 1
+            # 大部分函数都会在截止时间之前完成，堆里面积累的已完成job太多时压缩一下
+            if self._finished_in_heap > 1024 and self._finished_in_heap * 2 > len(self._heap):
+                self._heap = [j for j in self._heap if not j.finished]
+                heapq.heapify(self._heap)
+                self._finished_in_heap = 0
+
+    def _interrupt(self, job):
+        with self._lock:
+            if job.finished:
+                return
+            job.interrupted = True
+            if job.thread_id is not None:  # 还没有线程开始运行时只做标记，线程开始时看到标记直接放弃
+                _async_raise(job.thread_id, _WatchdogInterrupt)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._heap:
+                    self._cond.wait()
+                job = self._heap[0]
+                wait_seconds = job.deadline - time.monotonic()
+                if wait_seconds > 0:
+                    self._cond.wait(wait_seconds)
+                    continue
+                heapq.heappop(self._heap)
+                if job.finished:
+                    self._finished_in_heap -= 1
+                    continue
+            self._interrupt(job)
+
+
+class _ElasticThreadPool:
+    """
+    可复用线程的线程池，有空闲线程就复用，没有就新开一个，空闲超过keepalive秒的线程自动退出。
+    不限制线程数量，是为了和以前每次调用都开新线程的行为一致，卡在C代码里面中断不了的线程不会让后面的调用排队。
+    """
+
+    def __init__(self, keepalive=60):
+        self._keepalive = keepalive
+        self._lock = threading.Lock()
+        self._tasks = queue.SimpleQueue()
+        self._idle = 0
+
+    def submit(self, fn, *args):
+        with self._lock:
+            self._tasks.put((fn, args))
+            if self._idle > 0:
+                self._idle -= 1  # 预定一个空闲线程
+                return
+        threading.Thread(target=self._worker, name='TimeoutWorker', daemon=True).start()
+
+    def _worker(self):
+        while True:
+            try:
+                fn, args = self._tasks.get(timeout=self._keepalive)
+            except queue.Empty:
+                with self._lock:
+                    if self._idle == 0:  # 空闲名额已经被预定了，任务马上就到
+                        continue
+                    self._idle -= 1
+                    return
+            fn(*args)
+            with self._lock:
+                self._idle += 1
+
+
+_watchdog = _TimeoutWatchdog()
+_pool = _ElasticThreadPool()
+
+
+def _run_job(job):
+    """在线程池的线程里面运行，看门狗注入的异常无论落在哪一行都在这里被捕获，不会漏到线程池的代码里"""
+    try:
+        try:
+            with _watchdog._lock:  # 和看门狗的中断互斥，看门狗要么看到线程号，要么线程看到已经超时的标记
+                job.thread_id = threading.get_ident()
+                cancelled = job.interrupted
+            if cancelled:
+                raise _WatchdogInterrupt()
+            job.result = job.func(*job.args, **job.kwargs)
+        except BaseException as e:
+            job.exception = e
+        finally:
+            try:
+                _watchdog.disarm(job)
+            except _WatchdogInterrupt:  # 注入的异常晚到，落在了disarm标记完成之前，重新做一次
+                _watchdog.disarm(job)
+    except _WatchdogInterrupt:
+        pass
+    job.done_event.set()
 
 
-def timeout(seconds:int):
+def run_with_watchdog(func, args, kwargs, seconds):
+    """在复用的线程里面运行函数，超过seconds秒还没返回就抛出TIMEOUT_EXCEPTION，并由看门狗中断那个线程"""
+    job = _TimeoutJob(func, args, kwargs, time.monotonic() + seconds)
+    _watchdog.watch(job)
+    _pool.submit(_run_job, job)
+    if not job.done_event.wait(seconds) and not job.finished:
+        raise TIMEOUT_EXCEPTION(f'{func.__name__}运行时间超过{seconds}秒')
+    job.done_event.wait()  # 刚好在截止时间完成的情况，等待结果写入
+    if job.exception is not None:
+        if isinstance(job.exception, _WatchdogInterrupt):
+            raise TIMEOUT_EXCEPTION(f'{func.__name__}运行时间超过{seconds}秒')
+        raise job.exception
+    return job.result
+
+
+def timeout(seconds: float, isolation='thread'):
     """超时装饰器，指定超时时间
 
-    若被装饰的方法在指定的时间内未返回，则抛出Timeout异常"""
+    若被装饰的方法在指定的时间内未返回，则抛出Timeout异常。
+    :param isolation: 'thread' 函数在复用的线程池里面运行，由一个全局的看门狗线程在截止时间中断它，不会拖慢函数本身的运行。
+                      卡在C扩展或者阻塞的系统调用里面的函数，要等它回到python代码才能被中断，但调用方仍然会准时收到超时异常。
+                      'process' 函数在预先启动的常驻进程池里面运行，超时就杀掉那个进程并在后台补一个新的，能可靠中断任何代码。
+                      被装饰的函数必须是模块级别的函数，参数和返回值必须能pickle。"""
+    if isolation not in ('thread', 'process'):
+        raise ValueError("isolation参数必须设置为 'thread' 或者 'process'")
 
     def timeout_decorator(func):
+        if isolation == 'process':
+            @functools.wraps(func)
+            def _(*args, **kwargs):
+                # process_pool 依赖本模块的 TIMEOUT_EXCEPTION ，调用时才导入，避免两个模块谁先导入都会循环导入
+                from . import process_pool
+                if process_pool.in_worker():
+                    return func(*args, **kwargs)
+                return process_pool.get_default_pool().call(process_pool._FunctionRef(func), args, kwargs, seconds)
 
-        def _new_func(oldfunc, result, oldfunc_args, oldfunc_kwargs):
-            result.append(oldfunc(*oldfunc_args, **oldfunc_kwargs))
+            _.__process_isolated__ = True
+            return _
 
+        @functools.wraps(func)
         def _(*args, **kwargs):
-            result = []
-            new_kwargs = {
-                'oldfunc': func,
-                'result': result,
-                'oldfunc_args': args,
-                'oldfunc_kwargs': kwargs
-            }
-
-            thd = __KThread(target=_new_func, args=(), kwargs=new_kwargs)
-            thd.start()
-            thd.join(seconds)
-            alive = thd.isAlive()
-            thd.kill()  # kill the child thread
-
-            if alive:
-                # raise TIMEOUT_EXCEPTION('function run too long, timeout %d seconds.' % seconds)
-                raise TIMEOUT_EXCEPTION(f'{func.__name__}运行时间超过{seconds}秒')
-            else:
-                if result:
-                    return result[0]
-                return result
-
-        _.__name__ = func.__name__
-        _.__doc__ = func.__doc__
+            return run_with_watchdog(func, args, kwargs, seconds)
+
         return _
 
     return timeout_decorator
 
 
+class _ItimerTimeout(BaseException):
+    """
+    SIGALRM处理函数抛出的异常，带上是哪一层timeout_linux到期了。
+    继承BaseException，免得外层的超时在穿过内层函数时被 except TimeoutError 、 except Exception 吞掉，
+    到期的那一层再把它转换成TimeoutError。
+    """
+
+    def __init__(self, entry):
+        BaseException.__init__(self, 'timeout_linux deadline expired')
+        self.entry = entry
+
+
+class _ItimerEntry:
+    __slots__ = ('deadline', 'fired')
+
+    def __init__(self, deadline):
+        self.deadline = deadline
+        self.fired = False
 
 
-def timeout_linux(timeout: int):
+_itimer_stack = []  # 主线程里面正在运行的timeout_linux的截止时间，外层在前
+_itimer_saved = None  # 最外层进入之前的 (信号处理函数, 定时器剩余秒数, 定时器间隔, 保存的时间点)
+_itimer_critical = False  # 主线程正在修改定时器栈和信号处理器，这时不能抛超时异常
+
+
+def _itimer_arm():
+    pending = [e.deadline for e in _itimer_stack if not e.fired]
+    if pending:
+        signal.setitimer(signal.ITIMER_REAL, max(min(pending) - time.monotonic(), 1e-6))
+
+
+def _itimer_handler(signum, frame):
+    if _itimer_critical:  # 屏蔽SIGALRM之前已经收到、还没来得及运行的信号，修改完之后会重新设置定时器
+        return
+    now = time.monotonic()
+    expired = [e for e in _itimer_stack if not e.fired and e.deadline <= now]
+    if not expired:  # 定时器精度导致提前一点点触发
+        _itimer_arm()
+        return
+    entry = min(expired, key=lambda e: e.deadline)  # 同样的截止时间取最外层
+    entry.fired = True
+    raise _ItimerTimeout(entry)
+
+
+def timeout_linux(timeout: float):
     """
     这个不需要单独开一个线程来实现超时,但是只适合linux系统,windwos没有 signal.SIGALRM
+    用 signal.setitimer 实现，支持小数秒例如0.25秒。嵌套调用时每一层都按自己的截止时间超时，
+    内层结束后外层的定时器会恢复，进入之前已经存在的 signal.alarm / setitimer 定时器也会在最外层结束后按剩余时间恢复。
+    在非主线程中调用时不能使用信号，自动改用 timeout 装饰器的看门狗方式，超时同样抛出TimeoutError。
     """
     def _timeout_linux(func, ):
         """装饰器，为函数添加超时功能"""
 
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
-            def _timeout_handler(signum, frame):
-                """超时处理函数，当接收到信号时抛出异常"""
-                raise TimeoutError(f"Function: {func} params: {args}, {kwargs} ,execution timed out: {timeout}")
-
-            # 设置超时信号处理器
-            signal.signal(signal.SIGALRM, _timeout_handler)  # 只适合linux 的 timout
-            # 启动一个定时器，超时后发送信号
-            signal.alarm(timeout)
+            global _itimer_saved, _itimer_critical
+            if threading.current_thread() is not threading.main_thread():
+                try:
+                    return run_with_watchdog(func, args, kwargs, timeout)
+                except TIMEOUT_EXCEPTION:
+                    raise TimeoutError(f"Function: {func} params: {args}, {kwargs} ,execution timed out: {timeout}")
 
+            # 修改定时器栈和信号处理器期间屏蔽SIGALRM，免得外层的超时异常在修改到一半时抛出，栈和处理器没有恢复
+            _itimer_critical = True
+            old_mask = signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGALRM})
+            entry = _ItimerEntry(time.monotonic() + timeout)
+            if not _itimer_stack:
+                # 设置超时信号处理器，保存之前的处理器和定时器
+                prev_handler = signal.signal(signal.SIGALRM, _itimer_handler)  # 只适合linux 的 timout
+                prev_delay, prev_interval = signal.setitimer(signal.ITIMER_REAL, 0)
+                _itimer_saved = (prev_handler, prev_delay, prev_interval, time.monotonic())
+            _itimer_stack.append(entry)
+            _itimer_arm()
+            propagating = False
             try:
-                return func(*args, **kwargs)
+                _itimer_critical = False
+                signal.pthread_sigmask(signal.SIG_SETMASK, old_mask)
+                result = func(*args, **kwargs)
+            except _ItimerTimeout as e:
+                propagating = True
+                if e.entry is entry:
+                    raise TimeoutError(f"Function: {func} params: {args}, {kwargs} ,execution timed out: {timeout}")
+                raise  # 外层的截止时间到了，继续往外抛给外层
             finally:
-                # 执行完毕记得取消定时器
-                signal.alarm(0)  # 关闭定时器
+                # 执行完毕记得取消定时器，再按剩下的截止时间恢复外层的定时器
+                _itimer_critical = True
+                signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGALRM})
+                signal.setitimer(signal.ITIMER_REAL, 0)
+                _itimer_stack.remove(entry)
+                if _itimer_stack:
+                    _itimer_arm()
+                else:
+                    prev_handler, prev_delay, prev_interval, saved_at = _itimer_saved
+                    _itimer_saved = None
+                    signal.signal(signal.SIGALRM, prev_handler if prev_handler is not None else signal.SIG_DFL)
+                    if prev_delay > 0:
+                        signal.setitimer(signal.ITIMER_REAL, max(prev_delay - (time.monotonic() - saved_at), 1e-6),
+                                         prev_interval)
+                _itimer_critical = False
+                signal.pthread_sigmask(signal.SIG_SETMASK, old_mask)
+                if not propagating:
+                    # 外层已经到期的超时异常被函数里面的 except BaseException 或者裸except吞掉了，重新抛给外层
+                    swallowed = next((e for e in _itimer_stack if e.fired), None)
+                    if swallowed is not None:
+                        raise _ItimerTimeout(swallowed)
+            if entry.fired:  # 本层的超时异常被函数自己吞掉了
+                raise TimeoutError(f"Function: {func} params: {args}, {kwargs} ,execution timed out: {timeout}")
+            return result
 
         return wrapper
 
     return _timeout_linux
 
 
+@timeout(0.5, isolation='process')
+def _test_sleep_in_process(seconds):
+    time.sleep(seconds)
+    return seconds
+
+
+class _Test(unittest.TestCase):
+    def test_timeout(self):
+        progress = []
+
+        @timeout(0.2)
+        def f(n):
+            for i in range(n):
+                progress.append(i)
+                time.sleep(0.01)
+            return n
+
+        self.assertEqual(f(3), 3)
+        t0 = time.monotonic()
+        with self.assertRaises(TIMEOUT_EXCEPTION):
+            f(1000)
+        self.assertLess(time.monotonic() - t0, 0.5)
+        time.sleep(0.1)
+        count = len(progress)
+        time.sleep(0.1)
+        self.assertEqual(len(progress), count)  # 超时的函数已经被看门狗中断，不会继续运行
+
+    def test_exception_and_thread_reuse(self):
+        @timeout(1)
+        def f(x):
+            if x < 0:
+                raise ValueError(x)
+            return threading.get_ident()
+
+        with self.assertRaises(ValueError):
+            f(-1)
+        self.assertLess(len({f(1) for _ in range(20)}), 5)  # 线程被复用，而不是每次调用新开一个线程
+
+    def test_interrupt_lands_inside_disarm(self):
+        """看门狗注入的异常落在disarm标记完成之前，disarm重新做完，堆的计数不会乱"""
+        job = _TimeoutJob(lambda: 1, (), {}, time.monotonic() + 10)
+        real_disarm = _watchdog.disarm
+        calls = []
+
+        def _late_interrupt(j):
+            calls.append(j)
+            if len(calls) == 1:
+                raise _WatchdogInterrupt()
+            real_disarm(j)
+
+        finished_before = _watchdog._finished_in_heap
+        _watchdog.disarm = _late_interrupt
+        try:
+            _run_job(job)
+        finally:
+            del _watchdog.disarm
+        self.assertEqual(len(calls), 2)
+        self.assertTrue(job.finished)
+        self.assertEqual(job.result, 1)
+        self.assertIsNone(job.exception)
+        self.assertEqual(_watchdog._finished_in_heap, finished_before + 1)
+        self.assertTrue(job.done_event.is_set())
+
+    def test_job_expired_before_start(self):
+        """线程开始运行之前看门狗就到期了，函数不再运行，不会一直占着线程"""
+        calls = []
+        job = _TimeoutJob(calls.append, (1,), {}, time.monotonic())
+        _watchdog._interrupt(job)
+        _run_job(job)
+        self.assertEqual(calls, [])
+        self.assertIsInstance(job.exception, _WatchdogInterrupt)
+        self.assertTrue(job.done_event.is_set())
+
+    def test_timeout_process_isolation(self):
+        self.assertEqual(_test_sleep_in_process(0), 0)
+        t0 = time.monotonic()
+        with self.assertRaises(TIMEOUT_EXCEPTION):
+            _test_sleep_in_process(5)  # time.sleep阻塞在系统调用里面，线程方式中断不了，进程方式直接杀掉
+        self.assertLess(time.monotonic() - t0, 1)
+        self.assertEqual(_test_sleep_in_process(0.01), 0.01)
+
+    def test_timeout_linux_nested(self):
+        @timeout_linux(0.25)
+        def inner(seconds):
+            time.sleep(seconds)
+            return 'inner'
+
+        @timeout_linux(0.6)
+        def outer(inner_seconds, outer_seconds):
+            try:
+                inner(inner_seconds)
+            except TimeoutError:
+                pass
+            time.sleep(outer_seconds)
+            return 'outer'
+
+        t0 = time.monotonic()
+        self.assertEqual(outer(1, 0.2), 'outer')  # 内层0.25秒超时，外层剩下的预算足够
+        self.assertLess(time.monotonic() - t0, 0.55)
+        t0 = time.monotonic()
+        with self.assertRaises(TimeoutError):
+            outer(0.1, 1)  # 内层正常返回之后，外层的定时器恢复并在0.6秒超时
+        self.assertLess(abs(time.monotonic() - t0 - 0.6), 0.1)
+        self.assertEqual(signal.getitimer(signal.ITIMER_REAL), (0.0, 0.0))
+
+    def test_timeout_linux_swallowed(self):
+        """函数吞掉了超时异常，外层仍然按自己的截止时间超时"""
+        swallowed = []
+
+        def _busy(seconds):
+            end = time.monotonic() + seconds
+            while time.monotonic() < end:
+                try:
+                    time.sleep(0.01)
+                except TimeoutError:
+                    swallowed.append('TimeoutError')
+                except BaseException:  # noqa
+                    swallowed.append('BaseException')
+
+        @timeout_linux(5)
+        def inner():
+            _busy(0.4)
+            return 'inner'
+
+        @timeout_linux(0.2)
+        def outer():
+            inner()
+            time.sleep(2)
+            return 'outer'
+
+        t0 = time.monotonic()
+        with self.assertRaises(TimeoutError):
+            outer()
+        self.assertLess(time.monotonic() - t0, 1)
+        self.assertEqual(swallowed, ['BaseException'])  # except TimeoutError 不会捕获内部的超时异常
+
+        @timeout_linux(0.1)
+        def swallow_own():
+            _busy(0.3)
+            return 'done'
+
+        with self.assertRaises(TimeoutError):
+            swallow_own()
+
+    def test_timeout_linux_critical_section(self):
+        """修改定时器栈期间晚到的信号不抛异常，调用结束后SIGALRM不再被屏蔽"""
+        global _itimer_critical
+        entry = _ItimerEntry(time.monotonic() - 1)
+        _itimer_stack.append(entry)
+        _itimer_critical = True
+        try:
+            _itimer_handler(signal.SIGALRM, None)
+        finally:
+            _itimer_critical = False
+            _itimer_stack.remove(entry)
+        self.assertFalse(entry.fired)
+
+        @timeout_linux(0.05)
+        def f(seconds):
+            time.sleep(seconds)
+
+        f(0)
+        with self.assertRaises(TimeoutError):
+            f(1)
+        self.assertNotIn(signal.SIGALRM, signal.pthread_sigmask(signal.SIG_BLOCK, []))
+        self.assertEqual(_itimer_stack, [])
+        self.assertIsNot(signal.getsignal(signal.SIGALRM), _itimer_handler)
+
+    def test_timeout_linux_restore_outer_alarm(self):
+        fired = []
+        old_handler = signal.signal(signal.SIGALRM, lambda signum, frame: fired.append(signum))
+        try:
+            signal.setitimer(signal.ITIMER_REAL, 0.3)
+            timeout_linux(1)(time.sleep)(0.1)
+            self.assertGreater(signal.getitimer(signal.ITIMER_REAL)[0], 0.1)
+            time.sleep(0.3)
+            self.assertEqual(fired, [signal.SIGALRM])
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, old_handler)
+
+    def test_timeout_linux_in_thread(self):
+        errors = []
+
+        @timeout_linux(0.2)
+        def f():
+            for _ in range(100):
+                time.sleep(0.01)
+
+        def run():
+            try:
+                f()
+            except TimeoutError as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join()
+        self.assertEqual(len(errors), 1)
+
+
 if __name__ == '__main__':
     @timeout(3)
     def f(time_to_be_sleep):
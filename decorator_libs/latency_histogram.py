@@ -0,0 +1,187 @@
+# coding=utf-8
+"""
+耗时直方图，给 timer 装饰器记录函数耗时用，每次调用只是给一个桶计数加一，不写日志。
+桶是HDR风格的对数桶，每个2的幂次区间再等分成16份，相对误差不超过1/16，纳秒到几百年都能表示，内存固定。
+每个线程记录到自己的分片里面，记录时不加锁，统计时再把各个分片合并起来。
+"""
+import threading
+import time
+import unittest
+
+_SUB_BITS = 4
+_SUB_COUNT = 1 << _SUB_BITS  # 每个2的幂次区间等分成多少个桶
+_N_BUCKETS = (64 - _SUB_BITS) * _SUB_COUNT + 2 * _SUB_COUNT
+
+
+def bucket_index(value):
+    """纳秒数对应的桶序号，小于32的值每个值一个桶"""
+    if value < 2 * _SUB_COUNT:
+        return value if value > 0 else 0
+    shift = value.bit_length() - _SUB_BITS - 1
+    return (shift + 1) * _SUB_COUNT + (value >> shift) - _SUB_COUNT
+
+
+def bucket_upper_bound(index):
+    """桶能表示的最大纳秒数，统计分位数时用桶的上界，宁可高估也不低估耗时"""
+    if index < 2 * _SUB_COUNT:
+        return index
+    shift = index // _SUB_COUNT - 1
+    mantissa = index % _SUB_COUNT + _SUB_COUNT
+    return ((mantissa + 1) << shift) - 1
+
+
+class _Shard:
+    __slots__ = ('counts', 'count', 'total', 'max', 'min', 'thread')
+
+    def __init__(self, thread=None):
+        self.thread = thread
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * _N_BUCKETS
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.min = None
+
+    def merge_into(self, other):
+        counts = other.counts
+        for i, c in enumerate(self.counts):
+            if c:
+                counts[i] += c
+        other.count += self.count
+        other.total += self.total
+        other.max = max(other.max, self.max)
+        if self.min is not None:
+            other.min = self.min if other.min is None else min(other.min, self.min)
+
+
+class LatencyHistogram:
+    """
+    线程安全的耗时直方图，单位纳秒。
+    """
+
+    def __init__(self, name=''):
+        self.name = name
+        self._local = threading.local()
+        self._shards = []
+        self._retired = _Shard()  # 已经结束的线程的分片合并到这里，免得分片越来越多
+        self._lock = threading.Lock()
+        self.started_at = time.time()
+
+    def _new_shard(self):
+        shard = _Shard(threading.current_thread())
+        with self._lock:
+            self._shards.append(shard)
+        self._local.shard = shard
+        return shard
+
+    def record(self, nanoseconds):
+        try:
+            shard = self._local.shard
+        except AttributeError:
+            shard = self._new_shard()
+        shard.counts[bucket_index(nanoseconds)] += 1
+        shard.count += 1
+        shard.total += nanoseconds
+        if nanoseconds > shard.max:
+            shard.max = nanoseconds
+        if shard.min is None or nanoseconds < shard.min:
+            shard.min = nanoseconds
+
+    def _merged(self, reset=False):
+        merged = _Shard()
+        with self._lock:
+            alive = []
+            for shard in self._shards:
+                if shard.thread.is_alive():
+                    alive.append(shard)
+                else:
+                    shard.merge_into(self._retired)
+            self._shards = alive
+            self._retired.merge_into(merged)
+            if reset:
+                self._retired.reset()
+            for shard in alive:
+                shard.merge_into(merged)
+                if reset:
+                    shard.reset()
+            if reset:
+                self.started_at = time.time()
+        return merged
+
+    def reset(self):
+        self._merged(reset=True)
+
+    def snapshot(self, reset=False, percentiles=(50, 90, 99, 99.9)):
+        """
+        返回统计结果，耗时单位是毫秒
+        :param reset: 是否同时清零，用来按时间窗口统计
+        :param percentiles: 需要计算哪些分位数
+        """
+        started_at = self.started_at
+        merged = self._merged(reset)
+        result = {'name': self.name, 'count': merged.count, 'since': started_at,
+                  'mean_ms': merged.total / merged.count / 1e6 if merged.count else None,
+                  'min_ms': merged.min / 1e6 if merged.min is not None else None,
+                  'max_ms': merged.max / 1e6 if merged.count else None}
+        targets = sorted((p, max(int(merged.count * p / 100 + 0.999999), 1)) for p in percentiles)
+        cumulative = 0
+        t = 0
+        for i, c in enumerate(merged.counts):
+            if not c:
+                continue
+            cumulative += c
+            while t < len(targets) and cumulative >= targets[t][1]:
+                # 桶的上界不会超过实际的最大值
+                result[f'p{targets[t][0]:g}_ms'] = min(bucket_upper_bound(i), merged.max) / 1e6
+                t += 1
+            if t == len(targets):
+                break
+        for p, _ in targets[t:]:
+            result[f'p{p:g}_ms'] = None
+        return result
+
+
+class _Test(unittest.TestCase):
+    def test_bucket_error_bound(self):
+        for value in list(range(100)) + [10 ** k + 7 for k in range(2, 15)]:
+            index = bucket_index(value)
+            upper = bucket_upper_bound(index)
+            self.assertLessEqual(value, upper)
+            self.assertLessEqual(upper - value, value / _SUB_COUNT + 1)
+            if index:
+                self.assertLess(bucket_upper_bound(index - 1), value)
+
+    def test_percentiles(self):
+        histogram = LatencyHistogram('test')
+        for ms in range(1, 101):
+            histogram.record(ms * 1000000)
+        snapshot = histogram.snapshot()
+        self.assertEqual(snapshot['count'], 100)
+        self.assertEqual(snapshot['max_ms'], 100)
+        self.assertEqual(snapshot['min_ms'], 1)
+        self.assertAlmostEqual(snapshot['p50_ms'], 50, delta=50 / 16)
+        self.assertAlmostEqual(snapshot['p99_ms'], 99, delta=99 / 16)
+        self.assertEqual(histogram.snapshot(reset=True)['count'], 100)
+        self.assertEqual(histogram.snapshot()['count'], 0)
+        self.assertIsNone(histogram.snapshot()['p50_ms'])
+
+    def test_threads(self):
+        histogram = LatencyHistogram('test')
+
+        def _record():
+            for i in range(1000):
+                histogram.record(i)
+
+        threads = [threading.Thread(target=_record) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(histogram.snapshot()['count'], 8000)
+        self.assertEqual(len(histogram._shards), 0)  # 结束的线程的分片已经合并
+
+
+if __name__ == '__main__':
+    unittest.main()
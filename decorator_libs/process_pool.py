@@ -0,0 +1,620 @@
+# coding=utf-8
+"""
+预先启动的常驻进程池。
+任务通过每个进程各自的管道发过去，超时的进程直接杀掉，后台补一个新进程，可以可靠地中断卡在C扩展或者阻塞系统调用里面的函数。
+大的bytes和numpy数组参数、结果通过共享内存传递，不走管道复制。
+submit 返回 concurrent.futures.Future ， map 自动把任务分块，减少每个任务单独pickle和收发的开销。
+"""
+import atexit
+import importlib
+import math
+import multiprocessing
+import os
+import pickle
+import queue
+import sys
+import threading
+import time
+import traceback
+import unittest
+from concurrent.futures import Executor, Future
+from multiprocessing import resource_tracker, shared_memory
+
+from .function_timeout_decorators import TIMEOUT_EXCEPTION
+from .thread_pool import BoundedThreadPoolExecutor
+
+_in_worker = False
+
+
+def in_worker():
+    """当前是否在进程池的工作进程里面运行"""
+    return _in_worker
+
+
+class WorkerCrashedError(Exception):
+    """工作进程在运行函数的过程中意外退出了，例如C扩展段错误"""
+
+
+class _FunctionRef:
+    """
+    被装饰的函数本身不能按引用pickle，因为模块里面同名的属性是装饰之后的函数，所以只传模块名和限定名，
+    在工作进程里面找到装饰后的函数，再沿着 __wrapped__ 找到标记了 __process_isolated__ 的那一层装饰器包住的原函数。
+    """
+    __slots__ = ('module', 'qualname')
+
+    def __init__(self, func):
+        self.module = func.__module__
+        self.qualname = func.__qualname__
+
+    def __getstate__(self):
+        return self.module, self.qualname
+
+    def __setstate__(self, state):
+        self.module, self.qualname = state
+
+    def resolve(self):
+        obj = importlib.import_module(self.module)
+        for name in self.qualname.split('.'):
+            obj = getattr(obj, name)
+        outer = obj
+        while obj is not None and not getattr(obj, '__process_isolated__', False):
+            obj = getattr(obj, '__wrapped__', None)
+        return obj.__wrapped__ if obj is not None else outer
+
+
+def _func_name(fn):
+    return getattr(fn, 'qualname', None) or getattr(fn, '__name__', None) or repr(fn)
+
+
+def _is_ndarray(obj):
+    return type(obj).__name__ == 'ndarray' and type(obj).__module__ == 'numpy'
+
+
+def _shm_size(obj, shm_threshold):
+    """对象适合走共享内存时返回字节数，否则返回None"""
+    if shm_threshold is None:
+        return None
+    tp = type(obj)
+    if tp is bytes or tp is bytearray:
+        size = len(obj)
+    elif _is_ndarray(obj) and obj.dtype.hasobject is False:
+        size = obj.nbytes
+    else:
+        return None
+    return size if size >= shm_threshold and size > 0 else None
+
+
+if sys.version_info >= (3, 13):
+    def _open_shm(name=None, create=False, size=0):
+        return shared_memory.SharedMemory(name, create, size, track=False)
+
+    def _unlink_shm(shm):
+        shm.unlink()
+else:
+    if os.name == 'posix':
+        import _posixshmem
+
+    def _open_shm(name=None, create=False, size=0):
+        """
+        3.13之前不管是创建还是打开别的进程创建的共享内存，都会登记到当前进程的resource_tracker，
+        进程退出时会误报泄漏并且重复删除。共享内存的生命周期由进程池自己管理，所以打开之后立即取消登记。
+        """
+        shm = shared_memory.SharedMemory(name, create, size)
+        if os.name == 'posix':
+            resource_tracker.unregister(shm._name, 'shared_memory')  # noqa
+        return shm
+
+    def _unlink_shm(shm):
+        if os.name == 'posix':  # shm.unlink() 会再取消登记一次，resource_tracker 会报错
+            _posixshmem.shm_unlink(shm._name)  # noqa
+
+
+def _new_result_shm_name():
+    """结果的共享内存名字由调用方生成，工作进程被杀掉时调用方也知道要删除哪一块"""
+    return f'dlpr_{os.urandom(8).hex()}'
+
+
+class _ShmRef:
+    """放在共享内存里面的bytes或者numpy数组，只通过管道传名字和形状"""
+    __slots__ = ('name', 'size', 'dtype', 'shape')
+
+    def __init__(self, name, size, dtype=None, shape=None):
+        self.name = name
+        self.size = size
+        self.dtype = dtype
+        self.shape = shape
+
+    def __getstate__(self):
+        return self.name, self.size, self.dtype, self.shape
+
+    def __setstate__(self, state):
+        self.name, self.size, self.dtype, self.shape = state
+
+    @classmethod
+    def create(cls, obj, size, name=None):
+        shm = _open_shm(name, create=True, size=size)
+        try:
+            if _is_ndarray(obj):
+                import numpy
+                numpy.ndarray(obj.shape, obj.dtype, buffer=shm.buf)[...] = obj
+                return cls(shm.name, size, obj.dtype.str, obj.shape)
+            shm.buf[:size] = obj
+            return cls(shm.name, size)
+        finally:
+            shm.close()
+
+    def load(self, unlink):
+        shm = _open_shm(self.name)
+        try:
+            if self.dtype is not None:
+                import numpy
+                return numpy.ndarray(self.shape, self.dtype, buffer=shm.buf).copy()
+            return bytes(shm.buf[:self.size])
+        finally:
+            shm.close()
+            if unlink:
+                _unlink_shm(shm)
+
+    def unlink(self):
+        try:
+            shm = _open_shm(self.name)
+        except FileNotFoundError:
+            return
+        shm.close()
+        _unlink_shm(shm)
+
+
+def _pack_args(args, kwargs, shm_threshold):
+    """把顶层的大bytes和numpy数组参数放进共享内存，返回新的参数和需要调用方在调用结束后释放的共享内存"""
+    refs = []
+
+    def _pack(value):
+        size = _shm_size(value, shm_threshold)
+        if size is None:
+            return value
+        ref = _ShmRef.create(value, size)
+        refs.append(ref)
+        return ref
+
+    if shm_threshold is not None:
+        args = tuple(_pack(v) for v in args)
+        kwargs = {k: _pack(v) for k, v in kwargs.items()}
+    return args, kwargs, refs
+
+
+def _unpack_args(args, kwargs):
+    args = tuple(v.load(unlink=False) if isinstance(v, _ShmRef) else v for v in args)
+    kwargs = {k: v.load(unlink=False) if isinstance(v, _ShmRef) else v for k, v in kwargs.items()}
+    return args, kwargs
+
+
+def _pack_result(result, shm_threshold, shm_name):
+    size = _shm_size(result, shm_threshold)
+    if size is not None:
+        return 'shm', _ShmRef.create(result, size, shm_name)
+    return 'obj', result
+
+
+def _unpack_result(kind, payload):
+    if kind == 'shm':
+        return payload.load(unlink=True)
+    return payload
+
+
+def _run_chunk(fn, chunk):
+    """map分块时在工作进程里面运行一块任务"""
+    if isinstance(fn, _FunctionRef):
+        fn = fn.resolve()
+    return [fn(*item) for item in chunk]
+
+
+def _worker_main(conn, shm_threshold):
+    global _in_worker
+    _in_worker = True
+    while True:
+        try:
+            task = conn.recv()
+        except (EOFError, OSError):
+            return
+        if task is None:
+            return
+        fn, args, kwargs, result_shm_name = task
+        try:
+            if isinstance(fn, _FunctionRef):
+                fn = fn.resolve()
+            args, kwargs = _unpack_args(args, kwargs)
+            kind, payload = _pack_result(fn(*args, **kwargs), shm_threshold, result_shm_name)
+            message = (True, kind, payload)
+        except BaseException as e:  # noqa
+            message = (False, 'obj', e)
+        try:
+            conn.send(message)
+        except Exception as e:  # 结果或者异常不能pickle
+            conn.send((False, 'obj', RuntimeError(f'结果不能序列化 {e!r}\n{traceback.format_exc()}')))
+
+
+class _Worker:
+    __slots__ = ('process', 'conn')
+
+    def __init__(self, process, conn):
+        self.process = process
+        self.conn = conn
+
+
+def _default_mp_context():
+    """
+    工作进程被杀掉之后在后台线程里面补充，这时调度器、线程池这些线程可能正在运行，在多线程的进程里面fork，
+    子进程可能继承一把正被别的线程持有的锁而死锁，所以常驻进程池默认不直接fork，而是用forkserver，不支持时用spawn。
+    """
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
+
+
+class WarmProcessPool(Executor):
+    """
+    常驻进程池，进程启动一次反复使用，不需要每次调用都创建新进程。
+    调用超时时杀掉正在运行的那个进程并在后台补一个新进程，调用方立即收到 TIMEOUT_EXCEPTION 。
+    兼容 concurrent.futures.Executor 的接口，submit 返回Future。
+    工作进程默认由forkserver启动，和spawn一样，启动进程池的主脚本要放在 if __name__ == '__main__': 里面。
+    """
+
+    def __init__(self, processes=None, shm_threshold=1024 * 1024, mp_context=None):
+        """
+        :param processes: 进程数量，默认cpu核数
+        :param shm_threshold: 顶层的bytes、bytearray、numpy数组参数和结果大于等于这个字节数时通过共享内存传递，None为不使用共享内存
+        :param mp_context: multiprocessing的上下文，默认用forkserver，不支持forkserver的系统用spawn
+        """
+        self.processes = processes or os.cpu_count() or 1
+        self.shm_threshold = shm_threshold
+        self._ctx = mp_context or _default_mp_context()
+        self._idle = queue.Queue()
+        self._workers = set()
+        self._lock = threading.Lock()
+        self._closed = False
+        self._dispatcher = None
+        for _ in range(self.processes):
+            self._idle.put(self._spawn())
+
+    def _spawn(self):
+        parent_conn, child_conn = self._ctx.Pipe()
+        process = self._ctx.Process(target=_worker_main, args=(child_conn, self.shm_threshold), daemon=True,
+                                    name='WarmProcessPoolWorker')
+        process.start()
+        child_conn.close()
+        worker = _Worker(process, parent_conn)
+        with self._lock:
+            self._workers.add(worker)
+        return worker
+
+    def _discard(self, worker):
+        with self._lock:
+            self._workers.discard(worker)
+        if worker.process.is_alive():
+            worker.process.kill()
+        worker.process.join()
+        worker.conn.close()
+
+    def _replace_in_background(self, worker, result_shm_name):
+        """
+        杀掉进程并补一个新的，放到后台线程做，调用方不用等待进程退出和新进程启动。
+        进程可能在被杀掉之前已经把结果放进了共享内存，进程退出之后删除掉。
+        """
+
+        def _replace():
+            self._discard(worker)
+            _ShmRef(result_shm_name, 0).unlink()
+            if not self._closed:
+                self._idle.put(self._spawn())
+
+        threading.Thread(target=_replace, daemon=True).start()
+
+    def call(self, fn, args=(), kwargs=None, timeout=None):
+        """
+        在工作进程里面运行 fn(*args, **kwargs) 并返回结果
+        :param timeout: 从调用开始算起的超时秒数，包括等待空闲进程的时间，None为不超时
+        """
+        if self._closed:
+            raise RuntimeError('进程池已经关闭')
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            worker = self._idle.get(timeout=timeout)
+        except queue.Empty:
+            raise TIMEOUT_EXCEPTION(f'{_func_name(fn)} 等待空闲进程超过{timeout}秒')
+        shm_refs = []
+        result_shm_name = _new_result_shm_name()
+        try:
+            try:
+                args, kwargs, shm_refs = _pack_args(args, kwargs or {}, self.shm_threshold)
+                worker.conn.send((fn, args, kwargs, result_shm_name))
+            except BaseException:  # 参数不能pickle，进程没有收到任务，可以继续使用
+                self._idle.put(worker)
+                raise
+            try:
+                ready = worker.conn.poll(None if deadline is None else max(deadline - time.monotonic(), 0))
+                if not ready:
+                    self._replace_in_background(worker, result_shm_name)
+                    raise TIMEOUT_EXCEPTION(f'{_func_name(fn)}运行时间超过{timeout}秒')
+                ok, kind, payload = worker.conn.recv()
+            except (EOFError, OSError):
+                self._replace_in_background(worker, result_shm_name)
+                raise WorkerCrashedError(f'运行 {_func_name(fn)} 的进程 {worker.process.pid} 意外退出了, '
+                                         f'exitcode {worker.process.exitcode}')
+        finally:
+            for ref in shm_refs:
+                ref.unlink()
+        self._idle.put(worker)
+        if not ok:
+            raise payload
+        return _unpack_result(kind, payload)
+
+    def _get_dispatcher(self):
+        """每个进程对应一个分发线程，分发线程阻塞在call上等待结果"""
+        if self._dispatcher is None:
+            with self._lock:
+                if self._dispatcher is None:
+                    self._dispatcher = BoundedThreadPoolExecutor(
+                        self.processes, thread_name_prefix='WarmProcessPoolDispatcher', log_exceptions=False)
+        return self._dispatcher
+
+    def submit_with_timeout(self, fn, args=(), kwargs=None, timeout=None):
+        """和submit一样返回Future，可以指定超时"""
+        if self._closed:
+            raise RuntimeError('进程池已经关闭')
+        return self._get_dispatcher().submit(self.call, fn, args, kwargs, timeout)
+
+    def submit(self, fn, /, *args, **kwargs):
+        return self.submit_with_timeout(fn, args, kwargs)
+
+    def map(self, fn, *iterables, timeout=None, chunksize=None):
+        """
+        和 Executor.map 一样按顺序返回结果的迭代器。任务分块发给工作进程，每块只pickle和收发一次。
+        :param timeout: 每一块的超时秒数
+        :param chunksize: 每块的任务数量，默认分成进程数的4倍那么多块
+        """
+        items = list(zip(*iterables))
+        if not items:
+            return iter(())
+        if chunksize is None:
+            chunksize = math.ceil(len(items) / (self.processes * 4))
+        chunksize = max(int(chunksize), 1)
+        futures = [self.submit_with_timeout(_run_chunk, (fn, items[i:i + chunksize]), timeout=timeout)
+                   for i in range(0, len(items), chunksize)]
+
+        def _results():
+            try:
+                for future in futures:
+                    yield from future.result()
+            finally:
+                for future in futures:
+                    future.cancel()
+
+        return _results()
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        self._closed = True
+        if self._dispatcher is not None:
+            self._dispatcher.shutdown(wait=False, cancel_futures=cancel_futures)
+        with self._lock:
+            workers = list(self._workers)
+        for worker in workers:
+            try:
+                worker.conn.send(None)
+            except OSError:
+                pass
+            worker.process.join(1)
+            self._discard(worker)
+
+
+def _forked_main(conn, fn, args, kwargs):
+    global _in_worker
+    _in_worker = True
+    try:
+        message = (True, fn(*args, **kwargs))
+    except BaseException as e:  # noqa
+        message = (False, e)
+    try:
+        conn.send(message)
+    except Exception as e:  # 结果或者异常不能pickle
+        conn.send((False, RuntimeError(f'结果不能序列化 {e!r}\n{traceback.format_exc()}')))
+    conn.close()
+
+
+class ForkExecutor(Executor):
+    """
+    每次提交都fork一个新进程运行，函数和参数由子进程直接继承，不需要pickle，所以lambda、闭包也能运行，只有结果需要能pickle。
+    给不能按名字pickle、没法发给常驻进程池的函数做后备，只能在支持fork的系统上使用。
+    """
+
+    def __init__(self, processes=None):
+        """
+        :param processes: map 把任务分成多少块，每块fork一个进程，默认和默认进程池的进程数一样
+        """
+        if 'fork' not in multiprocessing.get_all_start_methods():
+            raise RuntimeError('当前系统不支持fork，不能pickle的函数(lambda、闭包等)不能在子进程中运行，请改成模块级别的函数')
+        self.processes = processes or default_pool_size()
+        self._ctx = multiprocessing.get_context('fork')
+
+    def submit(self, fn, /, *args, **kwargs):
+        future = Future()
+        parent_conn, child_conn = self._ctx.Pipe(duplex=False)
+        process = self._ctx.Process(target=_forked_main, args=(child_conn, fn, args, kwargs))
+        process.start()
+        child_conn.close()
+        future.set_running_or_notify_cancel()
+
+        def _wait():
+            try:
+                ok, payload = parent_conn.recv()
+            except (EOFError, OSError):
+                process.join()
+                ok, payload = False, WorkerCrashedError(
+                    f'运行 {_func_name(fn)} 的进程意外退出了，退出码 {process.exitcode}')
+            finally:
+                parent_conn.close()
+            process.join()
+            if ok:
+                future.set_result(payload)
+            else:
+                future.set_exception(payload)
+
+        threading.Thread(target=_wait, daemon=True, name='ForkExecutorWaiter').start()
+        return future
+
+    def map(self, fn, *iterables, timeout=None, chunksize=None):
+        """
+        和 Executor.map 一样按顺序返回结果的迭代器，任务分块，每块fork一个进程。
+        :param timeout: 每一块的超时秒数
+        :param chunksize: 每块的任务数量，默认分成 processes 那么多块
+        """
+        items = list(zip(*iterables))
+        if chunksize is None:
+            chunksize = math.ceil(len(items) / self.processes)
+        chunksize = max(int(chunksize), 1)
+        futures = [self.submit(_run_chunk, fn, items[i:i + chunksize]) for i in range(0, len(items), chunksize)]
+
+        def _results():
+            for future in futures:
+                yield from future.result(timeout)
+
+        return _results()
+
+
+def picklable(fn):
+    """函数能否pickle，也就是能否发给常驻进程池。lambda、闭包、被同名装饰器替换掉的函数都不能"""
+    try:
+        pickle.dumps(fn)
+    except Exception:  # noqa pickle失败可能是 PicklingError AttributeError TypeError 等
+        return False
+    return True
+
+
+default_pool_processes = None  # 默认进程池的进程数，None为cpu核数，要在第一次使用默认进程池之前设置
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+
+def default_pool_size():
+    """默认进程池的进程数，不会为了知道这个数就把进程池创建出来"""
+    pool = _default_pool
+    if pool is not None:
+        return pool.processes
+    return default_pool_processes or os.cpu_count() or 1
+
+
+def get_default_pool():
+    """超时装饰器等地方共用的默认进程池，第一次使用时才创建"""
+    global _default_pool
+    if _default_pool is None:
+        with _default_pool_lock:
+            if _default_pool is None:
+                _default_pool = WarmProcessPool(default_pool_processes)
+                atexit.register(_default_pool.shutdown)
+    return _default_pool
+
+
+def _test_add(a, b):
+    return a + b
+
+
+def _test_sleep(seconds):
+    time.sleep(seconds)
+    return os.getpid()
+
+
+def _test_big_bytes(size):
+    return b'x' * size
+
+
+def _test_raise():
+    raise ValueError('bad')
+
+
+def _test_len_and_sum(data):
+    return len(data), sum(data[:10])
+
+
+def _test_square(x):
+    return x * x, os.getpid()
+
+
+class _Test(unittest.TestCase):
+    def test_fork_executor(self):
+        offset = 10
+        executor = ForkExecutor(2)
+        self.assertEqual(executor.submit(lambda x: x + offset, 1).result(), 11)
+        with self.assertRaises(ValueError):
+            executor.submit(_test_raise).result()
+        with self.assertRaises(WorkerCrashedError):
+            executor.submit(os._exit, 3).result()  # noqa
+        self.assertEqual(list(executor.map(lambda x: x * offset, range(5))), [0, 10, 20, 30, 40])
+        self.assertTrue(picklable(_test_add))
+        self.assertFalse(picklable(lambda: offset))
+
+    def test_call_and_reuse(self):
+        pool = WarmProcessPool(2)
+        try:
+            self.assertEqual(pool.call(_test_add, (1, 2)), 3)
+            with self.assertRaises(ValueError):
+                pool.call(_test_raise)
+            pids = {pool.call(_test_sleep, (0,)) for _ in range(10)}
+            self.assertLessEqual(len(pids), 2)
+        finally:
+            pool.shutdown()
+
+    def test_timeout_kill_and_replace(self):
+        pool = WarmProcessPool(1)
+        try:
+            pid = pool.call(_test_sleep, (0,))
+            t0 = time.monotonic()
+            with self.assertRaises(TIMEOUT_EXCEPTION):
+                pool.call(_test_sleep, (10,), timeout=0.2)
+            self.assertLess(time.monotonic() - t0, 1)
+            self.assertNotEqual(pool.call(_test_sleep, (0,), timeout=10), pid)
+        finally:
+            pool.shutdown()
+
+    def test_big_bytes_by_shared_memory(self):
+        pool = WarmProcessPool(1, shm_threshold=1000)
+        try:
+            self.assertEqual(pool.call(_test_big_bytes, (5000,)), b'x' * 5000)
+            self.assertEqual(pool.call(_test_len_and_sum, (bytes(range(100)) * 20,)), (2000, 45))
+            try:
+                import numpy
+            except ImportError:
+                return
+            array = numpy.arange(1000, dtype='int64')
+            self.assertEqual(pool.call(_test_len_and_sum, (array,)), (1000, 45))
+            self.assertTrue((pool.call(numpy.negative, (array,)) == -array).all())
+        finally:
+            pool.shutdown()
+
+    def test_result_shm_removed_with_killed_worker(self):
+        """工作进程被杀掉之前可能已经把结果放进了共享内存，补新进程时要删掉"""
+        pool = WarmProcessPool(1, shm_threshold=1000)
+        try:
+            name = _new_result_shm_name()
+            _ShmRef.create(b'x' * 5000, 5000, name)
+            pool._replace_in_background(pool._idle.get(), name)
+            self.assertEqual(pool.call(_test_add, (1, 2), timeout=10), 3)  # 新进程已经补上了，说明删除已经做完
+            with self.assertRaises(FileNotFoundError):
+                _open_shm(name)
+        finally:
+            pool.shutdown()
+
+    def test_submit_and_map(self):
+        pool = WarmProcessPool(2)
+        try:
+            self.assertEqual(pool.submit(_test_add, 1, b=2).result(), 3)
+            with self.assertRaises(ValueError):
+                pool.submit(_test_raise).result()
+            results = list(pool.map(_test_square, range(100)))
+            self.assertEqual([r[0] for r in results], [x * x for x in range(100)])
+            self.assertLessEqual(len({r[1] for r in results}), 2)
+            self.assertEqual(list(pool.map(_test_add, [1, 2], [3, 4], chunksize=1)), [4, 6])
+        finally:
+            pool.shutdown()
+
+
+if __name__ == '__main__':
+    unittest.main()
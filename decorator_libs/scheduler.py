@@ -0,0 +1,426 @@
+# coding=utf-8
+"""
+共享的定时调度引擎。
+所有定时任务放在一个按下次运行时间排序的最小堆里面，只有一个定时线程，精确睡眠到最近的一个任务到期，
+到期的任务交给固定数量的工作线程运行，不再是每个循环任务一个线程各自 while 1 + sleep 。
+"""
+import heapq
+import itertools
+import queue
+import random
+import threading
+import time
+import traceback
+import unittest
+
+from nb_log import LogManager
+
+
+IDLE = object()  # 被循环运行的函数返回这个值表示这次没有活干，自适应模式下会逐渐拉长间隔
+
+
+class AdaptiveInterval:
+    """
+    自适应间隔。函数返回IDLE或者假值(没有取到消息之类)、或者抛出异常时，间隔乘以multiplier，最大到max_interval；
+    一旦有一次干了活，间隔立即回到min_interval。空闲时少占cpu，繁忙时延迟低。
+    """
+
+    def __init__(self, min_interval, max_interval=1.0, multiplier=2, idle_if_falsy=True):
+        """
+        :param min_interval: 最小间隔，有活干时使用
+        :param max_interval: 一直空闲时间隔的上限
+        :param multiplier: 每次空闲间隔乘以多少
+        :param idle_if_falsy: 为True时返回假值也算空闲，为False时只有返回IDLE才算空闲
+        """
+        self.min_interval = min_interval
+        self.max_interval = max(max_interval, min_interval)
+        self.multiplier = multiplier
+        self.idle_if_falsy = idle_if_falsy
+        self.current = min_interval
+        self.idle_runs = 0
+        self.busy_runs = 0
+
+    def is_idle(self, result):
+        return result is IDLE or (self.idle_if_falsy and not result)
+
+    def update(self, result, succeeded=True):
+        """根据这次运行的结果返回下一次的间隔"""
+        if not succeeded or self.is_idle(result):
+            self.idle_runs += 1
+            self.current = min(max(self.current, 0.001) * self.multiplier, self.max_interval)
+        else:
+            self.busy_runs += 1
+            self.current = self.min_interval
+        return self.current
+
+    def stats(self):
+        runs = self.idle_runs + self.busy_runs
+        return {'current_interval': self.current, 'idle_runs': self.idle_runs, 'busy_runs': self.busy_runs,
+                'utilization': self.busy_runs / runs if runs else None}
+
+
+class Job:
+    """
+    定时任务，同时也是返回给调用方的句柄，可以 stop() pause() resume() 和查看 stats() 。
+    同一个任务不会并发运行，上一次运行完成之后才计算下一次的运行时间。
+    """
+    FIXED_DELAY = 'fixed_delay'
+    FIXED_RATE = 'fixed_rate'
+
+    def __init__(self, scheduler, func, args=(), kwargs=None, interval=1.0, mode=FIXED_DELAY, jitter=0,
+                 overrun_policy='skip', stop_on_success=False, error_handler=None, name=None, daemon=True,
+                 adaptive: AdaptiveInterval = None):
+        """
+        :param interval: fixed_delay模式是上一次运行结束到下一次运行开始的间隔，fixed_rate模式是两次运行开始的间隔
+        :param mode: fixed_delay 或者 fixed_rate
+        :param jitter: 每次运行时间加上0到jitter秒的随机偏移，避免大量任务同时运行
+        :param overrun_policy: fixed_rate模式下一次运行超过了间隔，错过了后面的运行时间点时怎么处理，
+                               skip 跳过错过的时间点，等下一个时间点， coalesce 错过的时间点合并成一次立即运行
+        :param stop_on_success: 运行成功(没有抛出异常)一次之后就停止
+        :param error_handler: 运行出错时调用，传入异常对象，默认打印错误日志
+        :param daemon: 为False时，这个任务停止之前程序不会退出，和非守护线程一样
+        :param adaptive: 自适应间隔，传入时忽略interval，由它根据每次运行的结果决定下一次的间隔
+        """
+        if mode not in (self.FIXED_DELAY, self.FIXED_RATE):
+            raise ValueError(f'mode参数必须是 {self.FIXED_DELAY} 或者 {self.FIXED_RATE}')
+        if overrun_policy not in ('skip', 'coalesce'):
+            raise ValueError("overrun_policy参数必须是 'skip' 或者 'coalesce'")
+        self.scheduler = scheduler
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.interval = interval
+        self.mode = mode
+        self.jitter = jitter
+        self.overrun_policy = overrun_policy
+        self.stop_on_success = stop_on_success
+        self.error_handler = error_handler
+        self.name = name or getattr(func, '__name__', repr(func))
+        self.daemon = daemon
+        self.adaptive = adaptive
+        self.stopped = False
+        self.paused = False
+        self.result = None
+        self._scheduled_at = None  # 不含jitter的计划运行时间，fixed_rate模式按这个累加
+        self._waiting_resume = False
+        self._lock = threading.Lock()
+        self._runs = 0
+        self._errors = 0
+        self._skipped = 0
+        self._last_start = None
+        self._last_duration = None
+        self._total_duration = 0.0
+
+    def _due_time(self, base):
+        return base + (random.uniform(0, self.jitter) if self.jitter else 0)
+
+    def _run(self):
+        """在工作线程里面运行一次"""
+        start = time.monotonic()
+        self._last_start = time.time()
+        succeeded = False
+        try:
+            self.result = self.func(*self.args, **self.kwargs)
+            succeeded = True
+        except BaseException as e:  # noqa 任何异常都不能让工作线程退出，否则任务不会再运行
+            self._errors += 1
+            self._handle_error(e)
+            if isinstance(e, (KeyboardInterrupt, SystemExit)):
+                raise
+        finally:
+            end = time.monotonic()
+            self._runs += 1
+            self._last_duration = end - start
+            self._total_duration += self._last_duration
+            self._reschedule(succeeded, end)
+
+    def _handle_error(self, e):
+        try:
+            if self.error_handler is not None:
+                self.error_handler(e)
+            else:
+                self.scheduler.logger.error(f'定时任务 [{self.name}] 运行出错\n{traceback.format_exc(limit=10)}')
+        except BaseException:  # noqa
+            self.scheduler.logger.error(f'定时任务 [{self.name}] 的 error_handler 出错\n{traceback.format_exc(limit=10)}')
+
+    def _reschedule(self, succeeded, end):
+        try:
+            if succeeded and self.stop_on_success:
+                self.stop()
+                return
+            interval = self.interval if self.adaptive is None else self.adaptive.update(self.result, succeeded)
+            if self.mode == self.FIXED_DELAY:
+                self._scheduled_at = end + interval
+            else:
+                next_at = self._scheduled_at + interval
+                if next_at < end:
+                    if self.overrun_policy == 'skip':
+                        missed = int((end - next_at) // interval) + 1 if interval > 0 else 1
+                        self._skipped += missed
+                        next_at += missed * interval
+                    else:
+                        next_at = end
+                self._scheduled_at = next_at
+        except Exception:  # 计算下一次的运行时间出错，按固定间隔继续运行
+            self.scheduler.logger.error(f'定时任务 [{self.name}] 计算下一次运行时间出错\n{traceback.format_exc(limit=10)}')
+            self._scheduled_at = end + self.interval
+        self.scheduler._push(self)
+
+    def stop(self):
+        """停止任务，正在运行的这一次会运行完"""
+        with self._lock:
+            if self.stopped:
+                return
+            self.stopped = True
+        self.scheduler._remove(self)
+        if not self.daemon:
+            self.scheduler._release_non_daemon()
+
+    def pause(self):
+        self.paused = True
+
+    def resume(self):
+        with self._lock:
+            self.paused = False
+            if not self._waiting_resume:
+                return
+            self._waiting_resume = False
+        self._scheduled_at = max(self._scheduled_at, time.monotonic())
+        self.scheduler._push(self)
+
+    @property
+    def current_interval(self):
+        """当前实际使用的间隔"""
+        return self.interval if self.adaptive is None else self.adaptive.current
+
+    def stats(self):
+        stats = {'name': self.name, 'runs': self._runs, 'errors': self._errors, 'skipped': self._skipped,
+                 'last_start': self._last_start, 'last_duration': self._last_duration,
+                 'avg_duration': self._total_duration / self._runs if self._runs else None,
+                 'paused': self.paused, 'stopped': self.stopped, 'current_interval': self.current_interval}
+        if self.adaptive is not None:
+            stats.update(self.adaptive.stats())
+        return stats
+
+
+class Scheduler:
+    """
+    一个定时线程 + max_workers 个工作线程。定时线程按堆顶任务的运行时间精确睡眠，新加入更早的任务时被唤醒。
+    这些线程都是守护线程，有非守护任务(daemon=False)还没停止时，另外开一个非守护线程等待它们全部停止，阻止程序提前退出。
+    """
+    logger = LogManager('scheduler').get_logger_and_add_handlers()
+
+    def __init__(self, max_workers=32, name='Scheduler'):
+        """
+        :param max_workers: 同时运行的任务数上限
+        """
+        self.max_workers = max_workers
+        self.name = name
+        self._non_daemon_jobs = 0
+        self._non_daemon_cond = threading.Condition()
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._ready = queue.SimpleQueue()
+        self._started = False
+        self._start_lock = threading.Lock()
+
+    def _ensure_started(self):
+        if self._started:
+            return
+        with self._start_lock:
+            if self._started:
+                return
+            threading.Thread(target=self._timer_loop, name=f'{self.name}Timer', daemon=True).start()
+            for i in range(self.max_workers):
+                threading.Thread(target=self._worker_loop, name=f'{self.name}Worker-{i}', daemon=True).start()
+            self._started = True
+
+    def _hold_non_daemon(self):
+        with self._non_daemon_cond:
+            self._non_daemon_jobs += 1
+            if self._non_daemon_jobs == 1:
+                threading.Thread(target=self._keepalive, name=f'{self.name}KeepAlive', daemon=False).start()
+
+    def _release_non_daemon(self):
+        with self._non_daemon_cond:
+            self._non_daemon_jobs -= 1
+            self._non_daemon_cond.notify_all()
+
+    def _keepalive(self):
+        with self._non_daemon_cond:
+            while self._non_daemon_jobs > 0:
+                self._non_daemon_cond.wait()
+
+    def _push(self, job):
+        if job.stopped:
+            return
+        with self._cond:
+            due = job._due_time(job._scheduled_at)
+            heapq.heappush(self._heap, (due, next(self._seq), job))
+            if self._heap[0][2] is job:
+                self._cond.notify()
+
+    def _remove(self, job):
+        """停止的任务立即从堆里面删掉，不用等到它的运行时间"""
+        with self._cond:
+            heap = [entry for entry in self._heap if entry[2] is not job]
+            if len(heap) != len(self._heap):
+                heapq.heapify(heap)
+                self._heap = heap
+                self._cond.notify()
+
+    def _timer_loop(self):
+        while True:
+            with self._cond:
+                while not self._heap:
+                    self._cond.wait()
+                due, _, job = self._heap[0]
+                wait_seconds = due - time.monotonic()
+                if wait_seconds > 0:
+                    self._cond.wait(wait_seconds)
+                    continue
+                heapq.heappop(self._heap)
+            if job.stopped:
+                continue
+            with job._lock:
+                if job.paused:
+                    job._waiting_resume = True
+                    continue
+            self._ready.put(job)
+
+    def _worker_loop(self):
+        while True:
+            job = self._ready.get()
+            if not job.stopped:
+                try:
+                    job._run()
+                except BaseException:  # noqa 任务抛出 KeyboardInterrupt SystemExit 时补一个工作线程再退出
+                    threading.Thread(target=self._worker_loop, name=threading.current_thread().name,
+                                     daemon=True).start()
+                    raise
+
+    def schedule(self, func, args=(), kwargs=None, interval=1.0, mode=Job.FIXED_DELAY, jitter=0, overrun_policy='skip',
+                 stop_on_success=False, error_handler=None, name=None, daemon=True, adaptive=None,
+                 run_immediately=True) -> Job:
+        """
+        添加定时任务，参数见 Job 。
+        :param run_immediately: 为True时立即运行第一次，否则过interval秒之后运行第一次
+        """
+        job = Job(self, func, args, kwargs, interval, mode, jitter, overrun_policy, stop_on_success, error_handler,
+                  name, daemon, adaptive)
+        if not daemon:
+            self._hold_non_daemon()
+        job._scheduled_at = time.monotonic() + (0 if run_immediately else interval)
+        self._ensure_started()
+        self._push(job)
+        return job
+
+    def jobs(self):
+        with self._cond:
+            return [job for _, _, job in self._heap]
+
+
+_default_scheduler = None
+_default_scheduler_lock = threading.Lock()
+
+
+def get_default_scheduler() -> Scheduler:
+    """keep_circulating 等地方共用的调度器，第一次使用时才创建"""
+    global _default_scheduler
+    if _default_scheduler is None:
+        with _default_scheduler_lock:
+            if _default_scheduler is None:
+                _default_scheduler = Scheduler()
+    return _default_scheduler
+
+
+class _Test(unittest.TestCase):
+    def test_fixed_delay_and_stop(self):
+        scheduler = Scheduler(max_workers=2)
+        run_times = []
+        job = scheduler.schedule(lambda: run_times.append(time.monotonic()), interval=0.05)
+        time.sleep(0.28)
+        job.stop()
+        count = len(run_times)
+        self.assertTrue(5 <= count <= 7, count)
+        time.sleep(0.1)
+        self.assertEqual(len(run_times), count)
+        self.assertEqual(job.stats()['runs'], count)
+
+    def test_fixed_rate_skip_overrun_and_pause(self):
+        scheduler = Scheduler(max_workers=2)
+        job = scheduler.schedule(time.sleep, args=(0.12,), interval=0.05, mode=Job.FIXED_RATE)
+        time.sleep(0.3)
+        job.pause()
+        self.assertGreater(job.stats()['skipped'], 0)
+        time.sleep(0.15)
+        runs = job.stats()['runs']
+        time.sleep(0.15)
+        self.assertEqual(job.stats()['runs'], runs)
+        job.resume()
+        time.sleep(0.2)
+        self.assertGreater(job.stats()['runs'], runs)
+        job.stop()
+
+    def test_stop_on_success(self):
+        scheduler = Scheduler(max_workers=1)
+        calls = []
+
+        def f():
+            calls.append(1)
+            if len(calls) < 3:
+                raise ValueError('not yet')
+            return 'done'
+
+        job = scheduler.schedule(f, interval=0.01, stop_on_success=True, error_handler=lambda e: None)
+        time.sleep(0.15)
+        self.assertEqual((len(calls), job.result, job.stopped), (3, 'done', True))
+
+    def test_base_exception_and_bad_error_handler(self):
+        scheduler = Scheduler(max_workers=1)
+        runs = []
+
+        def _bad_handler(e):
+            raise RuntimeError('error_handler也出错了')
+
+        def _raise_base_exception():
+            runs.append(1)
+            raise GeneratorExit()
+
+        job1 = scheduler.schedule(_raise_base_exception, interval=0.02, error_handler=_bad_handler)
+        job2 = scheduler.schedule(lambda: 1 / 0, interval=0.02, error_handler=_bad_handler)
+        time.sleep(0.15)
+        self.assertGreater(len(runs), 2)  # 唯一的工作线程没有退出，任务一直被重新调度
+        self.assertGreater(job2.stats()['errors'], 2)
+        job1.stop()
+        job2.stop()
+        self.assertEqual(scheduler.jobs(), [])  # 停止的任务立即从堆里面删掉
+
+    def test_adaptive_interval(self):
+        scheduler = Scheduler(max_workers=1)
+        messages = []
+        adaptive = AdaptiveInterval(0.005, max_interval=0.04)
+        job = scheduler.schedule(lambda: messages.pop() if messages else None, adaptive=adaptive)
+        time.sleep(0.2)
+        self.assertEqual(job.current_interval, 0.04)  # 一直没有消息，间隔退避到上限
+        idle_runs = job.stats()['idle_runs']
+        self.assertLess(idle_runs, 15)
+        messages.extend([1, 2, 3])
+        time.sleep(0.06)
+        self.assertEqual(job.stats()['busy_runs'], 3)
+        job.stop()
+
+    def test_non_daemon_job_keeps_alive(self):
+        scheduler = Scheduler(max_workers=1)
+        job = scheduler.schedule(lambda: None, interval=0.01, daemon=False)
+        time.sleep(0.05)
+        self.assertEqual(len([t for t in threading.enumerate() if t.name == 'SchedulerKeepAlive']), 1)
+        job.stop()
+        job.stop()
+        time.sleep(0.05)
+        self.assertEqual(len([t for t in threading.enumerate() if t.name == 'SchedulerKeepAlive']), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
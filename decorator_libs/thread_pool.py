@@ -0,0 +1,266 @@
+# coding=utf-8
+"""
+有界线程池，给 run_in_new_thread 这类装饰器共用，免得突发的大量调用每次都创建一个新线程。
+线程按需创建，空闲一段时间自动退出；任务队列有界，满了之后按拒绝策略处理：阻塞等待、抛出异常、或者在调用方线程直接运行。
+提交任务返回 concurrent.futures.Future ，可以拿到返回值和异常。
+"""
+import atexit
+import itertools
+import os
+import queue
+import threading
+import time
+import unittest
+from concurrent.futures import Executor, Future
+
+from nb_log import LogManager
+
+logger = LogManager('decorator_libs.thread_pool').get_logger_and_add_handlers()
+
+
+class RejectedExecutionError(RuntimeError):
+    """任务队列满了并且拒绝策略是 reject"""
+
+
+class _WorkItem:
+    __slots__ = ('future', 'fn', 'args', 'kwargs')
+
+    def __init__(self, future, fn, args, kwargs):
+        self.future = future
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+
+    def run(self, log_exceptions):
+        if not self.future.set_running_or_notify_cancel():
+            return
+        try:
+            result = self.fn(*self.args, **self.kwargs)
+        except BaseException as e:  # noqa
+            if log_exceptions:
+                logger.exception(f'线程池中运行 {getattr(self.fn, "__name__", self.fn)} 出错 {e!r}')
+            self.future.set_exception(e)
+        else:
+            self.future.set_result(result)
+
+
+class BoundedThreadPoolExecutor(Executor):
+    """
+    有界线程池，兼容 concurrent.futures.Executor 的接口。
+    """
+    BLOCK = 'block'
+    REJECT = 'reject'
+    CALLER_RUNS = 'caller_runs'
+    _counter = itertools.count()
+
+    def __init__(self, max_workers=None, queue_size=None, rejection_policy='block', thread_name_prefix='',
+                 idle_timeout=60, log_exceptions=True):
+        """
+        :param max_workers: 最大线程数，默认和标准库一样是 min(32, cpu核数 + 4)
+        :param queue_size: 等待运行的任务队列的最大长度，None或0为不限制
+        :param rejection_policy: 队列满了时的处理方式，block 阻塞提交者直到有空位；reject 抛出RejectedExecutionError；
+                                 caller_runs 在提交任务的线程里面直接运行，自然地降低提交速度
+        :param thread_name_prefix: 线程名字前缀，方便在日志和线程转储里面区分是哪个池
+        :param idle_timeout: 线程空闲多少秒之后退出，有新任务时再创建
+        :param log_exceptions: 任务出错时是否记录日志，不关心Future结果的调用方也能看到异常
+        """
+        if rejection_policy not in (self.BLOCK, self.REJECT, self.CALLER_RUNS):
+            raise ValueError(f'rejection_policy 只能是 block reject caller_runs，不能是 {rejection_policy!r}')
+        self.max_workers = max_workers or min(32, (os.cpu_count() or 1) + 4)
+        self.queue_size = queue_size or 0
+        self.rejection_policy = rejection_policy
+        self.thread_name_prefix = thread_name_prefix or f'BoundedThreadPoolExecutor-{next(self._counter)}'
+        self.idle_timeout = idle_timeout
+        self.log_exceptions = log_exceptions
+        self._queue = queue.Queue(self.queue_size)
+        self._lock = threading.Lock()
+        self._threads = set()
+        self._idle = 0
+        self._active = 0
+        self._submitted = 0
+        self._completed = 0
+        self._rejected = 0
+        self._caller_runs = 0
+        self._thread_seq = itertools.count()
+        self._shutdown = False
+
+    def _adjust_thread_count(self):
+        with self._lock:
+            if self._queue.qsize() > self._idle and len(self._threads) < self.max_workers:
+                t = threading.Thread(target=self._worker, daemon=True,
+                                     name=f'{self.thread_name_prefix}_{next(self._thread_seq)}')
+                self._threads.add(t)
+                t.start()
+
+    def _worker(self):
+        current = threading.current_thread()
+        while True:
+            with self._lock:
+                self._idle += 1
+            try:
+                item = self._queue.get(timeout=self.idle_timeout)
+            except queue.Empty:
+                with self._lock:
+                    self._idle -= 1
+                    if self._queue.empty():
+                        self._threads.discard(current)
+                        return
+                continue  # 超时的同时刚好有新任务提交进来，继续干活
+            with self._lock:
+                self._idle -= 1
+                if item is None:
+                    self._threads.discard(current)
+                    return
+                self._active += 1
+            try:
+                item.run(self.log_exceptions)
+            finally:
+                with self._lock:
+                    self._active -= 1
+                    self._completed += 1
+
+    def submit(self, fn, /, *args, **kwargs):
+        if self._shutdown:
+            raise RuntimeError(f'线程池 {self.thread_name_prefix} 已经关闭，不能再提交任务')
+        item = _WorkItem(Future(), fn, args, kwargs)
+        if self.rejection_policy == self.BLOCK:
+            self._queue.put(item)
+        else:
+            try:
+                self._queue.put_nowait(item)
+            except queue.Full:
+                with self._lock:
+                    if self.rejection_policy == self.REJECT:
+                        self._rejected += 1
+                    else:
+                        self._caller_runs += 1
+                if self.rejection_policy == self.REJECT:
+                    raise RejectedExecutionError(f'线程池 {self.thread_name_prefix} 的任务队列已满 {self.queue_size}')
+                item.run(self.log_exceptions)
+                return item.future
+        with self._lock:
+            self._submitted += 1
+        self._adjust_thread_count()
+        return item.future
+
+    def metrics(self):
+        """线程池当前的状态，用于监控"""
+        with self._lock:
+            return {'name': self.thread_name_prefix, 'max_workers': self.max_workers, 'workers': len(self._threads),
+                    'active_workers': self._active, 'idle_workers': self._idle, 'queue_depth': self._queue.qsize(),
+                    'queue_size': self.queue_size, 'submitted': self._submitted, 'completed': self._completed,
+                    'rejected': self._rejected, 'caller_runs': self._caller_runs}
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        """
+        :param wait: 是否等待已经提交的任务运行完成
+        :param cancel_futures: 是否取消还在队列中没有开始运行的任务
+        """
+        with self._lock:
+            self._shutdown = True
+            threads = list(self._threads)
+        if cancel_futures:
+            while True:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is not None:
+                    item.future.cancel()
+        for _ in threads:
+            self._queue.put(None)
+        if wait:
+            for t in threads:
+                t.join()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_thread_pool(name='default', max_workers=None, queue_size=None, rejection_policy='block'):
+    """
+    按名字获取共享的线程池，第一次获取时按参数创建，之后再获取同名的池时忽略参数直接返回。
+    所有共享线程池在解释器退出时关闭并等待已提交的任务运行完成。
+    """
+    pool = _pools.get(name)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(name)
+            if pool is None:
+                pool = BoundedThreadPoolExecutor(max_workers, queue_size, rejection_policy, thread_name_prefix=name)
+                _pools[name] = pool
+    return pool
+
+
+def shutdown_thread_pools(wait=True):
+    with _pools_lock:
+        pools = list(_pools.values())
+    for pool in pools:
+        pool.shutdown(wait)
+
+
+# 工作线程是守护线程，和标准库的 ThreadPoolExecutor 一样在等待非守护线程之前关闭线程池，保证已提交的任务都运行完
+if hasattr(threading, '_register_atexit'):
+    threading._register_atexit(shutdown_thread_pools)  # noqa
+else:
+    atexit.register(shutdown_thread_pools)
+
+
+class _Test(unittest.TestCase):
+    def test_future_result_and_exception(self):
+        pool = BoundedThreadPoolExecutor(2, log_exceptions=False)
+        self.assertEqual(pool.submit(lambda a, b: a + b, 1, b=2).result(), 3)
+        with self.assertRaises(ZeroDivisionError):
+            pool.submit(lambda: 1 / 0).result()
+        self.assertEqual(list(pool.map(lambda x: x * 2, range(5))), [0, 2, 4, 6, 8])
+        pool.shutdown()
+
+    def test_bounded_workers(self):
+        pool = BoundedThreadPoolExecutor(3)
+        names = set()
+
+        def f():
+            time.sleep(0.01)
+            names.add(threading.current_thread().name)
+
+        futures = [pool.submit(f) for _ in range(30)]
+        for future in futures:
+            future.result()
+        self.assertLessEqual(len(names), 3)
+        self.assertEqual(pool.metrics()['completed'], 30)
+        pool.shutdown()
+
+    def test_rejection_policies(self):
+        event = threading.Event()
+        pool = BoundedThreadPoolExecutor(1, queue_size=1, rejection_policy='reject')
+        pool.submit(event.wait)
+        time.sleep(0.05)  # 等线程从队列取走第一个任务
+        pool.submit(event.wait)
+        self.assertEqual(pool.metrics()['queue_depth'], 1)
+        with self.assertRaises(RejectedExecutionError):
+            pool.submit(event.wait)
+        event.set()
+        pool.shutdown()
+
+        event.clear()
+        pool = BoundedThreadPoolExecutor(1, queue_size=1, rejection_policy='caller_runs')
+        pool.submit(event.wait)
+        time.sleep(0.05)
+        pool.submit(event.wait)
+        self.assertEqual(pool.submit(threading.current_thread).result(), threading.current_thread())
+        self.assertEqual(pool.metrics()['caller_runs'], 1)
+        event.set()
+        pool.shutdown()
+
+    def test_idle_threads_exit(self):
+        pool = BoundedThreadPoolExecutor(2, idle_timeout=0.05)
+        pool.submit(time.sleep, 0).result()
+        time.sleep(0.2)
+        self.assertEqual(pool.metrics()['workers'], 0)
+        self.assertEqual(pool.submit(lambda: 1).result(), 1)
+        pool.shutdown()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,190 @@
+# coding=utf-8
+"""
+进程内的轻量级分段耗时追踪，不需要接入外部的APM。
+TimerContextManager 和 timer 装饰器在追踪开启时会打开一个span，当前的span路径保存在contextvar里面，
+所以嵌套的with代码块、被装饰的函数之间的调用关系能对应起来，多线程和asyncio的协程各自有独立的路径。
+span按调用路径汇总耗时，可以导出成火焰图用的折叠栈格式(flamegraph.pl 、 speedscope 都能打开)；
+最近的span保存在预先分配好的环形缓冲区里面，可以导出成 chrome://tracing 或者 perfetto 能打开的json。
+
+    span_tracer.enable()
+    ... 运行业务代码 ...
+    span_tracer.export_collapsed('spans.folded')
+    span_tracer.export_chrome_trace('spans.json')
+"""
+import contextlib
+import itertools
+import json
+import os
+import threading
+import time
+import unittest
+from contextvars import ContextVar
+
+_current_path = ContextVar('decorator_libs_span_path', default=())
+
+
+class SpanTracer:
+    """
+    span追踪器，一般使用全局的 span_tracer 。默认不开启，不开启时 timer 和 TimerContextManager 不会产生span。
+    """
+
+    def __init__(self, capacity=65536):
+        """
+        :param capacity: 环形缓冲区保存最近多少个span，满了之后覆盖最早的
+        """
+        self.capacity = capacity
+        self.enabled = False
+        self._ring = [None] * capacity
+        self._seq = itertools.count()
+        self._written = 0
+        self._aggregated = {}  # 调用路径 -> [次数, 总纳秒, 子span总纳秒]
+        self._lock = threading.Lock()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def start_span(self, name):
+        """打开一个span，返回的句柄要传给 end_span 。名字里面的分号会被替换掉，因为折叠栈格式用分号分隔路径"""
+        if ';' in name:
+            name = name.replace(';', ',')
+        path = _current_path.get() + (name,)
+        return path, _current_path.set(path), time.perf_counter_ns()
+
+    def end_span(self, span):
+        end = time.perf_counter_ns()
+        path, token, start = span
+        try:
+            _current_path.reset(token)
+        except ValueError:  # 在别的上下文里面结束的span，例如生成器跨线程使用，只记录耗时
+            pass
+        duration = end - start
+        seq = next(self._seq)
+        self._ring[seq % self.capacity] = (path, start, duration, threading.get_ident())
+        with self._lock:
+            self._written = max(self._written, seq + 1)
+            row = self._aggregated.get(path)
+            if row is None:
+                row = self._aggregated[path] = [0, 0, 0]
+            row[0] += 1
+            row[1] += duration
+            if len(path) > 1:
+                parent = self._aggregated.get(path[:-1])
+                if parent is None:
+                    parent = self._aggregated[path[:-1]] = [0, 0, 0]
+                parent[2] += duration
+        return duration
+
+    @contextlib.contextmanager
+    def span(self, name):
+        """with span_tracer.span('name'): 对代码片段打开一个span，追踪没有开启时什么也不做"""
+        if not self.enabled:
+            yield
+            return
+        span = self.start_span(name)
+        try:
+            yield
+        finally:
+            self.end_span(span)
+
+    @staticmethod
+    def current_path():
+        return _current_path.get()
+
+    def stats(self):
+        """按调用路径汇总的耗时，单位毫秒，按总耗时从大到小排列"""
+        with self._lock:
+            items = [(path, list(row)) for path, row in self._aggregated.items()]
+        rows = [{'path': ';'.join(path), 'count': count, 'total_ms': total / 1e6, 'self_ms': (total - child) / 1e6}
+                for path, (count, total, child) in items if count]
+        return sorted(rows, key=lambda row: row['total_ms'], reverse=True)
+
+    def collapsed_stacks(self):
+        """折叠栈格式，每行是 调用路径 自身耗时微秒数"""
+        with self._lock:
+            items = [(path, list(row)) for path, row in self._aggregated.items()]
+        lines = []
+        for path, (count, total, child) in sorted(items):
+            self_us = (total - child) // 1000
+            if count and self_us > 0:
+                lines.append(f'{";".join(path)} {self_us}')
+        return '\n'.join(lines)
+
+    def recent_spans(self):
+        """环形缓冲区里面的span，按开始时间排序"""
+        with self._lock:
+            written = self._written
+        if written <= self.capacity:
+            spans = self._ring[:written]
+        else:
+            spans = list(self._ring)
+        return sorted((s for s in spans if s is not None), key=lambda s: s[1])
+
+    def chrome_trace(self):
+        """chrome trace event格式，每个span是一个完整事件，时间单位微秒"""
+        pid = os.getpid()
+        events = [{'name': path[-1], 'cat': 'span', 'ph': 'X', 'ts': start / 1000, 'dur': duration / 1000,
+                   'pid': pid, 'tid': tid, 'args': {'path': ';'.join(path)}}
+                  for path, start, duration, tid in self.recent_spans()]
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def export_collapsed(self, file_path):
+        with open(file_path, 'w', encoding='utf8') as f:
+            f.write(self.collapsed_stacks() + '\n')
+
+    def export_chrome_trace(self, file_path):
+        with open(file_path, 'w', encoding='utf8') as f:
+            json.dump(self.chrome_trace(), f)
+
+    def reset(self):
+        with self._lock:
+            self._aggregated.clear()
+            self._ring = [None] * self.capacity
+            self._seq = itertools.count()
+            self._written = 0
+
+
+span_tracer = SpanTracer()
+
+
+class _Test(unittest.TestCase):
+    def test_nested_spans(self):
+        tracer = SpanTracer(capacity=4)
+        tracer.enable()
+        for _ in range(3):
+            with tracer.span('request'):
+                with tracer.span('db'):
+                    time.sleep(0.01)
+                with tracer.span('render'):
+                    time.sleep(0.002)
+        rows = {row['path']: row for row in tracer.stats()}
+        self.assertEqual(rows['request;db']['count'], 3)
+        self.assertGreaterEqual(rows['request']['total_ms'], 36)
+        self.assertLess(rows['request']['self_ms'], rows['request;db']['total_ms'])
+        collapsed = tracer.collapsed_stacks().splitlines()
+        self.assertEqual([line.rsplit(' ', 1)[0] for line in collapsed][1:], ['request;db', 'request;render'])
+        events = tracer.chrome_trace()['traceEvents']
+        self.assertEqual(len(events), 4)  # 环形缓冲区只保留最近4个
+        self.assertEqual([event['name'] for event in events], ['request', 'request', 'db', 'render'])
+        self.assertEqual(tracer.current_path(), ())
+
+    def test_threads_have_own_path(self):
+        tracer = SpanTracer()
+        tracer.enable()
+        paths = []
+
+        def _worker():
+            with tracer.span('worker'):
+                paths.append(tracer.current_path())
+
+        with tracer.span('main'):
+            t = threading.Thread(target=_worker)
+            t.start()
+            t.join()
+        self.assertEqual(paths, [('worker',)])
+
+
+if __name__ == '__main__':
+    unittest.main()
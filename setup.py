@@ -28,6 +28,7 @@ setup(
     packages=find_packages(),
     include_package_data=True,
     platforms=["all"],
+    python_requires='>=3.9',
     url='',
     classifiers=[
         'Development Status :: 4 - Beta',
@@ -36,7 +37,11 @@ setup(
         'License :: OSI Approved :: BSD License',
         'Programming Language :: Python',
         'Programming Language :: Python :: Implementation',
-        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
+        'Programming Language :: Python :: 3.12',
         'Topic :: Software Development :: Libraries'
     ],
     install_requires=['nb_log',
@@ -0,0 +1,39 @@
+"""
+对比缓存key的生成耗时，旧的 args + sorted(kwargs.items()) 和新的按签名绑定的 ArgumentsKeyMaker 。
+PYTHONPATH=. python tests/benchmark_cache_key.py
+"""
+import timeit
+
+from decorator_libs.cache_keys import ArgumentsKeyMaker
+
+
+def f10(a, b, c=3, d=4):
+    pass
+
+
+def old_make_arguments_to_key(args, kwds):
+    key = args
+    if kwds:
+        sorted_items = sorted(kwds.items())
+        for item in sorted_items:
+            key += item
+    return key
+
+
+make_key = ArgumentsKeyMaker(f10)
+make_key_typed = ArgumentsKeyMaker(f10, typed=True)
+
+cases = {
+    '位置参数 f10(1, 2, 3, 4)': ((1, 2, 3, 4), {}),
+    '关键字参数 f10(1, 2, c=3, d=4)': ((1, 2), {'c': 3, 'd': 4}),
+    '默认参数 f10(1, 2)': ((1, 2), {}),
+    '不可哈希参数 f10({..}, [..])': (({'k': 1, 'v': 2}, [1, 2, 3]), {}),
+}
+
+if __name__ == '__main__':
+    number = 200000
+    for name, (args, kwargs) in cases.items():
+        old = timeit.timeit(lambda: old_make_arguments_to_key(args, kwargs), number=number) / number * 1e9
+        new = timeit.timeit(lambda: make_key(args, kwargs), number=number) / number * 1e9
+        typed = timeit.timeit(lambda: make_key_typed(args, kwargs), number=number) / number * 1e9
+        print(f'{name:<30} 旧: {old:7.0f} ns    新: {new:7.0f} ns    新typed: {typed:7.0f} ns')
@@ -0,0 +1,55 @@
+"""
+实例已经创建之后，各种单例再次获取实例的开销，对比旧版本每次调用都加全局锁的 singleton 装饰器。
+PYTHONPATH=. python tests/benchmark_singleton.py
+"""
+import threading
+import timeit
+from functools import wraps
+
+from decorator_libs.common_decorators import singleton, SingletonBaseCall, SingletonBaseNew, SingletonBaseCustomInit
+
+
+def old_singleton(cls):
+    """旧版本的实现，保持原样"""
+    _instance = {}
+    old_singleton.__lock = threading.Lock()
+
+    @wraps(cls)
+    def _singleton(*args, **kwargs):
+        with old_singleton.__lock:
+            if cls not in _instance:
+                _instance[cls] = cls(*args, **kwargs)
+            return _instance[cls]
+
+    return _singleton
+
+
+@old_singleton
+class OldDecorated:
+    pass
+
+
+@singleton
+class Decorated:
+    pass
+
+
+class Meta(SingletonBaseCall):
+    pass
+
+
+class New(SingletonBaseNew):
+    pass
+
+
+class CustomInit(SingletonBaseCustomInit):
+    def _custom_init(self):
+        pass
+
+
+if __name__ == '__main__':
+    n = 1000000
+    for cls in (OldDecorated, Decorated, Meta, New, CustomInit):
+        cls()
+        cost = min(timeit.repeat(cls, number=n, repeat=3)) / n
+        print(f'{cls.__name__:<15} {cost * 1e9:.0f}ns')
@@ -0,0 +1,91 @@
+"""
+对比旧的 KThread + sys.settrace 超时装饰器和新的 线程池 + 看门狗 超时装饰器。
+分别测试 空函数的单次调用开销 和 纯python计算函数被拖慢的程度。
+PYTHONPATH=. python tests/benchmark_timeout.py
+"""
+import sys
+import threading
+import time
+
+from decorator_libs.function_timeout_decorators import timeout, TIMEOUT_EXCEPTION
+
+
+class KThread(threading.Thread):
+    """旧版本的实现，isAlive改成了is_alive，其余保持原样"""
+
+    def __init__(self, *args, **kwargs):
+        threading.Thread.__init__(self, *args, **kwargs)
+        self.killed = False
+        self.__run_backup = None
+
+    def start(self):
+        self.__run_backup = self.run
+        self.run = self.__run
+        threading.Thread.start(self)
+
+    def __run(self):
+        sys.settrace(self.globaltrace)
+        self.__run_backup()
+        self.run = self.__run_backup
+
+    def globaltrace(self, frame, why, arg):
+        if why == 'call':
+            return self.localtrace
+        return None
+
+    def localtrace(self, frame, why, arg):
+        if self.killed:
+            if why == 'line':
+                raise SystemExit()
+        return self.localtrace
+
+    def kill(self):
+        self.killed = True
+
+
+def old_timeout(seconds):
+    def timeout_decorator(func):
+        def _new_func(oldfunc, result, oldfunc_args, oldfunc_kwargs):
+            result.append(oldfunc(*oldfunc_args, **oldfunc_kwargs))
+
+        def _(*args, **kwargs):
+            result = []
+            thd = KThread(target=_new_func, args=(), kwargs={'oldfunc': func, 'result': result,
+                                                             'oldfunc_args': args, 'oldfunc_kwargs': kwargs})
+            thd.start()
+            thd.join(seconds)
+            alive = thd.is_alive()
+            thd.kill()
+            if alive:
+                raise TIMEOUT_EXCEPTION(f'{func.__name__}运行时间超过{seconds}秒')
+            return result[0] if result else result
+
+        return _
+
+    return timeout_decorator
+
+
+def empty():
+    return 1
+
+
+def cpu_work(n=200000):
+    total = 0
+    for i in range(n):
+        total += i % 7
+    return total
+
+
+def bench(fn, number):
+    t0 = time.perf_counter()
+    for _ in range(number):
+        fn()
+    return (time.perf_counter() - t0) / number
+
+
+if __name__ == '__main__':
+    for name, deco in [('旧 KThread+settrace', old_timeout(10)), ('新 线程池+看门狗', timeout(10))]:
+        per_call = bench(deco(empty), 2000)
+        cpu = bench(deco(cpu_work), 20)
+        print(f'{name:<20} 空函数单次调用 {per_call * 1e6:8.1f} us    计算函数 {cpu * 1e3:8.1f} ms')
+    print(f'{"不加装饰器":<20} 空函数单次调用 {bench(empty, 2000) * 1e6:8.1f} us    计算函数 {bench(cpu_work, 20) * 1e3:8.1f} ms')
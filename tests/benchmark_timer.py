@@ -0,0 +1,24 @@
+"""
+timer 装饰器的单次调用开销，对比不装饰的空函数。
+PYTHONPATH=. python tests/benchmark_timer.py
+"""
+import timeit
+
+from decorator_libs.common_decorators import timer
+
+
+def f():
+    pass
+
+
+@timer(flush_interval=None)
+def f_timed():
+    pass
+
+
+if __name__ == '__main__':
+    n = 1000000
+    plain = min(timeit.repeat(f, number=n, repeat=3)) / n
+    timed = min(timeit.repeat(f_timed, number=n, repeat=3)) / n
+    print(f'不装饰 {plain * 1e9:.0f}ns  timer装饰 {timed * 1e9:.0f}ns  开销 {(timed - plain) * 1e9:.0f}ns')
+    print(f_timed.timer_snapshot())